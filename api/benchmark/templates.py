@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Benchmark for evaluating the same forge's fields across many requests,
+with a fresh Jinja2 environment per request (like before) vs the shared cache
+"""
+
+import sys
+import time
+
+import jinja2
+import yaes
+
+import service
+
+FIELDS = 40
+REQUESTS = 100
+
+def forge():
+    """
+    A big form with conditions, templated descriptions, and defaults
+    """
+
+    fields = [
+        {
+            "name": "kind",
+            "options": ["api", "daemon", "gui"],
+            "trigger": True
+        }
+    ]
+
+    for index in range(FIELDS):
+        fields.append({
+            "name": f"setting{index}",
+            "description": "{{ kind }} setting {{ craft }} #" + str(index),
+            "default": "{{ craft }}-{{ kind }}-{{ port(craft) }}",
+            "condition": "{? kind != 'gui' or " + str(index) + " % 2 == 0 ?}"
+        })
+
+    return {
+        "id": "big",
+        "description": "Big form",
+        "input": {
+            "fields": fields
+        }
+    }
+
+def evaluate(cnc):
+    """
+    Evaluates the fields like OPTIONS does
+    """
+
+    cnc.fields(forge(), {"craft": "fun-time", "kind": "api"})
+
+def fresh():
+    """
+    New environment for every request
+    """
+
+    start = time.perf_counter()
+
+    for _ in range(REQUESTS):
+        cnc = service.CnC()
+        env = jinja2.Environment(keep_trailing_newline=True)
+        env.globals.update(port=cnc.port)
+        cnc.engine = yaes.Engine(env)
+        evaluate(cnc)
+
+    return time.perf_counter() - start
+
+def cached():
+    """
+    Shared, caching environment for every request
+    """
+
+    start = time.perf_counter()
+
+    for _ in range(REQUESTS):
+        evaluate(service.CnC())
+
+    return time.perf_counter() - start
+
+def main():
+    """
+    Runs both and prints the comparison
+    """
+
+    before = fresh()
+    after = cached()
+
+    print(f"{REQUESTS} requests x {FIELDS} fields")
+    print(f"fresh:  {before:.3f}s ({before / REQUESTS * 1000:.1f}ms per request)")
+    print(f"cached: {after:.3f}s ({after / REQUESTS * 1000:.1f}ms per request)")
+    print(f"speedup: {before / after:.1f}x")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,22 +2,31 @@
 Module for the service
 """
 
-# pylint: disable=no-self-use,too-many-instance-attributes
+# pylint: disable=no-self-use,too-many-instance-attributes,too-many-public-methods
 
 import os
+import re
 import time
 import copy
 import glob
 import json
+import hashlib
+import functools
+import threading
+import collections
+import concurrent.futures
 
 import yaml
 import redis
+import urllib3
 import requests
+import requests.adapters
 
 import flask
 import flask_restful
 
 import jinja2
+import jinja2.meta
 import opengui
 import overscore
 import yaes
@@ -42,6 +51,69 @@ RESERVED = [
     "cnc"
 ]
 
+QUEUE = "/queue/cnc"
+INDEX = "/index/cnc"
+STATUS = "/status/cnc"
+
+# What's kept in a CnC's status hash, away from its bulky definition
+
+HOT = [
+    "status",
+    "error",
+    "links",
+    "progress",
+    "timings"
+]
+
+STATUSES = [
+    "Created",
+    "Retry",
+    "Completed",
+    "Error"
+]
+
+class Environment(jinja2.Environment):
+    """
+    Jinja2 environment that keeps templates compiled from strings, least
+    recently used dropped past size
+    """
+
+    def __init__(self, size=1024, **kwargs):
+
+        super().__init__(**kwargs)
+
+        self.size = size
+        self.compiled = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def from_string(self, source, globals=None, template_class=None):
+        """
+        Loads a template from a string, compiling only if we haven't seen it
+        """
+
+        key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+        with self.lock:
+            code = self.compiled.get(key)
+            if code is not None:
+                self.compiled.move_to_end(key)
+                self.hits += 1
+
+        if code is None:
+
+            code = self.compile(source)
+
+            with self.lock:
+                self.misses += 1
+                self.compiled[key] = code
+                while len(self.compiled) > self.size:
+                    self.compiled.popitem(last=False)
+
+        return (template_class or self.template_class).from_code(self, code, self.make_globals(globals), None)
+
+
 class Options:
     """
     Class for retrieving options remotely
@@ -49,10 +121,21 @@ class Options:
 
     creds = {}
 
+    ttl = 60
+    stale = 300
+    size = 1024
+    redis = None
+    timeout = 10
+
+    cache = collections.OrderedDict()
+    refreshing = set()
+    sessions = {}
+    lock = threading.Lock()
+
     @classmethod
-    def config(cls):
+    def config(cls, store=None):
         """
-        Sets up creds
+        Sets up creds and caching
         """
 
         for creds in glob.glob("/opt/service/secret/options_*.json"):
@@ -63,7 +146,75 @@ class Options:
                 cls.creds[name] = json.load(creds_file)
                 cls.creds[name].setdefault("verify", True)
 
+        cls.ttl = int(os.environ.get("OPTIONS_TTL", 60))
+        cls.stale = int(os.environ.get("OPTIONS_STALE", 300))
+        cls.size = int(os.environ.get("OPTIONS_CACHE", 1024))
+        cls.redis = store if os.environ.get("OPTIONS_SHARE", "false").lower() == "true" else None
+        cls.timeout = float(os.environ.get("OPTIONS_TIMEOUT", 10))
+
+    @classmethod
+    def pooled(cls, name, url, pool, retries, backoff):
+        """
+        Gets the keep alive session for creds and a base url, creating if needed
+        """
+
+        with cls.lock:
+
+            if (name, url) not in cls.sessions:
+
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=pool,
+                    pool_maxsize=pool,
+                    max_retries=urllib3.util.retry.Retry(
+                        total=retries,
+                        backoff_factor=backoff,
+                        status_forcelist=[429, 500, 502, 503, 504]
+                    )
+                )
+
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+
+                cls.sessions[(name, url)] = session
+
+            return cls.sessions[(name, url)]
+
+    @classmethod
+    def stats(cls):
+        """
+        Requests made and connections opened per session, the difference being reuse
+        """
+
+        stats = {}
+
+        with cls.lock:
+            sessions = list(cls.sessions.items())
+
+        for (name, url), session in sessions:
+
+            stat = {"requests": 0, "connections": 0}
+
+            for adapter in set(session.adapters.values()):
+                for pool_key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools.get(pool_key)
+                    if pool is not None:
+                        stat["requests"] += pool.num_requests
+                        stat["connections"] += pool.num_connections
+
+            stat["reused"] = stat["requests"] - stat["connections"]
+
+            stats[f"{name} {url}"] = stat
+
+        return stats
+
     session = None
+    name = None
+    auth = None
+    headers = None
+    search = None
+    defer = None
+    limit = None
     method = None
     url = None
     verify = None
@@ -76,9 +227,9 @@ class Options:
 
     def __init__(self, data):
 
-        self.session = requests.Session()
+        self.name = data.get("creds", "default")
 
-        creds = copy.deepcopy(self.creds.get(data.get("creds", "default"), {"verify": True}))
+        creds = copy.deepcopy(self.creds.get(self.name, {"verify": True}))
         creds.update(data)
 
         creds.setdefault("method", "GET")
@@ -89,6 +240,15 @@ class Options:
         creds.setdefault("results", "")
         creds.setdefault("option", "")
         creds.setdefault("title", "")
+        creds.setdefault("ttl", self.ttl)
+        creds.setdefault("stale", self.stale)
+        creds.setdefault("timeout", self.timeout)
+        creds.setdefault("pool", 10)
+        creds.setdefault("search", None)
+        creds.setdefault("defer", None)
+        creds.setdefault("limit", 50)
+        creds.setdefault("retries", 3)
+        creds.setdefault("backoff", 0.5)
 
         self.url = creds["url"]
         self.verify = creds["verify"]
@@ -100,24 +260,246 @@ class Options:
         self.results = creds["results"]
         self.option = creds["option"]
         self.title = creds["title"]
+        self.ttl = creds["ttl"]
+        self.stale = creds["stale"]
+        self.timeout = creds["timeout"]
+        self.search = creds["search"]
+        self.defer = creds["defer"]
+        self.limit = creds["limit"]
+
+        self.session = self.pooled(self.name, self.url, creds["pool"], creds["retries"], creds["backoff"])
 
         if "username" in creds:
-            self.session.auth = (creds["username"], creds["password"])
+            self.auth = (creds["username"], creds["password"])
+
+        self.headers = {}
 
         if "token" in creds:
-            self.session.headers["Authorization"] = f"Bearer {creds['token']}"
+            self.headers["Authorization"] = f"Bearer {creds['token']}"
 
         if creds["headers"]:
-            self.session.headers.update(creds["headers"])
+            self.headers.update(creds["headers"])
+
+    def key(self):
+        """
+        Identifies the request for caching
+        """
+
+        request = [self.name, self.method, self.url, self.path, self.params, self.body]
+
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def request(self):
+        """
+        Makes the request upstream, raising on an error status so it's never cached
+        """
+
+        url = f"{self.url}/{self.path}" if self.path else self.url
+
+        response = self.session.request(
+            self.method, url, verify=self.verify, params=self.params, json=self.body,
+            auth=self.auth, headers=self.headers, timeout=self.timeout
+        )
+
+        response.raise_for_status()
+
+        return response.json()
+
+    def lookup(self, key):
+        """
+        Finds a cached (stored, results), locally then shared
+        """
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        if self.redis is None:
+            return None
+
+        shared = self.redis.get(f"/options/{key}")
+
+        if not shared:
+            return None
+
+        shared = json.loads(shared)
+
+        self.remember(key, shared["stored"], shared["results"])
+
+        return shared["stored"], shared["results"]
+
+    def remember(self, key, stored, results):
+        """
+        Stores locally, evicting the least recently used
+        """
+
+        with self.lock:
+
+            self.cache[key] = (stored, results)
+            self.cache.move_to_end(key)
+
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def store(self, key, results):
+        """
+        Stores locally and shared
+        """
+
+        stored = time.time()
+
+        self.remember(key, stored, results)
+
+        if self.redis is not None:
+            self.redis.set(f"/options/{key}", json.dumps({"stored": stored, "results": results}), ex=self.ttl + self.stale)
+
+    def fetch(self, key):
+        """
+        Requests and caches
+        """
+
+        results = self.request()
+
+        self.store(key, results)
+
+        return results
+
+    def revalidate(self, key):
+        """
+        Fetches in the background, once per key at a time, keeping what's cached
+        if it fails
+        """
+
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.fetch(key)
+            except Exception as exception: # pylint: disable=broad-except
+                print(f"options refresh failed: {exception}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def cached(self):
+        """
+        Returns results, fresh from cache, stale while revalidating, or requested
+        """
+
+        if self.ttl <= 0:
+            return self.request()
+
+        key = self.key()
+        entry = self.lookup(key)
+
+        if entry is not None:
+
+            age = time.time() - entry[0]
+
+            if age < self.ttl:
+                return entry[1]
+
+            if age < self.ttl + self.stale:
+                self.revalidate(key)
+                return entry[1]
+
+        return self.fetch(key)
 
     def retrieve(self, extra):
         """
         Retrieves the options and adds to extra
         """
 
-        url = f"{self.url}/{self.path}" if self.path else self.url
+        self.extract(self.cached(), extra)
+
+    def find(self, filter, page, extra):
+        """
+        Retrieves a page of options matching filter and adds to extra
+        """
+
+        if isinstance(self.search, str) and filter:
+            self.params = {**self.params, self.search: filter}
+
+        self.retrieve(extra)
+
+        options = extra["options"]
+        titles = extra.get("titles", {})
+
+        if self.search is True and filter:
+            lowered = filter.lower()
+            options = [
+                option for option in options
+                if lowered in str(option).lower() or lowered in str(titles.get(option, "")).lower()
+            ]
+
+        start = (page - 1) * self.limit
+
+        extra["options"] = options[start:start + self.limit]
+        extra["page"] = page
+        extra["more"] = len(options) > start + self.limit
+
+        if "titles" in extra:
+            extra["titles"] = {option: titles[option] for option in extra["options"] if option in titles}
+
+    def check(self, values, extra):
+        """
+        Retrieves just the options among values, searching upstream for each if it can, and adds to extra
+        """
+
+        values = values if isinstance(values, list) else ([] if values is None else [values])
 
-        results = self.session.request(self.method, url, verify=self.verify, params=self.params, json=self.body).json()
+        if isinstance(self.search, str):
+            searches = [{**self.params, self.search: value} for value in values]
+        else:
+            searches = [self.params]
+
+        options = []
+        titles = {}
+
+        for params in searches:
+
+            self.params = params
+
+            found = {}
+            self.retrieve(found)
+
+            for option in found["options"]:
+                if option in values and option not in options:
+                    options.append(option)
+
+            titles.update(found.get("titles", {}))
+
+        extra["options"] = options
+
+        if self.title:
+            extra["titles"] = {option: titles[option] for option in options if option in titles}
+
+    def fallback(self, extra):
+        """
+        Adds whatever's cached, however old, or no options to extra
+        """
+
+        entry = self.lookup(self.key())
+
+        if entry is not None:
+            self.extract(entry[1], extra)
+            return
+
+        extra["options"] = []
+
+        if self.title:
+            extra["titles"] = {}
+
+    def extract(self, results, extra):
+        """
+        Adds options and titles from results to extra
+        """
 
         if self.results:
             results = overscore.get(results, self.results)
@@ -149,10 +531,15 @@ def build():
     app.redis = redis.Redis(host="redis.cnc-forge", charset="utf-8", decode_responses=True)
 
     app.api.add_resource(Health, '/health')
+    app.api.add_resource(GitHub, '/github')
     app.api.add_resource(Forge, '/forge', '/forge/<id>')
+    app.api.add_resource(Field, '/forge/<id>/field/<name>/options')
     app.api.add_resource(CnC, '/cnc', '/cnc/<id>')
 
-    Options.config()
+    Options.config(app.redis)
+    Forge.config()
+    CnC.config()
+    CnC.reindex(app.redis)
 
     return app
 
@@ -164,43 +551,191 @@ class Health(flask_restful.Resource):
 
     def get(self):
         """
-        Just return ok
+        Just return ok, with options connection stats
         """
-        return {"message": "OK"}
+        return {"message": "OK", "options": Options.stats()}
 
 
-class Forge(flask_restful.Resource):
+class GitHub(flask_restful.Resource):
     """
-    Forge class for design patterns to cnc
+    Class for what the daemon's seen of GitHub, kept out of health so probes don't wait on Redis
     """
 
     @staticmethod
-    def forges():
+    def budgets(store, names):
         """
-        Gets all forges return as dict
+        What's left of each creds' GitHub rate limit, as the daemon last saw it
+        """
+
+        pipeline = store.pipeline()
+
+        for name in names:
+            pipeline.hgetall(f"/github/budget/{name}")
+
+        return {
+            name: {field: int(value) for field, value in budget.items()}
+            for name, budget in zip(names, pipeline.execute()) if budget
+        }
+
+    @staticmethod
+    def latency(store, names):
+        """
+        How long the daemon's GitHub calls have taken, counts by method and bucket
+        """
+
+        pipeline = store.pipeline()
+
+        for name in names:
+            pipeline.hgetall(f"/github/latency/{name}")
+
+        return {
+            name: {field: float(value) if field.endswith(" sum") else int(value) for field, value in latency.items()}
+            for name, latency in zip(names, pipeline.execute()) if latency
+        }
+
+    def get(self):
         """
+        Budgets and latency for every creds the daemon's used
+        """
+
+        store = flask.current_app.redis
+
+        names = sorted(store.smembers("/github/creds"))
+
+        return {"budgets": self.budgets(store, names), "latency": self.latency(store, names)}
 
-        forges = {}
 
-        for forge_path in sorted(glob.glob("/opt/service/forge/*.yaml")) + sorted(glob.glob("/opt/service/repo/*/*/forge/*.yaml")):
-            if forge_path.split("/")[-1] not in ["fields.yaml", "values.yaml"]:
-                with open(forge_path, "r") as forge_file:
-                    forges[forge_path.split("/")[-1].split(".")[0]] = yaml.safe_load(forge_file)["description"]
+class Catalog:
+    """
+    Class for keeping parsed forges in memory, only reparsing what's changed
+
+    Files are globbed and stat'd at most every interval seconds and a file is
+    only parsed again if its inode, mtime, or size differs.
+    """
+
+    def __init__(self, interval=0):
 
-        return forges
+        self.interval = interval
+        self.checked = None
+        self.lock = threading.Lock()
+
+        self.files = {}
+        self.index = {}
+        self.descriptions = {}
 
     @staticmethod
-    def forge(id):
+    def stamp(path):
+        """
+        What identifies a version of a file
+        """
+
+        stat = os.stat(path)
+
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def stale(self):
         """
-        Gets a single forge and return as dict
+        Whether it's time to check the files again
         """
 
-        paths = sorted(glob.glob(f"/opt/service/repo/*/*/forge/{id}.yaml"))
+        return self.checked is None or time.time() - self.checked >= self.interval
+
+    def refresh(self):
+        """
+        Rebuilds the index, parsing only new or changed files
+        """
+
+        if not self.stale():
+            return
+
+        with self.lock:
+
+            if not self.stale():
+                return
+
+            files = {}
+            index = {}
+
+            for forge_path in sorted(glob.glob("/opt/service/forge/*.yaml")) + sorted(glob.glob("/opt/service/repo/*/*/forge/*.yaml")):
+
+                if forge_path.split("/")[-1] in ["fields.yaml", "values.yaml"]:
+                    continue
 
-        with open(paths[-1] if paths else f"/opt/service/forge/{id}.yaml", "r") as forge_file:
-            forge = yaml.safe_load(forge_file)
+                try:
+                    stamp = self.stamp(forge_path)
+                except OSError:
+                    continue
 
-        forge["id"] = id.split("/")[-1]
+                if forge_path in self.files and self.files[forge_path][0] == stamp:
+                    files[forge_path] = self.files[forge_path]
+                else:
+                    with open(forge_path, "r") as forge_file:
+                        files[forge_path] = (stamp, yaml.safe_load(forge_file))
+
+                index[forge_path.split("/")[-1].split(".")[0]] = files[forge_path][1]
+
+            self.files = files
+            self.index = index
+            self.descriptions = {id: forge["description"] for id, forge in index.items()}
+            self.checked = time.time()
+
+    def forges(self):
+        """
+        Gets all forge descriptions by id
+        """
+
+        self.refresh()
+
+        return dict(self.descriptions)
+
+    def forge(self, id):
+        """
+        Gets a copy of a single forge, None if not found
+        """
+
+        self.refresh()
+
+        forge = self.index.get(id)
+
+        if forge is None:
+            return None
+
+        return copy.deepcopy(forge)
+
+
+class Forge(flask_restful.Resource):
+    """
+    Forge class for design patterns to cnc
+    """
+
+    catalog = None
+
+    @classmethod
+    def config(cls):
+        """
+        Sets up the catalog
+        """
+
+        cls.catalog = Catalog(int(os.environ.get("REFRESH", 5)))
+
+    @classmethod
+    def forges(cls):
+        """
+        Gets all forges return as dict
+        """
+
+        return cls.catalog.forges()
+
+    @classmethod
+    def forge(cls, id):
+        """
+        Gets a single forge and return as dict, None if not found
+        """
+
+        forge = cls.catalog.forge(id)
+
+        if forge is not None:
+            forge["id"] = id
 
         return forge
 
@@ -220,13 +755,11 @@ class Forge(flask_restful.Resource):
         Return a single forge
         """
 
-        forges = cls.forges()
+        forge = cls.forge(id)
 
-        if id not in forges:
+        if forge is None:
             return {"message": f"forge '{id}' not found"}, 404
 
-        forge = cls.forge(id)
-
         return {"forge": forge, "yaml": yaml.safe_dump(forge, default_flow_style=False)}
 
     def get(self, id=None):
@@ -240,16 +773,78 @@ class Forge(flask_restful.Resource):
         return self.retrieve(id)
 
 
+class Field(flask_restful.Resource):
+    """
+    Field class for looking up a single field's options
+    """
+
+    def post(self, id, name):
+        """
+        POST method handling, with values, and filter and page if searching
+        """
+
+        forge = Forge.forge(id)
+
+        if forge is None:
+            return {"message": f"forge '{id}' not found"}, 404
+
+        request = flask.request.json or {}
+
+        try:
+            page = int(request.get("page", 1))
+        except (TypeError, ValueError):
+            page = 0
+
+        if page < 1:
+            return {"message": "page must be a positive integer"}, 400
+
+        extra = CnC().search(forge, request.get("values", {}), name, request.get("filter", ""), page)
+
+        if extra is None:
+            return {"message": f"field '{name}' has no remote options"}, 404
+
+        return extra, 200
+
+
 class CnC(flask_restful.Resource):
     """
     Class of actions to force code and/or chagnes from Forge's.
     """
 
+    pool = None
+
+    graphs = collections.OrderedDict()
+    graphing = threading.Lock()
+
+    @classmethod
+    def config(cls):
+        """
+        Sets up the pool for fetching options
+        """
+
+        cls.pool = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.environ.get("OPTIONS_WORKERS", 8)))
+
+    env = None
+    shared = None
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        env = jinja2.Environment(keep_trailing_newline=True)
-        env.globals.update(port=self.port)
-        self.engine = yaes.Engine(env)
+        self.engine = self.environment()
+        self.fetching = None
+
+    @classmethod
+    def environment(cls):
+        """
+        Gets the template engine shared by all requests in this process
+        """
+
+        if cls.shared is None:
+            env = Environment(size=int(os.environ.get("TEMPLATES", 1024)), keep_trailing_newline=True)
+            env.globals.update(port=cls.port)
+            cls.env = env
+            cls.shared = yaes.Engine(env)
+
+        return cls.shared
 
     @staticmethod
     def port(name):
@@ -264,9 +859,117 @@ class CnC(flask_restful.Resource):
 
         return int(f"{ord(words[0][0])}{ord(words[1][0])}")
 
+    def depends(self, block):
+        """
+        Gets the values a block references and whether it's too dynamic to tell
+        """
+
+        names = set()
+        dynamic = False
+
+        def reference(text, name):
+
+            nonlocal dynamic
+
+            if "{" in text:
+                dynamic = True
+                template(text)
+            else:
+                names.add(name)
+
+        def template(text):
+
+            nonlocal dynamic
+
+            if len(text) > 4 and text[:2] == "{[" and text[-2:] == "]}":
+                path = text[2:-2].strip()
+                reference(path, path.split("__")[0])
+                return
+
+            if len(text) > 4 and text[:2] == "{?" and text[-2:] == "?}":
+                text = "{{%s}}" % text[2:-2]
+
+            try:
+                names.update(jinja2.meta.find_undeclared_variables(self.engine.env.parse(text)))
+            except jinja2.TemplateSyntaxError:
+                dynamic = True
+
+        def walk(item):
+
+            if isinstance(item, dict):
+                for key, value in item.items():
+                    if key == "requires":
+                        for path in value if isinstance(value, list) else [value]:
+                            reference(path, path.split("__")[0])
+                    elif key in ["iterate", "transpose"]:
+                        names.update(value.values())
+                    elif key == "name" and isinstance(value, str):
+                        reference(value, value)
+                    else:
+                        walk(value)
+            elif isinstance(item, list):
+                for value in item:
+                    walk(value)
+            elif isinstance(item, str):
+                template(item)
+
+        walk(block)
+
+        return names, dynamic
+
+    def graph(self, forge):
+        """
+        Gets which blocks depend on which values, and which always need evaluating,
+        built once per forge input
+        """
+
+        blocks = forge.get("input", {}).get("fields", [])
+
+        key = hashlib.sha256(json.dumps(blocks, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+        with self.graphing:
+            if key in self.graphs:
+                self.graphs.move_to_end(key)
+                return self.graphs[key]
+
+        graph = {"values": {}, "dynamic": []}
+
+        for index, block in enumerate(blocks):
+
+            names, dynamic = self.depends(block)
+
+            if dynamic:
+                graph["dynamic"].append(index)
+
+            for name in names:
+                graph["values"].setdefault(name, []).append(index)
+
+        with self.graphing:
+
+            self.graphs[key] = graph
+
+            while len(self.graphs) > 128:
+                self.graphs.popitem(last=False)
+
+        return graph
+
+    def affected(self, forge, changed):
+        """
+        Gets the indexes of the blocks to evaluate when these values changed
+        """
+
+        graph = self.graph(forge)
+
+        indexes = set(graph["dynamic"])
+
+        for name in changed:
+            indexes.update(graph["values"].get(name, []))
+
+        return indexes
+
     def field(self, fields, field, values):
         """
-        Adds a field if requires and conditions are satsified
+        Adds a field if requires and conditions are satsified, returning its name
         """
 
         children = None
@@ -291,15 +994,21 @@ class CnC(flask_restful.Resource):
         extra = {}
 
         if isinstance(field.get("options"), dict):
-            Options(field["options"]).retrieve(extra)
+            if self.fetching is not None:
+                self.fetching.append((fields, field["name"], Options(field["options"])))
+            else:
+                Options(field["options"]).retrieve(extra)
 
         fields.update({**field, **extra})
 
         fields[field['name']].fields = children
 
-    def fields(self, forge, values):
+        return field['name']
+
+    def evaluate(self, forge, values, changed=None):
         """
-        Gets the dynamic fields
+        Gets the dynamic fields, the options they still need, and the names from
+        each input block, only evaluating the blocks affected if changed is sent
         """
 
         values["forge"] = forge['id']
@@ -321,45 +1030,166 @@ class CnC(flask_restful.Resource):
 
         fields["forge"].description = forge["description"]
 
-        for field, each_values in self.engine.each(forge.get("input", {}).get("fields", []), values):
-            self.field(fields, field, each_values)
+        affected = None if changed is None else self.affected(forge, changed)
+
+        blocks = {}
+
+        self.fetching = []
+
+        try:
+            for index, block in enumerate(forge.get("input", {}).get("fields", [])):
+                if affected is None or index in affected:
+                    blocks[index] = []
+                    for field, each_values in self.engine.each(block, values):
+                        blocks[index].append(self.field(fields, field, each_values))
+            fetching = self.fetching
+        finally:
+            self.fetching = None
+
+        return fields, fetching, blocks
+
+    def fields(self, forge, values, lazy=True):
+        """
+        Gets the dynamic fields with their options, unless searched or (if lazy) deferred
+        """
+
+        fields, fetching, _ = self.evaluate(forge, values)
+
+        self.fetch(fetching, forge.get("input", {}).get("defer", False), lazy)
 
         return fields
 
+    def search(self, forge, values, name, filter, page):
+        """
+        Gets the options for a single field, a page if searching, None if there's no such field
+        """
+
+        fetching = self.evaluate(forge, values)[1]
+
+        for _, field, options in fetching:
+            if field == name:
+                extra = {}
+                if options.search:
+                    options.find(filter, page, extra)
+                else:
+                    options.retrieve(extra)
+                return extra
+
+        return None
+
+    def fetch(self, fetching, defer=False, lazy=True):
+        """
+        Retrieves all the options at once, falling back if any take too long
+
+        If lazy, searched and deferred options are left to the field endpoint,
+        with just whatever's selected as options for now. If not, searched
+        options are checked upstream for whatever's selected.
+        """
+
+        start = time.time()
+
+        retrieving = []
+
+        for fields, name, options in fetching:
+
+            if lazy and (options.search or (defer if options.defer is None else options.defer)):
+                value = fields[name].value
+                fields.update({
+                    "name": name,
+                    "options": value if isinstance(value, list) else ([] if value is None else [value]),
+                    "search" if options.search else "defer": True
+                })
+                continue
+
+            extra = {}
+
+            if options.search:
+                future = self.pool.submit(options.check, fields[name].value, extra)
+            else:
+                future = self.pool.submit(options.retrieve, extra)
+
+            retrieving.append((fields, name, options, extra, future))
+
+        for fields, name, options, extra, future in retrieving:
+
+            try:
+                future.result(timeout=max(0, start + options.timeout - time.time()))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                extra = {}
+                options.fallback(extra)
+
+            fields.update({"name": name, **extra})
+
+            if not lazy and options.search and not fields[name].options:
+                fields[name].validation = functools.partial(self.unfound, fields[name].validation)
+
+    @staticmethod
+    def unfound(validation, field, errors):
+        """
+        Fails a searched field with values when none were found upstream, as
+        no options at all means anything goes, then validates as usual
+        """
+
+        if field.value not in (None, []):
+            errors.append(f"invalid value {field.value!r}")
+
+        if callable(validation):
+            validation(field, errors)
+        elif validation and field.value is not None and not re.match(validation, field.value):
+            errors.append(f"must match '{validation}'")
+
     def options(self, id):
         """
         OPTIONS method handling
         """
 
-        forges = Forge.forges()
+        forge = Forge.forge(id)
 
-        if id not in forges:
+        if forge is None:
             return {"message": f"forge '{id}' not found"}, 404
 
-        forge = Forge.forge(id)
+        request = flask.request.json or {}
+
+        changed = request.get("changed")
 
-        fields = self.fields(forge, (flask.request.json or {}).get("values", {}))
+        fields, fetching, blocks = self.evaluate(forge, request.get("values", {}), changed)
+
+        self.fetch(fetching, forge.get("input", {}).get("defer", False))
 
         fields.validate()
 
-        return fields.to_dict(), 200
+        response = fields.to_dict()
+
+        if changed is None:
+            response["blocks"] = [blocks[index] for index in sorted(blocks)]
+            return response, 200
+
+        names = set(changed)
+
+        for block in blocks.values():
+            names.update(block)
+
+        response["fields"] = [field for field in response["fields"] if field["name"] in names]
+        response["blocks"] = {str(index): block for index, block in blocks.items()}
+        response["delta"] = True
+
+        return response, 200
 
     def post(self, id):
         """
         POST method handling
         """
 
-        forges = Forge.forges()
+        forge = Forge.forge(id)
 
-        if id not in forges:
+        if forge is None:
             return {"message": f"forge '{id}' not found"}, 404
 
-        forge = Forge.forge(id)
-
         if "action" not in (flask.request.json or {}):
             return {"message": "missing action"}, 400
 
-        fields = self.fields(forge, (flask.request.json or {}).get("values"))
+        fields = self.fields(forge, (flask.request.json or {}).get("values"), lazy=False)
 
         if not fields.validate():
             return fields.to_dict(), 400
@@ -383,36 +1213,346 @@ class CnC(flask_restful.Resource):
         cnc["values"]["code"] = craft.replace('-', '_')
         cnc["status"] = "Created"
 
-        cnc["id"] = f"{craft}-{cnc['values']['forge']}-{int(time.time())}"
+        created = int(time.time())
+
+        cnc["id"] = f"{craft}-{cnc['values']['forge']}-{created}"
+        cnc["timings"] = {"created": created}
 
         cnc["values"]["cnc"] = cnc["id"]
 
-        flask.current_app.redis.set(f"/cnc/{cnc['id']}", json.dumps(cnc), ex=86400)
+        pipeline = flask.current_app.redis.pipeline()
+        self.store(pipeline, cnc)
+        pipeline.execute()
+
+        self.sweep(flask.current_app.redis)
+
+        flask.current_app.redis.lpush(QUEUE, cnc['id'])
 
         return {"cnc": cnc}, 202
 
     @staticmethod
-    def list():
+    def created(id):
+        """
+        When a CnC was created, from the end of its id
+        """
+
+        try:
+            return int(id.rsplit("-", 1)[-1])
+        except ValueError:
+            return int(time.time())
+
+    @classmethod
+    def index(cls, pipeline, cnc):
+        """
+        Adds a CnC to the indexes, by creation, forge, and only its current status
+        """
+
+        score = {cnc["id"]: cls.created(cnc["id"])}
+        forge = cnc.get('values', {}).get('forge')
+
+        pipeline.zadd(INDEX, score)
+        pipeline.zadd(f"{INDEX}/forge/{forge}", score)
+        pipeline.sadd(f"{INDEX}/forges", forge)
+
+        for status in STATUSES:
+            if status != cnc.get("status"):
+                pipeline.zrem(f"{INDEX}/status/{status}", cnc["id"])
+
+        pipeline.zadd(f"{INDEX}/status/{cnc.get('status')}", score)
+
+    @classmethod
+    def unindex(cls, pipeline, cnc):
+        """
+        Removes a CnC from the indexes
+        """
+
+        pipeline.zrem(INDEX, cnc["id"])
+        pipeline.zrem(f"{INDEX}/forge/{cnc.get('values', {}).get('forge')}", cnc["id"])
+
+        for status in STATUSES:
+            pipeline.zrem(f"{INDEX}/status/{status}", cnc["id"])
+
+    @staticmethod
+    def prune(store, ids):
+        """
+        Removes ids from every index, for when their CnCs have expired and
+        we no longer know their forge
+        """
+
+        pipeline = store.pipeline()
+
+        pipeline.zrem(INDEX, *ids)
+
+        for status in STATUSES:
+            pipeline.zrem(f"{INDEX}/status/{status}", *ids)
+
+        for forge in store.smembers(f"{INDEX}/forges"):
+            pipeline.zrem(f"{INDEX}/forge/{forge}", *ids)
+
+        pipeline.execute()
+
+    @classmethod
+    def sweep(cls, store):
+        """
+        Prunes the oldest ids whose CnCs have expired, as listing newest first
+        rarely gets that far back
+        """
+
+        ids = store.zrangebyscore(INDEX, "-inf", int(time.time()) - 86400, start=0, num=100)
+
+        if not ids:
+            return
+
+        pipeline = store.pipeline()
+
+        for cnc_id in ids:
+            pipeline.exists(f"/cnc/{cnc_id}")
+
+        stale = [cnc_id for cnc_id, exists in zip(ids, pipeline.execute()) if not exists]
+
+        if stale:
+            cls.prune(store, stale)
+
+    @staticmethod
+    def state(cnc):
+        """
+        The status hash fields of a CnC, each as JSON
+        """
+
+        return {field: json.dumps(cnc[field]) for field in HOT if field in cnc}
+
+    @staticmethod
+    def unstate(fields, values):
+        """
+        The status hash fields that were there, from JSON
+        """
+
+        return {field: json.loads(value) for field, value in zip(fields, values) if value is not None}
+
+    @classmethod
+    def store(cls, pipeline, cnc):
+        """
+        Saves a CnC's whole definition, a fresh status hash of its hot fields, and indexes
+        """
+
+        pipeline.set(f"/cnc/{cnc['id']}", json.dumps(cnc), ex=86400)
+        pipeline.delete(f"{STATUS}/{cnc['id']}")
+        pipeline.hset(f"{STATUS}/{cnc['id']}", mapping=cls.state(cnc))
+        pipeline.expire(f"{STATUS}/{cnc['id']}", 86400)
+        cls.index(pipeline, cnc)
+
+    @classmethod
+    def reindex(cls, store):
+        """
+        Indexes any CnCs from before there were indexes, and any forges indexed
+        from before we kept track of them
+        """
+
+        pipeline = store.pipeline()
+
+        for key in store.scan_iter(f"{INDEX}/forge/*"):
+            pipeline.sadd(f"{INDEX}/forges", key[len(f"{INDEX}/forge/"):])
+
+        for key in store.scan_iter("/cnc/*"):
+
+            cnc = store.get(key)
+
+            if cnc:
+                cls.index(pipeline, json.loads(cnc))
+
+        pipeline.execute()
+
+    @staticmethod
+    def summary(cnc):
         """
-        Returns the list of tasks
+        What to list about a CnC
         """
 
-        return {"cncs": [{"id": id.split("/")[-1]} for id in sorted(flask.current_app.redis.keys("/cnc/*"))]}
+        return {
+            "id": cnc["id"],
+            "status": cnc.get("status"),
+            "forge": cnc.get("values", {}).get("forge"),
+            "action": cnc.get("action"),
+            "links": cnc.get("links", [])
+        }
 
     @staticmethod
-    def retrieve(id):
+    def cursor(args):
         """
-        Return a single task
+        Where the last page left off, as score and id, raising ValueError if invalid
         """
 
-        cnc = flask.current_app.redis.get(f"/cnc/{id}")
+        if not args.get("cursor"):
+            return None
+
+        score, cnc_id = args["cursor"].split(":", 1)
+
+        return (int(score), cnc_id)
+
+    @staticmethod
+    def indexed(store, args):
+        """
+        Which index to list from, and the indexes that went into it, intersecting
+        status and forge into a short lived one if filtering by both
+        """
+
+        keys = []
+
+        if args.get("status"):
+            keys.append(f"{INDEX}/status/{args['status']}")
+
+        if args.get("forge"):
+            keys.append(f"{INDEX}/forge/{args['forge']}")
+
+        if not keys:
+            return INDEX, keys
+
+        if len(keys) == 1:
+            return keys[0], keys
+
+        key = f"{INDEX}/query/{args['status']}/{args['forge']}"
+        store.zinterstore(key, keys, aggregate="MAX")
+        store.expire(key, 10)
+
+        return key, keys
+
+    @classmethod
+    def summaries(cls, store, batch):
+        """
+        Summaries of a batch of ids and scores, None for those that have expired
+        """
+
+        pipeline = store.pipeline()
+        pipeline.mget([f"/cnc/{cnc_id}" for cnc_id, _ in batch])
+
+        for cnc_id, _ in batch:
+            pipeline.hmget(f"{STATUS}/{cnc_id}", ["status", "links"])
+
+        found, *states = pipeline.execute()
+
+        return [
+            cls.summary({**json.loads(cnc), **cls.unstate(["status", "links"], state)}) if cnc else None
+            for cnc, state in zip(found, states)
+        ]
+
+    @classmethod
+    def scan(cls, store, key, cursor, limit):
+        """
+        Scores and summaries past the cursor, one more than the limit if there
+        is more, and ids that have expired, which are only pruned once we're
+        done, so offsets don't shift under us
+        """
+
+        cncs = []
+        stale = []
+        offset = 0
+
+        while len(cncs) <= limit:
+
+            batch = store.zrevrangebyscore(key, cursor[0] if cursor else "+inf", "-inf", start=offset, num=limit + 1, withscores=True)
+
+            if not batch:
+                break
+
+            offset += len(batch)
+
+            batch = [
+                (cnc_id, int(score)) for cnc_id, score in batch
+                if cursor is None or score < cursor[0] or (score == cursor[0] and cnc_id < cursor[1])
+            ]
+
+            for (cnc_id, score), summary in zip(batch, cls.summaries(store, batch) if batch else []):
+                if summary is None:
+                    stale.append(cnc_id)
+                else:
+                    cncs.append((score, summary))
+
+        return cncs, stale
+
+    @classmethod
+    def list(cls):
+        """
+        Returns a page of tasks, newest first, filtered by status and forge,
+        with a cursor for the next page if there's more, status and links
+        coming from each status hash
+        """
+
+        store = flask.current_app.redis
+        args = flask.request.args
+
+        try:
+            limit = min(max(int(args.get("limit", 20)), 1), 100)
+        except ValueError:
+            return {"message": "limit must be an integer"}, 400
+
+        try:
+            cursor = cls.cursor(args)
+        except ValueError:
+            return {"message": f"invalid cursor '{args['cursor']}'"}, 400
+
+        key, _ = cls.indexed(store, args)
+
+        cncs, stale = cls.scan(store, key, cursor, limit)
+
+        if stale:
+            cls.prune(store, stale)
+
+        response = {"cncs": [summary for _, summary in cncs[:limit]]}
+
+        if len(cncs) > limit:
+            response["cursor"] = f"{cncs[limit - 1][0]}:{cncs[limit - 1][1]['id']}"
+
+        return response
+
+    @classmethod
+    def load(cls, id):
+        """
+        Loads a whole CnC, with the latest from its status hash, or None
+        """
+
+        store = flask.current_app.redis
+
+        cnc = store.get(f"/cnc/{id}")
 
         if not cnc:
-            return {"message": f"cnc '{id}' not found"}, 404
+            return None
 
         cnc = json.loads(cnc)
+        cnc.update(cls.unstate(HOT, store.hmget(f"{STATUS}/{id}", HOT)))
+
+        return cnc
+
+    @classmethod
+    def retrieve(cls, id):
+        """
+        Return a single task, only the fields asked for, and yaml if asked
+        """
+
+        fields = [field for field in flask.request.args.get("fields", "").split(",") if field]
 
-        return {"cnc": cnc, "yaml": yaml.safe_dump(cnc, default_flow_style=False)}
+        # If it's all just hot fields, the status hash is all we need
+
+        if fields and all(field in HOT for field in fields):
+
+            state = cls.unstate(fields, flask.current_app.redis.hmget(f"{STATUS}/{id}", fields))
+
+            if state:
+                return {"cnc": {"id": id, **state}}
+
+        cnc = cls.load(id)
+
+        if cnc is None:
+            return {"message": f"cnc '{id}' not found"}, 404
+
+        if not fields:
+            return {"cnc": cnc, "yaml": yaml.safe_dump(cnc, default_flow_style=False)}
+
+        response = {"cnc": {field: cnc[field] for field in ["id"] + fields if field in cnc}}
+
+        if "yaml" in fields:
+            response["yaml"] = yaml.safe_dump(cnc, default_flow_style=False)
+
+        return response
 
     def get(self, id=None):
         """
@@ -429,24 +1569,28 @@ class CnC(flask_restful.Resource):
         PATCH method handling (just retries)
         """
 
-        retrieved = self.retrieve(id)
+        cnc = self.load(id)
 
-        if "cnc" not in retrieved:
-            return retrieved
+        if cnc is None:
+            return {"message": f"cnc '{id}' not found"}, 404
 
         if flask.request.data and "yaml" in (flask.request.json or {}):
             cnc = yaml.safe_load(flask.request.json["yaml"])
-        else:
-            cnc = retrieved["cnc"]
 
         cnc["status"] = "Retry"
 
-        for issue in ["error", "traceback", "content", "change", "code"]:
+        for issue in ["error", "traceback", "content", "change", "code", "progress", "requests"]:
             if issue in cnc:
                 del cnc[issue]
 
         if not flask.request.data or (flask.request.json or {}).get("save", True):
-            flask.current_app.redis.set(f"/cnc/{id}", json.dumps(cnc), ex=86400)
+            pipeline = flask.current_app.redis.pipeline()
+            self.store(pipeline, {**cnc, "id": id})
+            pipeline.execute()
+
+            self.sweep(flask.current_app.redis)
+
+            flask.current_app.redis.lpush(QUEUE, id)
 
         return {"cnc": cnc, "yaml": yaml.safe_dump(cnc, default_flow_style=False)}, 201
 
@@ -455,11 +1599,15 @@ class CnC(flask_restful.Resource):
         PATCH method handling (just retries)
         """
 
-        retrieved = self.retrieve(id)
+        cnc = self.load(id)
 
-        if "cnc" not in retrieved:
-            return retrieved
+        if cnc is None:
+            return {"message": f"cnc '{id}' not found"}, 404
 
-        flask.current_app.redis.delete(f"/cnc/{id}")
+        pipeline = flask.current_app.redis.pipeline()
+        pipeline.delete(f"/cnc/{id}")
+        pipeline.delete(f"{STATUS}/{id}")
+        self.unindex(pipeline, {**cnc, "id": id})
+        pipeline.execute()
 
         return {"deleted": 1}, 201
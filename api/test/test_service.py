@@ -2,10 +2,16 @@ import unittest
 import unittest.mock
 import freezegun
 
+import os
+import copy
 import json
 import fnmatch
+import tempfile
+import threading
 
 import yaml
+import requests
+import jinja2
 import flask_restful
 
 import opengui
@@ -50,6 +56,10 @@ class MockRedis:
             if fnmatch.fnmatch(key, pattern):
                 yield key
 
+    def exists(self, key):
+
+        return int(key in self.data)
+
     def delete(self, key):
 
         if key in self.data:
@@ -58,12 +68,182 @@ class MockRedis:
         if key in self.expires:
             del self.expires[key]
 
+    def expire(self, key, seconds):
+
+        self.expires[key] = seconds
+
+    def scan_iter(self, pattern):
+
+        return self.keys(pattern)
+
+    def sadd(self, key, *members):
+
+        self.data.setdefault(key, set())
+        self.data[key].update(members)
+
+    def smembers(self, key):
+
+        return set(self.data.get(key, set()))
+
+    def mget(self, keys):
+
+        return [self.data.get(key) for key in keys]
+
+    def hset(self, key, field=None, value=None, mapping=None):
+
+        self.data.setdefault(key, {})
+
+        if field is not None:
+            self.data[key][field] = value
+
+        self.data[key].update(mapping or {})
+
+    def hgetall(self, key):
+
+        return dict(self.data.get(key, {}))
+
+    def hmget(self, key, fields):
+
+        return [self.data.get(key, {}).get(field) for field in fields]
+
+    def zadd(self, key, mapping):
+
+        self.data.setdefault(key, {})
+        self.data[key].update(mapping)
+
+    def zrem(self, key, *members):
+
+        for member in members:
+            self.data.get(key, {}).pop(member, None)
+
+    def zinterstore(self, destination, keys, aggregate=None):
+
+        members = set(self.data.get(keys[0], {}))
+
+        for key in keys[1:]:
+            members &= set(self.data.get(key, {}))
+
+        self.data[destination] = {member: max(self.data[key][member] for key in keys) for member in members}
+
+    def zrangebyscore(self, key, min, max, start=None, num=None):
+
+        min = float(min)
+        max = float(max)
+
+        members = sorted(
+            [(member, float(score)) for member, score in self.data.get(key, {}).items() if min <= score <= max],
+            key=lambda pair: (pair[1], pair[0])
+        )
+
+        if start is not None:
+            members = members[start:start + num]
+
+        return [member for member, _ in members]
+
+    def zrevrangebyscore(self, key, max, min, start=None, num=None, withscores=False):
+
+        max = float(max)
+        min = float(min)
+
+        members = sorted(
+            [(member, float(score)) for member, score in self.data.get(key, {}).items() if min <= score <= max],
+            key=lambda pair: (pair[1], pair[0]),
+            reverse=True
+        )
+
+        if start is not None:
+            members = members[start:start + num]
+
+        return members if withscores else [member for member, _ in members]
+
+    def pipeline(self):
+
+        return MockPipeline(self)
+
+
+class MockPipeline:
+
+    def __init__(self, redis):
+
+        self.redis = redis
+        self.results = []
+
+    def __getattr__(self, name):
+
+        def call(*args, **kwargs):
+            self.results.append(getattr(self.redis, name)(*args, **kwargs))
+
+        return call
+
+    def execute(self):
+
+        results, self.results = self.results, []
+
+        return results
+
+
+class TestEnvironment(unittest.TestCase):
+
+    def test___init__(self):
+
+        env = service.Environment(size=2, keep_trailing_newline=True)
+
+        self.assertEqual(env.size, 2)
+        self.assertEqual(env.compiled, {})
+        self.assertTrue(env.keep_trailing_newline)
+
+    def test_from_string(self):
+
+        env = service.Environment(size=2)
+        env.compile = unittest.mock.MagicMock(side_effect=jinja2.Environment().compile)
+
+        self.assertEqual(env.from_string("{{ a }}").render(a=1), "1")
+        self.assertEqual(env.from_string("{{ a }}").render(a=2), "2")
+
+        self.assertEqual(env.compile.call_count, 1)
+        self.assertEqual((env.hits, env.misses), (1, 1))
+
+        # least recently used goes
+
+        env.from_string("{{ b }}")
+        env.from_string("{{ a }}")
+        env.from_string("{{ c }}")
+
+        self.assertEqual(len(env.compiled), 2)
+
+        env.from_string("{{ a }}")
+        env.from_string("{{ b }}")
+
+        self.assertEqual(env.compile.call_count, 4)
+
+        # globals still work
+
+        self.assertEqual(env.from_string("{{ a }}", globals={"a": 3}).render(), "3")
+
 
 class TestOptions(unittest.TestCase):
 
     maxDiff = None
 
+    def setUp(self):
+
+        service.Options.cache.clear()
+        service.Options.refreshing.clear()
+        service.Options.sessions.clear()
+
     @unittest.mock.patch.dict(service.Options.creds, {})
+    @unittest.mock.patch.dict(os.environ, {
+        "OPTIONS_TTL": "7",
+        "OPTIONS_STALE": "11",
+        "OPTIONS_CACHE": "13",
+        "OPTIONS_SHARE": "true",
+        "OPTIONS_TIMEOUT": "2.5"
+    })
+    @unittest.mock.patch("service.Options.ttl", 60)
+    @unittest.mock.patch("service.Options.stale", 300)
+    @unittest.mock.patch("service.Options.size", 1024)
+    @unittest.mock.patch("service.Options.redis", None)
+    @unittest.mock.patch("service.Options.timeout", 10)
     @unittest.mock.patch("glob.glob")
     @unittest.mock.patch('service.open', create=True)
     def test_config(self, mock_open, mock_glob):
@@ -74,7 +254,7 @@ class TestOptions(unittest.TestCase):
             unittest.mock.mock_open(read_data='{"stuff": "things"}').return_value
         ]
 
-        service.Options.config()
+        service.Options.config("redis")
 
         self.assertEqual(service.Options.creds, {
             "people": {
@@ -83,6 +263,12 @@ class TestOptions(unittest.TestCase):
             }
         })
 
+        self.assertEqual(service.Options.ttl, 7)
+        self.assertEqual(service.Options.stale, 11)
+        self.assertEqual(service.Options.size, 13)
+        self.assertEqual(service.Options.redis, "redis")
+        self.assertEqual(service.Options.timeout, 2.5)
+
     @unittest.mock.patch.dict(service.Options.creds, {
         "default": {
             "url": "arcade",
@@ -95,6 +281,7 @@ class TestOptions(unittest.TestCase):
 
             options = service.Options({})
 
+            self.assertEqual(options.name, "default")
             self.assertEqual(options.url, "arcade")
             self.assertEqual(options.verify, True)
             self.assertEqual(options.method, "GET")
@@ -123,7 +310,10 @@ class TestOptions(unittest.TestCase):
                 },
                 "results": "people",
                 "option": "stuff",
-                "title": "things"
+                "title": "things",
+                "ttl": 7,
+                "stale": 11,
+                "timeout": 3
             }
 
             data = {
@@ -132,6 +322,11 @@ class TestOptions(unittest.TestCase):
 
             options = service.Options(data)
 
+            self.assertEqual(options.name, "credible")
+            self.assertEqual(options.ttl, 7)
+            self.assertEqual(options.stale, 11)
+            self.assertEqual(options.timeout, 3)
+
             self.assertEqual(options.url, "fire")
             self.assertEqual(options.verify, False)
             self.assertEqual(options.method, "POST")
@@ -142,7 +337,9 @@ class TestOptions(unittest.TestCase):
             self.assertEqual(options.option, "stuff")
             self.assertEqual(options.title, "things")
 
-            self.assertEqual(options.session.headers["yes"], "sah")
+            self.assertEqual(options.headers, {"yes": "sah"})
+            self.assertIsNone(options.auth)
+            self.assertEqual(options.session, service.Options.sessions[("credible", "fire")])
 
             # data
 
@@ -166,9 +363,363 @@ class TestOptions(unittest.TestCase):
             self.assertEqual(options.option, "stuff")
             self.assertEqual(options.title, "things")
 
-            self.assertEqual(options.session.headers["yes"], "sah")
-            self.assertEqual(options.session.auth, ("me", "sh"))
-            self.assertEqual(options.session.headers["Authorization"], "Bearer ring")
+            self.assertEqual(options.headers, {"yes": "sah", "Authorization": "Bearer ring"})
+            self.assertEqual(options.auth, ("me", "sh"))
+            self.assertEqual(options.session, service.Options.sessions[("credible", "disco")])
+
+    def test_pooled(self):
+
+        session = service.Options.pooled("creds", "http://api", 4, 2, 0.1)
+
+        self.assertEqual(service.Options.pooled("creds", "http://api", 4, 2, 0.1), session)
+        self.assertNotEqual(service.Options.pooled("creds", "http://other", 4, 2, 0.1), session)
+        self.assertNotEqual(service.Options.pooled("other", "http://api", 4, 2, 0.1), session)
+
+        adapter = session.get_adapter("https://api")
+
+        self.assertEqual(session.get_adapter("http://api"), adapter)
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertEqual(adapter.max_retries.backoff_factor, 0.1)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+
+    def test_stats(self):
+
+        session = service.Options.pooled("creds", "http://api", 4, 2, 0.1)
+
+        pool = session.get_adapter("http://api").poolmanager.connection_from_url("http://api")
+        pool.num_requests = 5
+        pool.num_connections = 2
+
+        self.assertEqual(service.Options.stats(), {
+            "creds http://api": {
+                "requests": 5,
+                "connections": 2,
+                "reused": 3
+            }
+        })
+
+    def test_key(self):
+
+        options = service.Options({"url": "arcade"})
+
+        self.assertEqual(options.key(), service.Options({"url": "arcade"}).key())
+        self.assertNotEqual(options.key(), service.Options({"url": "arcade", "params": {"a": 1}}).key())
+        self.assertNotEqual(options.key(), service.Options({"url": "arcade", "creds": "other"}).key())
+        self.assertEqual(options.key(), service.Options({"url": "arcade", "results": "other"}).key())
+
+    def test_request(self):
+
+        options = service.Options({"url": "arcade", "path": "disco", "params": {"a": 1}})
+        options.session = unittest.mock.MagicMock()
+        options.session.request.return_value.json.return_value = [1, 2, 3]
+
+        self.assertEqual(options.request(), [1, 2, 3])
+
+        options.session.request.assert_called_once_with(
+            "GET",
+            "arcade/disco",
+            verify=True,
+            params={"a": 1},
+            json={},
+            auth=None,
+            headers={},
+            timeout=10
+        )
+        options.session.request.return_value.raise_for_status.assert_called_once_with()
+
+        # error
+
+        options.session.request.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError("404 Client Error")
+
+        self.assertRaisesRegex(requests.exceptions.HTTPError, "404 Client Error", options.request)
+
+    @unittest.mock.patch("service.Options.size", 2)
+    def test_remember(self):
+
+        options = service.Options({"url": "arcade"})
+
+        options.remember("a", 1, [1])
+        options.remember("b", 2, [2])
+        options.lookup("a")
+        options.remember("c", 3, [3])
+
+        self.assertEqual(list(service.Options.cache.items()), [
+            ("a", (1, [1])),
+            ("c", (3, [3]))
+        ])
+
+    @unittest.mock.patch("service.Options.redis", None)
+    def test_lookup(self):
+
+        options = service.Options({"url": "arcade"})
+
+        self.assertIsNone(options.lookup("a"))
+
+        options.remember("a", 1, [1])
+
+        self.assertEqual(options.lookup("a"), (1, [1]))
+
+        # shared
+
+        options.redis = MockRedis("redis.cnc-forge")
+
+        self.assertIsNone(options.lookup("b"))
+
+        options.redis.set("/options/b", json.dumps({"stored": 2, "results": [2]}))
+
+        self.assertEqual(options.lookup("b"), (2, [2]))
+        self.assertEqual(service.Options.cache["b"], (2, [2]))
+
+    @unittest.mock.patch("service.time.time")
+    def test_store(self, mock_time):
+
+        mock_time.return_value = 3
+
+        options = service.Options({"url": "arcade", "ttl": 7, "stale": 11})
+
+        options.store("a", [1])
+
+        self.assertEqual(service.Options.cache["a"], (3, [1]))
+
+        options.redis = MockRedis("redis.cnc-forge")
+
+        options.store("b", [2])
+
+        self.assertEqual(json.loads(options.redis.data["/options/b"]), {"stored": 3, "results": [2]})
+        self.assertEqual(options.redis.expires["/options/b"], 18)
+
+    def test_fetch(self):
+
+        options = service.Options({"url": "arcade"})
+        options.request = unittest.mock.MagicMock(return_value=[1])
+        options.store = unittest.mock.MagicMock()
+
+        self.assertEqual(options.fetch("a"), [1])
+
+        options.store.assert_called_once_with("a", [1])
+
+        # error
+
+        options.request.side_effect = Exception("whoops")
+
+        self.assertRaisesRegex(Exception, "whoops", options.fetch, "b")
+
+        options.store.assert_called_once_with("a", [1])
+
+    @unittest.mock.patch("service.threading.Thread")
+    @unittest.mock.patch("builtins.print")
+    def test_revalidate(self, mock_print, mock_thread):
+
+        options = service.Options({"url": "arcade"})
+        options.fetch = unittest.mock.MagicMock()
+        options.remember("a", 1, [1])
+
+        options.revalidate("a")
+        options.revalidate("a")
+
+        mock_thread.assert_called_once()
+        mock_thread.return_value.start.assert_called_once_with()
+
+        self.assertEqual(service.Options.refreshing, {"a"})
+
+        mock_thread.call_args.kwargs["target"]()
+
+        options.fetch.assert_called_once_with("a")
+        self.assertEqual(service.Options.refreshing, set())
+
+        # failure
+
+        del options.fetch
+        options.request = unittest.mock.MagicMock(side_effect=Exception("whoops"))
+
+        options.revalidate("a")
+
+        mock_thread.call_args.kwargs["target"]()
+
+        mock_print.assert_called_once_with("options refresh failed: whoops")
+        self.assertEqual(service.Options.refreshing, set())
+        self.assertEqual(service.Options.cache["a"], (1, [1]))
+
+    @unittest.mock.patch("service.time.time")
+    def test_cached(self, mock_time):
+
+        options = service.Options({"url": "arcade", "ttl": 10, "stale": 20})
+        options.request = unittest.mock.MagicMock(return_value=[1])
+        options.revalidate = unittest.mock.MagicMock()
+
+        key = options.key()
+
+        # miss
+
+        mock_time.return_value = 100
+
+        self.assertEqual(options.cached(), [1])
+        self.assertEqual(options.request.call_count, 1)
+
+        # fresh
+
+        mock_time.return_value = 109
+
+        self.assertEqual(options.cached(), [1])
+        self.assertEqual(options.request.call_count, 1)
+        options.revalidate.assert_not_called()
+
+        # stale
+
+        options.request.return_value = [2]
+        mock_time.return_value = 129
+
+        self.assertEqual(options.cached(), [1])
+        self.assertEqual(options.request.call_count, 1)
+        options.revalidate.assert_called_once_with(key)
+
+        # expired
+
+        mock_time.return_value = 130
+
+        self.assertEqual(options.cached(), [2])
+        self.assertEqual(options.request.call_count, 2)
+
+        # off
+
+        options.ttl = 0
+
+        self.assertEqual(options.cached(), [2])
+        self.assertEqual(options.request.call_count, 3)
+
+    def test_find(self):
+
+        # upstream
+
+        options = service.Options({"url": "arcade", "search": "q", "limit": 2, "ttl": 0})
+        options.request = unittest.mock.MagicMock(return_value=["apple", "apricot", "avocado"])
+
+        extra = {}
+
+        options.find("ap", 1, extra)
+
+        self.assertEqual(options.params, {"q": "ap"})
+        self.assertEqual(extra, {
+            "options": ["apple", "apricot"],
+            "page": 1,
+            "more": True
+        })
+
+        extra = {}
+
+        options.find("ap", 2, extra)
+
+        self.assertEqual(extra, {
+            "options": ["avocado"],
+            "page": 2,
+            "more": False
+        })
+
+        # no filter, nothing sent
+
+        options = service.Options({"url": "arcade", "search": "q", "ttl": 0})
+        options.request = unittest.mock.MagicMock(return_value=["apple"])
+
+        extra = {}
+
+        options.find("", 1, extra)
+
+        self.assertEqual(options.params, {})
+        self.assertEqual(extra, {"options": ["apple"], "page": 1, "more": False})
+
+        # local
+
+        options = service.Options({"url": "arcade", "search": True, "option": "id", "title": "name", "ttl": 0})
+        options.request = unittest.mock.MagicMock(return_value=[
+            {"id": 1, "name": "Apple"},
+            {"id": 2, "name": "Pear"},
+            {"id": 3, "name": "Pineapple"}
+        ])
+
+        extra = {}
+
+        options.find("APPLE", 1, extra)
+
+        self.assertEqual(options.params, {})
+        self.assertEqual(extra, {
+            "options": [1, 3],
+            "titles": {1: "Apple", 3: "Pineapple"},
+            "page": 1,
+            "more": False
+        })
+
+    def test_check(self):
+
+        # upstream
+
+        options = service.Options({"url": "arcade", "search": "q", "ttl": 0})
+        options.request = unittest.mock.MagicMock(side_effect=[["apple", "pineapple"], ["pear"]])
+
+        extra = {}
+
+        options.check(["apple", "plum"], extra)
+
+        self.assertEqual(options.request.call_count, 2)
+        self.assertEqual(options.params, {"q": "plum"})
+        self.assertEqual(extra, {"options": ["apple"]})
+
+        # single
+
+        options.request = unittest.mock.MagicMock(return_value=["apple"])
+
+        extra = {}
+
+        options.check("apple", extra)
+
+        self.assertEqual(options.params, {"q": "apple"})
+        self.assertEqual(extra, {"options": ["apple"]})
+
+        # none
+
+        options.request = unittest.mock.MagicMock()
+
+        extra = {}
+
+        options.check(None, extra)
+
+        options.request.assert_not_called()
+        self.assertEqual(extra, {"options": []})
+
+        # local
+
+        options = service.Options({"url": "arcade", "search": True, "option": "id", "title": "name", "ttl": 0})
+        options.request = unittest.mock.MagicMock(return_value=[
+            {"id": 1, "name": "Apple"},
+            {"id": 2, "name": "Pear"},
+            {"id": 3, "name": "Pineapple"}
+        ])
+
+        extra = {}
+
+        options.check([3, 4], extra)
+
+        options.request.assert_called_once_with()
+        self.assertEqual(options.params, {})
+        self.assertEqual(extra, {"options": [3], "titles": {3: "Pineapple"}})
+
+    def test_fallback(self):
+
+        options = service.Options({"url": "arcade", "results": "numbers", "title": "name", "option": "id"})
+
+        extra = {}
+
+        options.fallback(extra)
+
+        self.assertEqual(extra, {"options": [], "titles": {}})
+
+        options.remember(options.key(), 1, {"numbers": [{"id": 1, "name": "one"}]})
+
+        extra = {}
+
+        options.fallback(extra)
+
+        self.assertEqual(extra, {"options": [1], "titles": {1: "one"}})
 
     @unittest.mock.patch.dict(service.Options.creds, {
         "default": {
@@ -176,6 +727,7 @@ class TestOptions(unittest.TestCase):
             "verify": True
         }
     })
+    @unittest.mock.patch("service.Options.ttl", 0)
     def test_retrieve(self):
 
         # basic
@@ -199,7 +751,10 @@ class TestOptions(unittest.TestCase):
             "arcade",
             verify=True,
             params={},
-            json={}
+            json={},
+            auth=None,
+            headers={},
+            timeout=10
         )
 
         # lookups
@@ -252,7 +807,10 @@ class TestOptions(unittest.TestCase):
             "arcade/disco",
             verify=True,
             params={"a": 1},
-            json={"b": 2}
+            json={"b": 2},
+            auth=None,
+            headers={},
+            timeout=10
         )
 
         # overscore
@@ -319,7 +877,10 @@ class TestOptions(unittest.TestCase):
             "arcade/disco",
             verify=True,
             params={"a": 1},
-            json={"b": 2}
+            json={"b": 2},
+            auth=None,
+            headers={},
+            timeout=10
         )
 
 class TestRestful(unittest.TestCase):
@@ -413,86 +974,236 @@ class TestHealth(TestRestful):
 
     def test_get(self):
 
+        self.app.redis = unittest.mock.MagicMock()
+
         self.assertStatusValue(self.api.get("/health"), 200, "message", "OK")
+        self.assertStatusValue(self.api.get("/health"), 200, "options", service.Options.stats())
 
+        self.assertEqual(self.app.redis.mock_calls, [])
 
-class TestForge(TestRestful):
 
-    @unittest.mock.patch('service.glob.glob')
-    @unittest.mock.patch('service.open', create=True)
-    def test_forges(self, mock_open, mock_glob):
-
-        mock_glob.side_effect = [
-            [
-                "/opt/service/forge/there.yaml",
-                "/opt/service/forge/here.yaml",
-                "/opt/service/forge/fields.yaml",
-                "/opt/service/forge/values.yaml"
-            ],
-            [
-                "/opt/service/repo/my/stuff/forge/every.yaml",
-            ]
-        ]
+class TestGitHub(TestRestful):
 
-        mock_open.side_effect = [
-            unittest.mock.mock_open(read_data='description: Here').return_value,
-            unittest.mock.mock_open(read_data='description: There').return_value,
-            unittest.mock.mock_open(read_data='description: Every').return_value
-        ]
+    def test_get(self):
 
-        self.assertEqual(service.Forge.forges(), {
-            "every": "Every",
-            "here": "Here",
-            "there": "There"
+        self.assertStatusValue(self.api.get("/github"), 200, "budgets", {})
+        self.assertStatusValue(self.api.get("/github"), 200, "latency", {})
+
+        self.app.redis.sadd("/github/creds", "default", "expired")
+        self.app.redis.hset("/github/budget/default", mapping={"remaining": "4999", "reset": "1604275200"})
+        self.app.redis.hset("/github/latency/default", mapping={"GET 0.25": "3", "GET sum": "0.5"})
+
+        self.assertStatusValue(self.api.get("/github"), 200, "budgets", {
+            "default": {
+                "remaining": 4999,
+                "reset": 1604275200
+            }
         })
 
+        self.assertStatusValue(self.api.get("/github"), 200, "latency", {
+            "default": {
+                "GET 0.25": 3,
+                "GET sum": 0.5
+            }
+        })
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.catalog = service.Catalog()
+
+    def tearDown(self):
+
+        self.directory.cleanup()
+
+    def write(self, name, data):
+
+        path = f"{self.directory.name}/{name}"
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "w") as forge_file:
+            forge_file.write(data)
+
+        return path
+
+    def test___init__(self):
+
+        catalog = service.Catalog(7)
+
+        self.assertEqual(catalog.interval, 7)
+        self.assertIsNone(catalog.checked)
+        self.assertEqual(catalog.files, {})
+        self.assertEqual(catalog.index, {})
+        self.assertEqual(catalog.descriptions, {})
+
+    def test_stamp(self):
+
+        path = self.write("here.yaml", "description: Here")
+
+        stat = os.stat(path)
+
+        self.assertEqual(self.catalog.stamp(path), (stat.st_ino, stat.st_mtime_ns, stat.st_size))
+
+    @unittest.mock.patch("service.time.time")
+    def test_stale(self, mock_time):
+
+        self.assertTrue(self.catalog.stale())
+
+        self.catalog.interval = 5
+        self.catalog.checked = 10
+
+        mock_time.return_value = 14
+        self.assertFalse(self.catalog.stale())
+
+        mock_time.return_value = 15
+        self.assertTrue(self.catalog.stale())
+
+    @unittest.mock.patch("service.glob.glob")
+    def test_refresh(self, mock_glob):
+
+        here = self.write("forge/here.yaml", "description: Here")
+        there = self.write("forge/there.yaml", "description: There")
+        fields = self.write("forge/fields.yaml", "fields: []")
+        every = self.write("repo/my/stuff/forge/every.yaml", "description: Every")
+        override = self.write("repo/my/stuff/forge/here.yaml", "description: Over")
+
+        def glob(pattern):
+
+            if pattern == "/opt/service/forge/*.yaml":
+                return [there, here, fields, f"{self.directory.name}/forge/gone.yaml"]
+
+            return [every, override]
+
+        mock_glob.side_effect = glob
+
+        self.catalog.refresh()
+
         mock_glob.assert_has_calls([
             unittest.mock.call("/opt/service/forge/*.yaml"),
             unittest.mock.call("/opt/service/repo/*/*/forge/*.yaml")
         ])
 
-        mock_open.assert_has_calls([
-            unittest.mock.call("/opt/service/forge/here.yaml", "r"),
-            unittest.mock.call("/opt/service/forge/there.yaml", "r"),
-            unittest.mock.call("/opt/service/repo/my/stuff/forge/every.yaml", "r")
-        ])
+        self.assertEqual(sorted(self.catalog.files.keys()), sorted([here, there, every, override]))
+        self.assertEqual(self.catalog.index, {
+            "every": {"description": "Every"},
+            "here": {"description": "Over"},
+            "there": {"description": "There"}
+        })
+        self.assertEqual(self.catalog.descriptions, {
+            "every": "Every",
+            "here": "Over",
+            "there": "There"
+        })
 
-    @unittest.mock.patch('service.glob.glob')
-    @unittest.mock.patch('service.open', create=True)
-    def test_forge(self, mock_open, mock_glob):
+        # not stale, not checked
 
-        mock_glob.retrurn_value = []
+        self.catalog.interval = 60
 
-        mock_open.side_effect = [
-            unittest.mock.mock_open(read_data='description: Here').return_value
-        ]
+        self.catalog.refresh()
+
+        self.assertEqual(mock_glob.call_count, 2)
+
+        # only changed files parsed
+
+        self.catalog.checked = None
+
+        self.write("forge/there.yaml", "description: Changed")
+
+        with unittest.mock.patch("service.open", create=True, side_effect=open) as mock_open:
+            self.catalog.refresh()
+
+        mock_open.assert_called_once_with(there, "r")
+        self.assertEqual(self.catalog.descriptions["there"], "Changed")
+
+        # removed
+
+        self.catalog.checked = None
+
+        os.remove(override)
+        mock_glob.side_effect = [[here, there], []]
+
+        self.catalog.refresh()
+
+        self.assertEqual(self.catalog.descriptions, {
+            "here": "Here",
+            "there": "Changed"
+        })
+
+    def test_forges(self):
+
+        self.catalog.refresh = unittest.mock.MagicMock()
+        self.catalog.descriptions = {"here": "Here"}
+
+        forges = self.catalog.forges()
+
+        self.assertEqual(forges, {"here": "Here"})
+        self.catalog.refresh.assert_called_once_with()
+
+        forges["there"] = "There"
+
+        self.assertEqual(self.catalog.descriptions, {"here": "Here"})
+
+    def test_forge(self):
+
+        self.catalog.refresh = unittest.mock.MagicMock()
+        self.catalog.index = {"here": {"description": "Here"}}
+
+        self.assertIsNone(self.catalog.forge("there"))
+
+        forge = self.catalog.forge("here")
+
+        self.assertEqual(forge, {"description": "Here"})
+        self.catalog.refresh.assert_called_with()
+
+        forge["id"] = "here"
+
+        self.assertEqual(self.catalog.index, {"here": {"description": "Here"}})
+
+
+class TestForge(TestRestful):
+
+    def setUp(self):
+
+        super().setUp()
+
+        service.Forge.catalog = unittest.mock.MagicMock()
+        service.Forge.catalog.forges.return_value = {
+            "there": "There",
+            "here": "Here"
+        }
+        service.Forge.catalog.forge.side_effect = lambda id: {"description": "Here"} if id == "here" else None
+
+    @unittest.mock.patch.dict(os.environ, {
+        "REFRESH": "7"
+    })
+    def test_config(self):
+
+        service.Forge.config()
+
+        self.assertIsInstance(service.Forge.catalog, service.Catalog)
+        self.assertEqual(service.Forge.catalog.interval, 7)
+
+    def test_forges(self):
+
+        self.assertEqual(service.Forge.forges(), {
+            "here": "Here",
+            "there": "There"
+        })
+
+    def test_forge(self):
 
         self.assertEqual(service.Forge.forge("here"), {
             "id": "here",
             "description": "Here"
         })
 
-        mock_open.assert_has_calls([
-            unittest.mock.call("/opt/service/forge/here.yaml", "r")
-        ])
+        self.assertIsNone(service.Forge.forge("there"))
 
-    @unittest.mock.patch('service.glob.glob')
-    @unittest.mock.patch('service.open', create=True)
-    def test_list(self, mock_open, mock_glob):
-
-        mock_glob.side_effect = [
-            [
-                "/opt/service/forge/there.yaml",
-                "/opt/service/forge/here.yaml"
-            ],
-            []
-        ]
-
-        mock_open.side_effect = [
-            unittest.mock.mock_open(read_data='description: Here').return_value,
-            unittest.mock.mock_open(read_data='description: There').return_value,
-            unittest.mock.mock_open(read_data='description: Here').return_value
-        ]
+    def test_list(self):
 
         self.assertEqual(service.Forge.list(), {
             "forges": [
@@ -507,30 +1218,7 @@ class TestForge(TestRestful):
             ]
         })
 
-    @unittest.mock.patch('service.glob.glob')
-    @unittest.mock.patch('service.open', create=True)
-    def test_retrieve(self, mock_open, mock_glob):
-
-        mock_glob.side_effect = [
-            [
-                "/opt/service/forge/here.yaml",
-            ],
-            [],
-            [
-                "/opt/service/forge/here.yaml",
-            ],
-            [],
-            [
-                "/opt/service/forge/here.yaml",
-            ],
-            []
-        ]
-
-        mock_open.side_effect = [
-            unittest.mock.mock_open(read_data='description: Here').return_value,
-            unittest.mock.mock_open(read_data='description: Here').return_value,
-            unittest.mock.mock_open(read_data='description: Here').return_value
-        ]
+    def test_retrieve(self):
 
         self.assertEqual(service.Forge.retrieve("here"), {
             "forge": {
@@ -544,35 +1232,7 @@ class TestForge(TestRestful):
             "message": "forge 'there' not found"
         }, 404))
 
-    @unittest.mock.patch('service.glob.glob')
-    @unittest.mock.patch('service.open', create=True)
-    def test_get(self, mock_open, mock_glob):
-
-        mock_glob.side_effect = [
-            [
-                "/opt/service/forge/there.yaml",
-                "/opt/service/forge/here.yaml"
-            ],
-            [],
-            [
-                "/opt/service/forge/there.yaml",
-                "/opt/service/forge/here.yaml"
-            ],
-            [],
-            [
-                "/opt/service/forge/there.yaml",
-                "/opt/service/forge/here.yaml"
-            ],
-            []
-        ]
-
-        mock_open.side_effect = [
-            unittest.mock.mock_open(read_data='description: Here').return_value,
-            unittest.mock.mock_open(read_data='description: There').return_value,
-            unittest.mock.mock_open(read_data='description: Here').return_value,
-            unittest.mock.mock_open(read_data='description: There').return_value,
-            unittest.mock.mock_open(read_data='description: Here').return_value
-        ]
+    def test_get(self):
 
         self.assertStatusValue(self.api.get("/forge"), 200, "forges", [
             {
@@ -595,19 +1255,165 @@ class TestForge(TestRestful):
         self.assertStatusValue(response, 200, "yaml", "description: Here\nid: here\n")
 
 
+class TestField(TestRestful):
+
+    @unittest.mock.patch("service.Forge.forge")
+    @unittest.mock.patch("service.CnC.search")
+    def test_post(self, mock_search, mock_forge):
+
+        mock_forge.return_value = None
+
+        self.assertStatusValue(self.api.post("/forge/nope/field/fruit/options"), 404, "message", "forge 'nope' not found")
+
+        mock_forge.return_value = {"id": "here"}
+
+        self.assertStatusValue(self.api.post("/forge/here/field/fruit/options", json={"page": 0}), 400, "message", "page must be a positive integer")
+        self.assertStatusValue(self.api.post("/forge/here/field/fruit/options", json={"page": "nope"}), 400, "message", "page must be a positive integer")
+
+        mock_search.return_value = None
+
+        self.assertStatusValue(self.api.post("/forge/here/field/fruit/options", json={}), 404, "message", "field 'fruit' has no remote options")
+
+        mock_search.assert_called_once_with({"id": "here"}, {}, "fruit", "", 1)
+
+        mock_search.return_value = {"options": ["pear"], "page": 2, "more": False}
+
+        response = self.api.post("/forge/here/field/fruit/options", json={
+            "values": {"where": "market"},
+            "filter": "pe",
+            "page": 2
+        })
+
+        self.assertEqual(response.status_code, 200, response.json)
+        self.assertEqual(response.json, {"options": ["pear"], "page": 2, "more": False})
+
+        mock_search.assert_called_with({"id": "here"}, {"where": "market"}, "fruit", "pe", 2)
+
+
 class TestCnC(TestRestful):
 
+    @unittest.mock.patch.dict(os.environ, {
+        "OPTIONS_WORKERS": "3"
+    })
+    def test_config(self):
+
+        service.CnC.config()
+
+        self.assertEqual(service.CnC.pool._max_workers, 3)
+
     def test___init__(self):
 
         cnc = service.CnC()
 
         self.assertIn("port", cnc.engine.env.globals)
+        self.assertIsNone(cnc.fetching)
+        self.assertIs(cnc.engine, service.CnC().engine)
+
+    @unittest.mock.patch.dict(os.environ, {
+        "TEMPLATES": "7"
+    })
+    @unittest.mock.patch("service.CnC.env", None)
+    @unittest.mock.patch("service.CnC.shared", None)
+    def test_environment(self):
+
+        engine = service.CnC.environment()
+
+        self.assertIsInstance(engine.env, service.Environment)
+        self.assertIs(service.CnC.env, engine.env)
+        self.assertEqual(engine.env.size, 7)
+        self.assertTrue(engine.env.keep_trailing_newline)
+        self.assertEqual(engine.transform("{{ port('a-b') }}", {}), "6566")
+
+        self.assertIs(service.CnC.environment(), engine)
 
     def test_port(self):
 
         self.assertEqual(service.CnC.port("a-b"), 6566)
         self.assertEqual(service.CnC.port("ac"), 6567)
 
+    def test_depends(self):
+
+        cnc = service.CnC()
+
+        self.assertEqual(cnc.depends({"name": "plain"}), ({"plain"}, False))
+
+        self.assertEqual(cnc.depends({
+            "name": "fancy",
+            "description": "{{ a }} and {{ b | upper }}",
+            "requires": ["c__d", "e"],
+            "condition": "{? f == 1 ?}",
+            "iterate": {"g": "gs"},
+            "transpose": {"h": "i"},
+            "default": "{[ j__k ]}",
+            "options": {
+                "url": "http://{{ l }}"
+            },
+            "fields": [
+                {
+                    "name": "child",
+                    "default": "{{ m }}"
+                }
+            ]
+        }), ({"fancy", "a", "b", "c", "e", "f", "gs", "i", "j", "l", "child", "m"}, False))
+
+        # dynamic
+
+        self.assertEqual(cnc.depends({"name": "{{ a }}"}), ({"a"}, True))
+        self.assertEqual(cnc.depends({"name": "b", "requires": "{[ c ]}"}), ({"b", "c"}, True))
+        self.assertEqual(cnc.depends({"name": "b", "default": "{[ {{ c }}__d ]}"}), ({"b", "c"}, True))
+        self.assertEqual(cnc.depends({"name": "b", "default": "{{ nope"}), ({"b"}, True))
+
+    def test_graph(self):
+
+        cnc = service.CnC()
+
+        service.CnC.graphs.clear()
+
+        forge = {
+            "input": {
+                "fields": [
+                    {"name": "a"},
+                    {"name": "b", "condition": "{? a ?}"},
+                    {"name": "{{ c }}"}
+                ]
+            }
+        }
+
+        graph = cnc.graph(forge)
+
+        self.assertEqual(graph, {
+            "values": {
+                "a": [0, 1],
+                "b": [1],
+                "c": [2]
+            },
+            "dynamic": [2]
+        })
+
+        cnc.depends = unittest.mock.MagicMock()
+
+        self.assertIs(cnc.graph(copy.deepcopy(forge)), graph)
+        cnc.depends.assert_not_called()
+
+    def test_affected(self):
+
+        cnc = service.CnC()
+
+        forge = {
+            "input": {
+                "fields": [
+                    {"name": "a"},
+                    {"name": "b", "condition": "{? a ?}"},
+                    {"name": "{{ c }}"},
+                    {"name": "d"}
+                ]
+            }
+        }
+
+        self.assertEqual(cnc.affected(forge, ["a"]), {0, 1, 2})
+        self.assertEqual(cnc.affected(forge, ["d", "nope"]), {2, 3})
+        self.assertEqual(cnc.affected(forge, []), {2})
+
     @unittest.mock.patch.dict(service.Options.creds, {
         "default": {
             "url": "arcade",
@@ -637,7 +1443,7 @@ class TestCnC(TestRestful):
             "requires": "some"
         }
 
-        cnc.field(fields, field, {"some": "fun"})
+        self.assertEqual(cnc.field(fields, field, {"some": "fun"}), "happy")
 
         self.assertEqual(len(fields), 1)
         self.assertEqual(fields["happy"].default, "7085 bone")
@@ -717,6 +1523,163 @@ class TestCnC(TestRestful):
         self.assertEqual(fields["deez"][2].name, "t")
         self.assertEqual(fields["deez"][3].name, "s")
 
+        # fetching
+
+        cnc.fetching = []
+
+        field = {
+            "name": "later",
+            "options": {
+                "url": "{{ some }}"
+            }
+        }
+
+        cnc.field(fields, field, {"some": "fun"})
+
+        self.assertEqual(len(cnc.fetching), 1)
+        self.assertEqual(cnc.fetching[0][0], fields)
+        self.assertEqual(cnc.fetching[0][1], "later")
+        self.assertEqual(cnc.fetching[0][2].url, "fun")
+        self.assertEqual(fields["later"].options, {"url": "fun"})
+
+    def test_fetch(self):
+
+        cnc = service.CnC()
+
+        fields = opengui.Fields(fields=[{"name": "slow"}, {"name": "fast"}])
+
+        release = threading.Event()
+
+        slow = service.Options({"url": "slow", "timeout": 0.05})
+        slow.request = unittest.mock.MagicMock(side_effect=lambda: release.wait(5) and ["late"])
+        slow.remember(slow.key(), 0, ["old"])
+
+        fast = service.Options({"url": "fast", "ttl": 0})
+        fast.request = unittest.mock.MagicMock(return_value=[1, 2])
+
+        cnc.fetch([
+            (fields, "slow", slow),
+            (fields, "fast", fast)
+        ])
+
+        release.set()
+
+        self.assertEqual(fields["slow"].options, ["old"])
+        self.assertEqual(fields["fast"].options, [1, 2])
+
+        # concurrent
+
+        fields = opengui.Fields()
+
+        barrier = threading.Barrier(3, timeout=5)
+
+        fetching = []
+
+        for index in range(3):
+            options = service.Options({"url": f"{index}", "ttl": 0})
+            options.request = unittest.mock.MagicMock(side_effect=lambda index=index: barrier.wait() is not None and [index])
+            fetching.append((fields, f"{index}", options))
+
+        cnc.fetch(fetching)
+
+        self.assertEqual([field.name for field in fields], ["0", "1", "2"])
+        self.assertEqual([field.options for field in fields], [[0], [1], [2]])
+
+        # search
+
+        fields = opengui.Fields(values={"one": "a", "many": ["b", "c"]})
+
+        fetching = []
+
+        for name in ["one", "many", "none"]:
+            fields.append({"name": name, "options": {"search": True}})
+            options = service.Options({"url": name, "search": True})
+            options.request = unittest.mock.MagicMock()
+            fetching.append((fields, name, options))
+
+        cnc.fetch(fetching)
+
+        self.assertEqual(fields["one"].options, ["a"])
+        self.assertEqual(fields["many"].options, ["b", "c"])
+        self.assertEqual(fields["none"].options, [])
+        self.assertTrue(fields["one"].content["search"])
+
+        for _, _, options in fetching:
+            options.request.assert_not_called()
+
+        # search checked
+
+        for _, name, options in fetching:
+            options.ttl = 0
+            options.request.return_value = ["a", "c", "d"]
+
+        cnc.fetch(fetching, lazy=False)
+
+        self.assertEqual(fields["one"].options, ["a"])
+        self.assertEqual(fields["many"].options, ["c"])
+        self.assertEqual(fields["none"].options, [])
+
+        self.assertFalse(fields.validate())
+        self.assertEqual(fields["one"].errors, [])
+        self.assertEqual(fields["many"].errors, ["invalid value '['b', 'c']'"])
+
+        # search found nothing
+
+        fields = opengui.Fields(values={"one": "x", "none": None})
+
+        fetching = []
+
+        for name, validation in [("one", "^y"), ("none", None)]:
+            fields.append({"name": name, "validation": validation})
+            options = service.Options({"url": name, "search": "q", "ttl": 0})
+            options.request = unittest.mock.MagicMock(return_value=["a"])
+            fetching.append((fields, name, options))
+
+        cnc.fetch(fetching, lazy=False)
+
+        self.assertEqual(fields["one"].options, [])
+        self.assertFalse(fields.validate())
+        self.assertEqual(fields["one"].errors, ["invalid value 'x'", "must match '^y'"])
+        self.assertEqual(fields["none"].errors, [])
+
+        # defer
+
+        fields = opengui.Fields(values={"one": "a"})
+
+        fetching = []
+
+        for name, defer in [("one", None), ("two", True), ("three", False)]:
+            fields.append({"name": name})
+            options = service.Options({"url": name, "defer": defer, "ttl": 0})
+            options.request = unittest.mock.MagicMock(return_value=[name])
+            fetching.append((fields, name, options))
+
+        cnc.fetch(fetching)
+
+        self.assertEqual(fields["one"].options, ["one"])
+        self.assertEqual(fields["two"].options, [])
+        self.assertTrue(fields["two"].content["defer"])
+        self.assertEqual(fields["three"].options, ["three"])
+
+        cnc.fetch(fetching, defer=True)
+
+        self.assertEqual(fields["one"].options, ["a"])
+        self.assertTrue(fields["one"].content["defer"])
+        self.assertEqual(fields["three"].options, ["three"])
+
+        cnc.fetch(fetching, defer=True, lazy=False)
+
+        self.assertEqual(fields["one"].options, ["one"])
+        self.assertEqual(fields["two"].options, ["two"])
+        self.assertEqual(fields["three"].options, ["three"])
+
+        # errors still raise
+
+        broken = service.Options({"url": "broken", "ttl": 0})
+        broken.request = unittest.mock.MagicMock(side_effect=Exception("whoops"))
+
+        self.assertRaisesRegex(Exception, "whoops", cnc.fetch, [(fields, "broken", broken)])
+
     @unittest.mock.patch('service.os.path.exists')
     @unittest.mock.patch('service.open', create=True)
     def test_fields(self, mock_open, mock_exists):
@@ -727,6 +1690,8 @@ class TestCnC(TestRestful):
            unittest.mock.mock_open(read_data='fields:\n- name: extra').return_value,
            unittest.mock.mock_open(read_data='{}').return_value,
            unittest.mock.mock_open(read_data='{}').return_value,
+           unittest.mock.mock_open(read_data='{}').return_value,
+           unittest.mock.mock_open(read_data='{}').return_value,
            unittest.mock.mock_open(read_data='{}').return_value
          ]
 
@@ -829,16 +1794,107 @@ class TestCnC(TestRestful):
             }
         ])
 
+        # remote
+
+        forge = {
+            "id": "here",
+            "description": "Here",
+            "input": {
+                "craft": "some",
+                "fields": [
+                    {
+                        "name": "some",
+                        "options": {
+                            "url": "somewhere"
+                        }
+                    }
+                ]
+            }
+        }
+
+        cnc.fetch = unittest.mock.MagicMock()
+
+        fields = cnc.fields(forge, {"some": "thing"})
+
+        fetching = cnc.fetch.call_args.args[0]
+
+        self.assertEqual(len(fetching), 1)
+        self.assertEqual(fetching[0][1], "some")
+        self.assertEqual(fetching[0][2].url, "somewhere")
+        self.assertIsNone(cnc.fetching)
+
+        cnc.fetch.assert_called_once_with(fetching, False, True)
+
+        # defer
+
+        forge["input"]["defer"] = True
+
+        cnc.fields(forge, {"some": "thing"})
+
+        self.assertEqual(cnc.fetch.call_args.args[1], True)
+
+        cnc.fields(forge, {"some": "thing"}, lazy=False)
+
+        self.assertEqual(cnc.fetch.call_args.args[1:], (True, False))
+
+    @unittest.mock.patch("service.Options.request")
+    def test_search(self, mock_request):
+
+        mock_request.return_value = ["apple", "pear"]
+
+        forge = {
+            "id": "here",
+            "description": "Here",
+            "input": {
+                "fields": [
+                    {
+                        "name": "fruit",
+                        "options": {
+                            "url": "{{ where }}",
+                            "search": True,
+                            "ttl": 0
+                        }
+                    },
+                    {
+                        "name": "plain"
+                    }
+                ]
+            }
+        }
+
+        cnc = service.CnC()
+
+        fields, fetching, blocks = cnc.evaluate(forge, {"where": "market"})
+
+        self.assertEqual(blocks, {0: ["fruit"], 1: ["plain"]})
+        self.assertEqual([name for _, name, _ in fetching], ["fruit"])
+        self.assertEqual(fetching[0][2].url, "market")
+        self.assertIsNone(cnc.fetching)
+        mock_request.assert_not_called()
+
+        self.assertEqual(cnc.search(forge, {"where": "market"}, "fruit", "pe", 1), {
+            "options": ["pear"],
+            "page": 1,
+            "more": False
+        })
+
+        self.assertIsNone(cnc.search(forge, {"where": "market"}, "plain", "", 1))
+
+        # deferred gets everything
+
+        forge["input"]["fields"][0]["options"] = {"url": "{{ where }}", "defer": True, "ttl": 0}
+
+        self.assertEqual(cnc.search(forge, {"where": "market"}, "fruit", "pe", 1), {
+            "options": ["apple", "pear"]
+        })
+
     @unittest.mock.patch("service.Forge.forge")
-    @unittest.mock.patch("service.Forge.forges")
-    def test_options(self, mock_forges, mock_forge):
+    def test_options(self, mock_forge):
 
-        mock_forges.return_value = {}
+        mock_forge.return_value = None
 
         self.assertStatusValue(self.api.options("/cnc/nope"), 404, "message", "forge 'nope' not found")
 
-        mock_forges.return_value = {"here": True}
-
         mock_forge.return_value = {
             "id": "here",
             "description": "Here",
@@ -877,14 +1933,75 @@ class TestCnC(TestRestful):
                 "name":"some",
                 "value":"thing"
             }
-        ], ready=True, valid=True)
+        ], ready=True, valid=True, blocks=[["some"]])
+
+        # delta
+
+        mock_forge.return_value = {
+            "id": "here",
+            "description": "Here",
+            "input": {
+                "fields": [
+                    {
+                        "name": "some"
+                    },
+                    {
+                        "name": "more",
+                        "condition": "{? some == 'thing' ?}"
+                    },
+                    {
+                        "name": "other"
+                    }
+                ]
+            }
+        }
+
+        response = self.api.options("/cnc/here", json={
+            "values": {
+                "craft": "funtime",
+                "some": "thing"
+            },
+            "changed": ["some"]
+        })
+
+        self.assertStatusFields(response, 200, [
+            {
+                "name":"some",
+                "value":"thing"
+            },
+            {
+                "name":"more"
+            }
+        ], ready=True, valid=True, delta=True, blocks={"0": ["some"], "1": ["more"]})
+
+        response = self.api.options("/cnc/here", json={
+            "values": {
+                "craft": "funtime",
+                "some": "else"
+            },
+            "changed": ["some", "craft"]
+        })
+
+        self.assertStatusFields(response, 200, [
+            {
+                "name": "craft",
+                "description": "name of what to craft, used for repos, branches, change requests",
+                "validation": '^[a-z][a-z0-9\-]{1,46}$',
+                "required": True,
+                "trigger": True,
+                "value": "funtime"
+            },
+            {
+                "name":"some",
+                "value":"else"
+            }
+        ], ready=True, valid=True, delta=True, blocks={"0": ["some"], "1": []})
 
     @freezegun.freeze_time("2020-11-02") # 1604275200
     @unittest.mock.patch("service.Forge.forge")
-    @unittest.mock.patch("service.Forge.forges")
     @unittest.mock.patch('service.os.path.exists')
     @unittest.mock.patch('service.open', create=True)
-    def test_post(self, mock_open, mock_exists, mock_forges, mock_forge):
+    def test_post(self, mock_open, mock_exists, mock_forge):
 
         def exists(path):
 
@@ -897,7 +2014,7 @@ class TestCnC(TestRestful):
 
         mock_exists.side_effect = exists
 
-        mock_forges.return_value = {}
+        mock_forge.return_value = None
 
         # not found
 
@@ -905,8 +2022,6 @@ class TestCnC(TestRestful):
 
         # no action
 
-        mock_forges.return_value = {"here": True}
-
         mock_forge.return_value = {
             "id": "here",
             "description": "Here",
@@ -982,6 +2097,7 @@ class TestCnC(TestRestful):
                 "cnc": "fun-time-here-1604275200"
             },
             "status": "Created",
+            "timings": {"created": 1604275200},
             "action": "commit"
         })
 
@@ -1004,10 +2120,20 @@ class TestCnC(TestRestful):
                 "cnc": "fun-time-here-1604275200"
             },
             "status": "Created",
+            "timings": {"created": 1604275200},
             "action": "commit"
         })
 
         self.assertEqual(self.app.redis.expires["/cnc/fun-time-here-1604275200"], 86400)
+        self.assertEqual(self.app.redis.data["/queue/cnc"], ["fun-time-here-1604275200"])
+        self.assertEqual(self.app.redis.data["/index/cnc"], {"fun-time-here-1604275200": 1604275200})
+        self.assertEqual(self.app.redis.data["/index/cnc/forge/here"], {"fun-time-here-1604275200": 1604275200})
+        self.assertEqual(self.app.redis.data["/index/cnc/status/Created"], {"fun-time-here-1604275200": 1604275200})
+        self.assertEqual(self.app.redis.data["/status/cnc/fun-time-here-1604275200"], {
+            "status": '"Created"',
+            "timings": '{"created": 1604275200}'
+        })
+        self.assertEqual(self.app.redis.expires["/status/cnc/fun-time-here-1604275200"], 86400)
 
         # override multi
 
@@ -1059,40 +2185,285 @@ class TestCnC(TestRestful):
                 "cnc": "fun-time-good-time-best-time-worst-time-no-tim-here-1604275200"
             },
             "status": "Created",
+            "timings": {"created": 1604275200},
             "action": "test"
         })
 
+    def test_created(self):
+
+        self.assertEqual(service.CnC.created("funtime-here-1604275200"), 1604275200)
+
+    @unittest.mock.patch("service.time.time")
+    def test_created_fallback(self, mock_time):
+
+        mock_time.return_value = 7.5
+
+        self.assertEqual(service.CnC.created("nope"), 7)
+
+    def test_index(self):
+
+        redis = self.app.redis
+
+        redis.zadd("/index/cnc/status/Created", {"fun-here-7": 7})
+
+        pipeline = redis.pipeline()
+
+        service.CnC.index(pipeline, {"id": "fun-here-7", "status": "Retry", "values": {"forge": "here"}})
+
+        pipeline.execute()
+
+        self.assertEqual(redis.data["/index/cnc"], {"fun-here-7": 7})
+        self.assertEqual(redis.data["/index/cnc/forge/here"], {"fun-here-7": 7})
+        self.assertEqual(redis.data["/index/cnc/status/Retry"], {"fun-here-7": 7})
+        self.assertEqual(redis.data["/index/cnc/status/Created"], {})
+        self.assertEqual(redis.data["/index/cnc/forges"], {"here"})
+
+        # unindex
+
+        pipeline = redis.pipeline()
+
+        service.CnC.unindex(pipeline, {"id": "fun-here-7", "status": "Retry", "values": {"forge": "here"}})
+
+        pipeline.execute()
+
+        self.assertEqual(redis.data["/index/cnc"], {})
+        self.assertEqual(redis.data["/index/cnc/forge/here"], {})
+        self.assertEqual(redis.data["/index/cnc/status/Retry"], {})
+
+    def test_prune(self):
+
+        redis = self.app.redis
+
+        for cnc in [
+            {"id": "fun-here-7", "status": "Error", "values": {"forge": "here"}},
+            {"id": "fun-there-8", "status": "Completed", "values": {"forge": "there"}},
+            {"id": "fun-here-9", "status": "Completed", "values": {"forge": "here"}}
+        ]:
+            pipeline = redis.pipeline()
+            service.CnC.index(pipeline, cnc)
+            pipeline.execute()
+
+        service.CnC.prune(redis, ["fun-here-7", "fun-there-8"])
+
+        self.assertEqual(redis.data["/index/cnc"], {"fun-here-9": 9})
+        self.assertEqual(redis.data["/index/cnc/forge/here"], {"fun-here-9": 9})
+        self.assertEqual(redis.data["/index/cnc/forge/there"], {})
+        self.assertEqual(redis.data["/index/cnc/status/Error"], {})
+        self.assertEqual(redis.data["/index/cnc/status/Completed"], {"fun-here-9": 9})
+
+    @unittest.mock.patch("service.time.time")
+    def test_sweep(self, mock_time):
+
+        mock_time.return_value = 86410
+
+        redis = self.app.redis
+
+        service.CnC.sweep(redis)
+
+        self.assertNotIn("/index/cnc", redis.data)
+
+        for cnc in [
+            {"id": "fun-here-7", "status": "Error", "values": {"forge": "here"}},
+            {"id": "fun-here-8", "status": "Completed", "values": {"forge": "here"}},
+            {"id": "fun-here-20", "status": "Completed", "values": {"forge": "here"}}
+        ]:
+            pipeline = redis.pipeline()
+            service.CnC.index(pipeline, cnc)
+            pipeline.execute()
+
+        redis.set("/cnc/fun-here-8", "{}")
+
+        service.CnC.sweep(redis)
+
+        self.assertEqual(redis.data["/index/cnc"], {"fun-here-8": 8, "fun-here-20": 20})
+        self.assertEqual(redis.data["/index/cnc/forge/here"], {"fun-here-8": 8, "fun-here-20": 20})
+        self.assertEqual(redis.data["/index/cnc/status/Error"], {})
+
+    def test_state(self):
+
+        self.assertEqual(service.CnC.state({
+            "id": "fun-here-7",
+            "status": "Completed",
+            "links": ["http://here"],
+            "values": {}
+        }), {
+            "status": '"Completed"',
+            "links": '["http://here"]'
+        })
+
+    def test_unstate(self):
+
+        self.assertEqual(service.CnC.unstate(["status", "error", "links"], ['"Error"', None, "[]"]), {
+            "status": "Error",
+            "links": []
+        })
+
+    def test_reindex(self):
+
+        redis = MockRedis("redis.cnc-forge")
+
+        redis.set("/cnc/fun-here-7", json.dumps({"id": "fun-here-7", "status": "Completed", "values": {"forge": "here"}}))
+        redis.zadd("/index/cnc/forge/there", {"fun-there-6": 6})
+
+        service.CnC.reindex(redis)
+
+        self.assertEqual(redis.data["/index/cnc"], {"fun-here-7": 7})
+        self.assertEqual(redis.data["/index/cnc/forge/here"], {"fun-here-7": 7})
+        self.assertEqual(redis.data["/index/cnc/status/Completed"], {"fun-here-7": 7})
+        self.assertEqual(redis.data["/index/cnc/forges"], {"here", "there"})
+
+    def test_summary(self):
+
+        self.assertEqual(service.CnC.summary({
+            "id": "fun-here-7",
+            "status": "Completed",
+            "action": "commit",
+            "values": {"forge": "here"},
+            "links": ["http://here"],
+            "output": {"big": "stuff"}
+        }), {
+            "id": "fun-here-7",
+            "status": "Completed",
+            "forge": "here",
+            "action": "commit",
+            "links": ["http://here"]
+        })
+
+    def test_cursor(self):
+
+        self.assertIsNone(service.CnC.cursor({}))
+        self.assertEqual(service.CnC.cursor({"cursor": "7:fun-here-7"}), (7, "fun-here-7"))
+        self.assertRaises(ValueError, service.CnC.cursor, {"cursor": "nope"})
+
+    def test_indexed(self):
+
+        redis = self.app.redis
+
+        self.assertEqual(service.CnC.indexed(redis, {}), ("/index/cnc", []))
+        self.assertEqual(service.CnC.indexed(redis, {"forge": "here"}), ("/index/cnc/forge/here", ["/index/cnc/forge/here"]))
+
+        redis.zadd("/index/cnc/status/Error", {"a": 1, "b": 2})
+        redis.zadd("/index/cnc/forge/here", {"b": 2, "c": 3})
+
+        self.assertEqual(service.CnC.indexed(redis, {"status": "Error", "forge": "here"}), (
+            "/index/cnc/query/Error/here",
+            ["/index/cnc/status/Error", "/index/cnc/forge/here"]
+        ))
+        self.assertEqual(redis.data["/index/cnc/query/Error/here"], {"b": 2})
+
+    def test_list_stale(self):
+
+        redis = self.app.redis
+
+        for number in range(1, 10):
+
+            cnc = {"id": f"c{number}", "status": "Completed", "values": {"forge": "here"}}
+
+            redis.set(f"/cnc/c{number}", json.dumps(cnc))
+            redis.zadd("/index/cnc", {f"c{number}": 100 + number})
+            redis.zadd("/index/cnc/status/Completed", {f"c{number}": 100 + number})
+
+        redis.delete("/cnc/c9")
+        redis.delete("/cnc/c8")
+        redis.delete("/cnc/c3")
+
+        response = self.api.get("/cnc?limit=2")
+
+        self.assertEqual([cnc["id"] for cnc in response.json["cncs"]], ["c7", "c6"])
+        self.assertEqual(response.json["cursor"], "106:c6")
+        self.assertEqual(sorted(redis.data["/index/cnc"]), ["c1", "c2", "c3", "c4", "c5", "c6", "c7"])
+        self.assertEqual(sorted(redis.data["/index/cnc/status/Completed"]), ["c1", "c2", "c3", "c4", "c5", "c6", "c7"])
+
+        response = self.api.get("/cnc?limit=2&cursor=106:c6")
+
+        self.assertEqual([cnc["id"] for cnc in response.json["cncs"]], ["c5", "c4"])
+        self.assertEqual(response.json["cursor"], "104:c4")
+
+        response = self.api.get("/cnc?limit=2&cursor=104:c4")
+
+        self.assertEqual([cnc["id"] for cnc in response.json["cncs"]], ["c2", "c1"])
+        self.assertNotIn("cursor", response.json)
+        self.assertNotIn("c3", redis.data["/index/cnc"])
+
     def test_list(self):
 
-        class TestList(flask_restful.Resource):
+        redis = self.app.redis
 
-            def get(self):
+        def create(craft, forge, created, status):
 
-                return service.CnC.list()
+            cnc = {
+                "id": f"{craft}-{forge}-{created}",
+                "status": status,
+                "action": "commit",
+                "values": {"forge": forge}
+            }
 
-        self.app.api.add_resource(TestList, '/test-list')
+            redis.set(f"/cnc/{cnc['id']}", json.dumps(cnc))
 
-        self.app.redis.data["/cnc/funtime-here-1604275200"] = json.dumps({
-            "id": "funtime-here-1604275200",
-            "description": "Here",
-            "input": {
-                "fields": [
-                    {
-                        "name": "some"
-                    }
-                ]
-            },
-            "values": {
-                "forge": "here",
-                "craft": "funtime",
-                "some": "thing"
-            },
-            "status": "Created"
+            pipeline = redis.pipeline()
+            service.CnC.index(pipeline, cnc)
+            pipeline.execute()
+
+        create("a", "here", 1, "Completed")
+        create("b", "there", 2, "Error")
+        create("c", "here", 2, "Error")
+        create("d", "here", 3, "Completed")
+        create("e", "there", 4, "Created")
+
+        def ids(response):
+
+            return [cnc["id"] for cnc in response.json["cncs"]]
+
+        # all
+
+        response = self.api.get("/cnc")
+
+        self.assertEqual(response.status_code, 200, response.json)
+        self.assertEqual(ids(response), ["e-there-4", "d-here-3", "c-here-2", "b-there-2", "a-here-1"])
+        self.assertNotIn("cursor", response.json)
+        self.assertEqual(response.json["cncs"][0], {
+            "id": "e-there-4",
+            "status": "Created",
+            "forge": "there",
+            "action": "commit",
+            "links": []
         })
 
-        self.assertStatusValue(self.api.get("/test-list"), 200, "cncs", [
-            {"id": "funtime-here-1604275200"}
-        ])
+        # paging, even on the same second
+
+        response = self.api.get("/cnc?limit=2")
+
+        self.assertEqual(ids(response), ["e-there-4", "d-here-3"])
+        self.assertEqual(response.json["cursor"], "3:d-here-3")
+
+        response = self.api.get("/cnc?limit=2&cursor=3:d-here-3")
+
+        self.assertEqual(ids(response), ["c-here-2", "b-there-2"])
+        self.assertEqual(response.json["cursor"], "2:b-there-2")
+
+        response = self.api.get("/cnc?limit=2&cursor=2:b-there-2")
+
+        self.assertEqual(ids(response), ["a-here-1"])
+        self.assertNotIn("cursor", response.json)
+
+        # filters
+
+        self.assertEqual(ids(self.api.get("/cnc?status=Error")), ["c-here-2", "b-there-2"])
+        self.assertEqual(ids(self.api.get("/cnc?forge=here")), ["d-here-3", "c-here-2", "a-here-1"])
+        self.assertEqual(ids(self.api.get("/cnc?forge=here&status=Completed")), ["d-here-3", "a-here-1"])
+        self.assertEqual(redis.expires["/index/cnc/query/Completed/here"], 10)
+
+        # expired get pruned
+
+        redis.delete("/cnc/d-here-3")
+
+        self.assertEqual(ids(self.api.get("/cnc?forge=here&limit=2")), ["c-here-2", "a-here-1"])
+        self.assertNotIn("d-here-3", redis.data["/index/cnc/forge/here"])
+
+        # bad
+
+        self.assertStatusValue(self.api.get("/cnc?limit=nope"), 400, "message", "limit must be an integer")
+        self.assertStatusValue(self.api.get("/cnc?cursor=nope"), 400, "message", "invalid cursor 'nope'")
 
     def test_retrieve(self):
 
@@ -1182,11 +2553,21 @@ class TestCnC(TestRestful):
             "status": "Created"
         })
 
+        service.CnC.reindex(self.app.redis)
+
         self.assertStatusValue(self.api.get("/cnc"), 200, "cncs", [
-            {"id": "funtime-here-1604275200"}
+            {
+                "id": "funtime-here-1604275200",
+                "status": "Created",
+                "forge": "here",
+                "action": None,
+                "links": []
+            }
         ])
 
-        self.assertStatusValue(self.api.get("/cnc/funtime-here-1604275200"), 200, "cnc", {
+        response = self.api.get("/cnc/funtime-here-1604275200")
+
+        self.assertStatusValue(response, 200, "cnc", {
             "id": "funtime-here-1604275200",
             "description": "Here",
             "input": {
@@ -1203,6 +2584,79 @@ class TestCnC(TestRestful):
             },
             "status": "Created"
         })
+        self.assertIn("yaml", response.json)
+
+        # status hash wins
+
+        self.app.redis.hset("/status/cnc/funtime-here-1604275200", mapping={
+            "status": '"Completed"',
+            "links": '["http://here"]',
+            "progress": '{"code": 2}'
+        })
+
+        self.assertStatusValue(self.api.get("/cnc"), 200, "cncs", [
+            {
+                "id": "funtime-here-1604275200",
+                "status": "Completed",
+                "forge": "here",
+                "action": None,
+                "links": ["http://here"]
+            }
+        ])
+
+        response = self.api.get("/cnc/funtime-here-1604275200")
+
+        self.assertEqual(response.json["cnc"]["status"], "Completed")
+        self.assertEqual(response.json["cnc"]["progress"], {"code": 2})
+        self.assertIn("status: Completed", response.json["yaml"])
+
+        # just hot fields, just from the hash
+
+        self.app.redis.get = unittest.mock.MagicMock()
+
+        response = self.api.get("/cnc/funtime-here-1604275200?fields=status,links,error")
+
+        self.assertEqual(response.json, {
+            "cnc": {
+                "id": "funtime-here-1604275200",
+                "status": "Completed",
+                "links": ["http://here"]
+            }
+        })
+
+        self.app.redis.get.assert_not_called()
+
+        del self.app.redis.get
+
+        # other fields, yaml only if asked
+
+        self.assertEqual(self.api.get("/cnc/funtime-here-1604275200?fields=status,values").json, {
+            "cnc": {
+                "id": "funtime-here-1604275200",
+                "status": "Completed",
+                "values": {
+                    "forge": "here",
+                    "craft": "funtime",
+                    "some": "thing"
+                }
+            }
+        })
+
+        response = self.api.get("/cnc/funtime-here-1604275200?fields=description,yaml")
+
+        self.assertEqual(response.json["cnc"], {"id": "funtime-here-1604275200", "description": "Here"})
+        self.assertIn("description: Here", response.json["yaml"])
+
+        # legacy without a hash
+
+        self.app.redis.delete("/status/cnc/funtime-here-1604275200")
+
+        self.assertStatusValue(self.api.get("/cnc/funtime-here-1604275200?fields=status"), 200, "cnc", {
+            "id": "funtime-here-1604275200",
+            "status": "Created"
+        })
+
+        self.assertStatusValue(self.api.get("/cnc/nope?fields=status"), 404, "message", "cnc 'nope' not found")
 
     def test_patch(self):
 
@@ -1228,7 +2682,14 @@ class TestCnC(TestRestful):
             "traceback": "scroll",
             "change": "down",
             "content": "monetized",
-            "code": "rancid"
+            "code": "rancid",
+            "requests": {"github.com": 3}
+        })
+
+        self.app.redis.hset("/status/cnc/funtime-here-1604275200", mapping={
+            "status": '"Error"',
+            "error": '"whoops"',
+            "progress": '{"code": 1}'
         })
 
         response = self.api.patch("/cnc/funtime-here-1604275200")
@@ -1256,6 +2717,9 @@ class TestCnC(TestRestful):
         self.assertStatusValue(response, 201, "yaml", yaml.safe_dump(result))
 
         self.assertEqual(json.loads(self.app.redis.data["/cnc/funtime-here-1604275200"]), result)
+        self.assertEqual(self.app.redis.data["/queue/cnc"], ["funtime-here-1604275200"])
+        self.assertEqual(self.app.redis.data["/index/cnc/status/Retry"], {"funtime-here-1604275200": 1604275200})
+        self.assertEqual(self.app.redis.data["/status/cnc/funtime-here-1604275200"], {"status": '"Retry"'})
 
         # edit
 
@@ -1282,6 +2746,8 @@ class TestCnC(TestRestful):
 
         self.api.patch("/cnc/funtime-here-1604275200", json={"save": False})
 
+        self.assertEqual(self.app.redis.data["/queue/cnc"], ["funtime-here-1604275200"])
+
         self.assertEqual(json.loads(self.app.redis.data["/cnc/funtime-here-1604275200"]), {
             "id": "funtime-here-1604275200",
             "description": "Here",
@@ -1341,10 +2807,17 @@ class TestCnC(TestRestful):
             "content": "monetized"
         })
 
+        service.CnC.reindex(self.app.redis)
+        self.app.redis.hset("/status/cnc/funtime-here-1604275200", "status", '"Created"')
+
         response = self.api.delete("/cnc/funtime-here-1604275200")
 
         self.assertStatusValue(response, 201, "deleted", 1)
 
-        self.assertEqual(self.app.redis.data, {})
+        self.assertNotIn("/cnc/funtime-here-1604275200", self.app.redis.data)
+        self.assertNotIn("/status/cnc/funtime-here-1604275200", self.app.redis.data)
+        self.assertEqual(self.app.redis.data["/index/cnc"], {})
+        self.assertEqual(self.app.redis.data["/index/cnc/forge/here"], {})
+        self.assertEqual(self.app.redis.data["/index/cnc/status/Created"], {})
 
         self.assertStatusValue(self.api.delete("/cnc/nope"), 404, "message", "cnc 'nope' not found")
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Benchmark for rendering the same boilerplate templates across many CnCs,
+with a fresh Jinja2 environment per CnC (like before) vs the shared cache
+"""
+
+import sys
+import time
+
+import jinja2
+import yaes
+
+import cnc
+
+FILES = 200
+CNCS = 20
+
+TEMPLATE = """# {{ craft }}
+
+{% for service in services %}
+- name: {{ service }}-{{ loop.index }}
+  image: {{ registry }}/{{ service }}:{{ version }}
+  {% if service == "api" %}port: {{ port }}{% endif %}
+{% endfor %}
+"""
+
+def files():
+    """
+    Slight variations of a template, like a forge of many similar files
+    """
+
+    return [f"{TEMPLATE}# file {index % 20}\n" for index in range(FILES)]
+
+def render(engine, templates):
+    """
+    Renders every template like CnC.file() does
+    """
+
+    values = {
+        "craft": "fun-time",
+        "services": ["api", "daemon", "gui"],
+        "registry": "docker.io/gaf3",
+        "version": "0.1.0",
+        "port": 8080
+    }
+
+    for template in templates:
+        engine.transform(template, values)
+
+def fresh():
+    """
+    New environment for every CnC
+    """
+
+    templates = files()
+
+    start = time.perf_counter()
+
+    for _ in range(CNCS):
+        render(yaes.Engine(jinja2.Environment(keep_trailing_newline=True)), templates)
+
+    return time.perf_counter() - start
+
+def cached():
+    """
+    Shared, caching environment for every CnC
+    """
+
+    templates = files()
+
+    start = time.perf_counter()
+
+    for _ in range(CNCS):
+        render(cnc.CnC({}).engine, templates)
+
+    return time.perf_counter() - start
+
+def main():
+    """
+    Runs both and prints the comparison
+    """
+
+    before = fresh()
+    after = cached()
+
+    print(f"{CNCS} CnCs x {FILES} files")
+    print(f"fresh:  {before:.3f}s")
+    print(f"cached: {after:.3f}s")
+    print(f"speedup: {before / after:.1f}x")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,14 +2,18 @@
 Module for CnC
 """
 
-# pylint: disable=too-many-public-methods,inconsistent-return-statements
+# pylint: disable=too-many-public-methods,too-many-instance-attributes,inconsistent-return-statements
 
 import os
 import glob
 import json
 import yaml
 import shutil
+import hashlib
 import fnmatch
+import threading
+import collections
+import concurrent.futures
 
 import jinja2
 import overscore
@@ -17,18 +21,115 @@ import yaes
 
 import github
 
+CHUNK = 1024*1024
+
+class Environment(jinja2.Environment):
+    """
+    Jinja2 environment that keeps templates compiled from strings, least
+    recently used dropped past size, optionally backed by bytecode on disk
+    """
+
+    def __init__(self, size=1024, bytecode=None, **kwargs):
+
+        super().__init__(**kwargs)
+
+        self.size = size
+        self.compiled = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if bytecode:
+            os.makedirs(bytecode, exist_ok=True)
+            self.bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode)
+
+    def compiling(self, source, key):
+        """
+        Compiles source, using the bytecode cache under key if we have one
+        """
+
+        if self.bytecode_cache is None:
+            return self.compile(source)
+
+        bucket = self.bytecode_cache.get_bucket(self, key, None, source)
+
+        if bucket.code is None:
+            bucket.code = self.compile(source)
+            self.bytecode_cache.set_bucket(bucket)
+
+        return bucket.code
+
+    def from_string(self, source, globals=None, template_class=None):
+        """
+        Loads a template from a string, compiling only if we haven't seen it
+        """
+
+        key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+        with self.lock:
+            code = self.compiled.get(key)
+            if code is not None:
+                self.compiled.move_to_end(key)
+                self.hits += 1
+
+        if code is None:
+
+            code = self.compiling(source, key)
+
+            with self.lock:
+                self.misses += 1
+                self.compiled[key] = code
+                while len(self.compiled) > self.size:
+                    self.compiled.popitem(last=False)
+
+        return (template_class or self.template_class).from_code(self, code, self.make_globals(globals), None)
+
 class CnC:
     """
     Class that craft the code and changes
     """
 
-    def __init__(self, data):
+    env = None
+
+    def __init__(self, data, report=None, lost=None):
         """
         Store the daemon
         """
 
         self.data = data
-        self.engine = yaes.Engine(jinja2.Environment(keep_trailing_newline=True))
+
+        # Where to send status fields like links and progress as they change, and
+        # what's set if our lease is lost and someone else might take this over
+
+        self.report = report
+        self.lost = lost
+        self.engine = yaes.Engine(self.environment())
+
+        # How many files to craft at once, and files waiting to be crafted if more than one
+
+        self.crafters = int(os.environ.get("CRAFTERS", 1))
+        self.crafting = None
+
+        # Source trees cloned so far, keyed by (host, path, branch, checkout), and the one in use,
+        # either relative to base or an absolute path like a local repo read in place
+
+        self.sources = {}
+        self.sourcing = "source"
+
+    @classmethod
+    def environment(cls):
+        """
+        Gets the template environment shared by all CnCs in this process
+        """
+
+        if cls.env is None:
+            cls.env = Environment(
+                size=int(os.environ.get("TEMPLATES", 1024)),
+                bytecode=os.environ.get("BYTECODE"),
+                keep_trailing_newline=True
+            )
+
+        return cls.env
 
     @staticmethod
     def placing(content):
@@ -92,10 +193,22 @@ class CnC:
         """
         return f"/opt/service/cnc/{self.data['id']}"
 
+    def root(self, placing):
+        """
+        Gets the root directory for either source or destination
+        """
+        return os.path.join(self.base(), self.sourcing if placing == "source" else "destination")
+
     def relative(self, path):
         """
-        Gets the relative path based on base and whether source or destnation
+        Gets the relative path based on whether source or destnation
         """
+
+        for placing in ["source", "destination"]:
+            root = self.root(placing)
+            if path == root or path.startswith(f"{root}/"):
+                return path[len(root) + 1:]
+
         return path.split(self.base(), 1)[-1].split("/", 2)[-1]
 
     def source(self, content, path=False):
@@ -106,9 +219,10 @@ class CnC:
         if isinstance(content['source'], dict):
             return content['source']['value']
 
-        source = os.path.abspath(f"{self.base()}/source/{content['source']}")
+        root = self.root("source")
+        source = os.path.abspath(f"{root}/{content['source']}")
 
-        if not source.startswith(f"{self.base()}/source"):
+        if source != root and not source.startswith(f"{root}/"):
             raise Exception(f"invalid path: {source}")
 
         if path:
@@ -122,9 +236,9 @@ class CnC:
         Retrieve or store the content of a destination file
         """
 
-        destination = os.path.abspath(f"{self.base()}/destination/{content['destination']}")
+        destination = os.path.abspath(f"{self.root('destination')}/{content['destination']}")
 
-        if not destination.startswith(f"{self.base()}/destination"):
+        if not destination.startswith(self.root("destination")):
             raise Exception(f"invalid path: {destination}")
 
         if path:
@@ -137,12 +251,44 @@ class CnC:
             with open(destination, "r") as destination_file:
                 return destination_file.read()
 
+        # Leave it alone if it's the same so mtime and git's index stay clean
+
+        if self.unchanged(destination, data.encode("utf-8")):
+            return
+
         with open(destination, "w") as destination_file:
             return destination_file.write(data)
 
+    @staticmethod
+    def digest(path):
+        """
+        Hash of a file, read in chunks so memory stays flat
+        """
+
+        hashed = hashlib.sha256()
+
+        with open(path, "rb") as hashing_file:
+            for chunk in iter(lambda: hashing_file.read(CHUNK), b""):
+                hashed.update(chunk)
+
+        return hashed.hexdigest()
+
+    def unchanged(self, destination, data=None, source=None):
+        """
+        Whether a destination already has exactly the data or the contents of the source file
+        """
+
+        if not os.path.isfile(destination):
+            return False
+
+        if os.path.getsize(destination) != (len(data) if source is None else os.path.getsize(source)):
+            return False
+
+        return self.digest(destination) == (hashlib.sha256(data).hexdigest() if source is None else self.digest(source))
+
     def copy(self, content):
         """
-        Copies the content of source to desintation unchanged
+        Copies the content of source to desintation unchanged, streamed and only if different
         """
 
         source = self.source(content, path=True)
@@ -151,6 +297,10 @@ class CnC:
         if not content.get("replace", True) and os.path.exists(destination):
             return
 
+        if self.unchanged(destination, source=source):
+            self.mode(content)
+            return
+
         shutil.copy(source, destination)
 
     def remove(self, content):
@@ -254,10 +404,11 @@ class CnC:
         Have the desination mode match the source mode
         """
 
-        os.chmod(
-            self.destination(content, path=True),
-            os.stat(self.source(content, path=True)).st_mode
-        )
+        destination = self.destination(content, path=True)
+        mode = os.stat(self.source(content, path=True)).st_mode
+
+        if os.stat(destination).st_mode != mode:
+            os.chmod(destination, mode)
 
     def directory(self, content, values):
         """
@@ -350,6 +501,10 @@ class CnC:
 
             self.directory(content, values)
 
+        elif self.crafting is not None:
+
+            self.crafting.append((content, values))
+
         else:
 
             self.file(content, values)
@@ -398,24 +553,100 @@ class CnC:
                 content[collection] = [content[collection]]
             content[collection] = [pattern[:-1] if pattern[-1] == "/" else pattern for pattern in content[collection]]
 
-        # Transform the source on templating, using destination if it doesn't exist for remove
+        # If crafting in parallel, walk everything first and craft the files after
 
-        if self.placing(content) == "source":
+        if self.crafters > 1:
+            self.crafting = []
 
-            # Go through the source as glob, transforming destination accordingly, assuming source if missing
+        try:
 
-            for place in self.places(content, values):
-                self.craft({**content,
-                    "source": place,
-                    "destination": self.engine.transform(content.get("destination", place), values)
-                }, values)
+            # Transform the source on templating, using destination if it doesn't exist for remove
 
-        else:
+            if self.placing(content) == "source":
+
+                # Go through the source as glob, transforming destination accordingly, assuming source if missing
+
+                for place in self.places(content, values):
+                    self.craft({**content,
+                        "source": place,
+                        "destination": self.engine.transform(content.get("destination", place), values)
+                    }, values)
+
+            else:
+
+                for place in self.places(content, values):
+                    self.craft({**content,
+                        "destination": place
+                    }, values)
+
+            crafting = self.crafting
+
+        finally:
+
+            self.crafting = None
+
+        if crafting:
+            self.parallel(crafting)
+
+    def files(self, crafting):
+        """
+        Crafts files in order, returning the content and exception if one fails
+        """
+
+        for content, values in crafting:
+            try:
+                self.file(content, values)
+            except Exception as exception: # pylint: disable=broad-except
+                return content, exception
+
+        return None
+
+    def parallel(self, crafting):
+        """
+        Crafts files across threads, keeping the order of anything going to the same destination
+        """
+
+        destinations = collections.OrderedDict()
+
+        for content, values in crafting:
+            destinations.setdefault(self.destination(content, path=True), []).append((content, values))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.crafters) as pool:
+            failures = list(pool.map(self.files, destinations.values()))
 
-            for place in self.places(content, values):
-                self.craft({**content,
-                    "destination": place
-                }, values)
+        # Report the first failure as it would have been sequentially
+
+        for failure in failures:
+            if failure is not None:
+                self.data['content'], exception = failure
+                raise exception
+
+    def sparse(self, contents, values, placing):
+        """
+        Patterns of everything contents could touch for a sparse checkout, None if everything
+        """
+
+        patterns = []
+
+        for content, content_values in self.engine.each(contents, values):
+
+            # Sources are only needed from source, destinations default to sources
+
+            if placing == "source":
+                if self.placing(content) != "source" or isinstance(content["source"], dict):
+                    continue
+                place = content["source"]
+            else:
+                place = content.get("destination", content.get("source"))
+
+            place = self.engine.transform(place, content_values).strip("/")
+
+            if not place:
+                return None
+
+            patterns.append(f"/{place}")
+
+        return patterns
 
     def change(self, change, values):
         """
@@ -431,7 +662,10 @@ class CnC:
             controller = github.GitHub(self, change["github"])
 
         if controller is not None:
-            controller.change()
+            if change["github"].get("checkout") == "sparse":
+                controller.change(self.sparse(change["content"], values, "source"))
+            else:
+                controller.change()
 
         # Go through each content, which it'll check conditions, transpose, and iterate
 
@@ -451,7 +685,25 @@ class CnC:
             code["github"] = self.engine.transform(code["github"], values)
             controller = github.GitHub(self, code["github"])
 
-        controller.code()
+        # If sparse, only checkout what any change could write to
+
+        sparse = None
+
+        if code.get("github", {}).get("checkout") == "sparse":
+
+            sparse = []
+
+            for change, change_values in self.engine.each(code["change"], values):
+
+                patterns = self.sparse(change["content"], change_values, "destination")
+
+                if patterns is None:
+                    sparse = None
+                    break
+
+                sparse.extend(patterns)
+
+        controller.code(sparse)
 
         # Go through each change, which it'll check conditions, transpose, and iterate
 
@@ -471,6 +723,24 @@ class CnC:
 
         if link not in self.data["links"]:
             self.data["links"].append(link)
+            self.update(links=self.data["links"])
+
+    def update(self, **fields):
+        """
+        Reports status fields as they change, if anyone's listening
+        """
+
+        if self.report is not None:
+            self.report(fields)
+
+    def check(self):
+        """
+        Stops processing before cloning, pushing, or changing anything upstream
+        if the lease is lost, so no CnC is ever worked on twice at once
+        """
+
+        if self.lost is not None and self.lost.is_set():
+            raise Exception(f"lost lease on {self.data['id']}")
 
     def process(self):
         """
@@ -489,14 +759,18 @@ class CnC:
 
         # Go through each code, which it'll check conditions, transpose, and iterate
 
-        for code, code_values in self.engine.each(self.data["code"], self.data["values"]):
+        for index, (code, code_values) in enumerate(self.engine.each(self.data["code"], self.data["values"])):
+            self.check()
             self.code({"remove": self.data["action"] == "remove", **code}, code_values)
+            self.update(progress={"code": index + 1})
 
         # If we're here we were successful and can clean up if we're not testing
 
         self.data["status"] = "Completed"
 
         if self.data["action"] == "test":
-            shutil.rmtree(f"{self.base()}/source", ignore_errors=True)
+            for source in self.sources.values():
+                if source["directory"].startswith(f"{self.base()}/"):
+                    shutil.rmtree(source["directory"], ignore_errors=True)
         else:
             shutil.rmtree(self.base(), ignore_errors=True)
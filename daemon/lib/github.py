@@ -2,15 +2,43 @@
 Module for interacting with GitHub
 """
 
-# pylint: disable=redefined-outer-name
+# pylint: disable=redefined-outer-name,too-many-public-methods
 
 import os
+import time
 import glob
 import json
+import fcntl
 import shutil
 import base64
+import hashlib
 import requests
+import requests.adapters
+import urllib3
+import threading
 import subprocess
+import collections
+import urllib.parse
+import concurrent.futures
+
+# Takes a request from a creds' budget, returning how long to wait if there's none left
+
+TAKE = """
+local remaining = tonumber(redis.call("hget", KEYS[1], "remaining"))
+local reset = tonumber(redis.call("hget", KEYS[1], "reset"))
+if remaining == nil or reset == nil or reset <= tonumber(ARGV[1]) then
+    return 0
+end
+if remaining > 0 then
+    redis.call("hincrby", KEYS[1], "remaining", -1)
+    return 0
+end
+return reset - tonumber(ARGV[1])
+"""
+
+# Upper bounds, in seconds, of the latency histogram buckets
+
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10]
 
 
 class GitHub:
@@ -24,6 +52,19 @@ class GitHub:
             host: Host to use with checkout (optional)
             user:
             token:
+            legacy: Page through lists for Enterprise versions without direct lookups (optional)
+    environment:
+        MIRROR: Directory to keep bare mirrors of cloned repos (optional)
+        MIRROR_BUDGET: Megabytes mirrors can use before evicting (optional)
+        LOCAL: How to use repos in /opt/service/repo, read (default) in place, link, or copy
+        GITHUB_CACHE: How many responses to keep for conditional requests, 0 to disable (default 1024)
+        GITHUB_SHARE: Whether to share those responses through Redis (default false)
+        GITHUB_RETRIES: How many times to retry a request that hit a rate limit (default 3)
+        GITHUB_WAIT: Most seconds to wait on a rate limit before trying anyway (default 3600)
+        GITHUB_POOL: How many keep alive connections to keep per creds (default 10)
+        GITHUB_TIMEOUT: Seconds to wait to connect and for each read (default 30)
+        GITHUB_BACKOFF: Backoff factor between retries of transient failures (default 0.5)
+        GITHUB_PAGES: How many pages of a listing to fetch at once (default 4)
     data fields:
         creds: Name of creds to use (default is default)
         repo: repo from settings
@@ -31,6 +72,7 @@ class GitHub:
         org: IF there's an org to do
         user: If this is owned by a user
         path: Full path to access the repo
+        checkout: full (default), shallow, or sparse
         prefix: Prefix to use for branch and title
         branch: THe branch for the PR
         title: Title for the PR
@@ -43,6 +85,49 @@ class GitHub:
     """
 
     creds = {}
+    mirror = None
+    budget = 0
+    local = "read"
+    grace = 60*60
+
+    # Responses by request with their ETag / Last-Modified, least recently used
+    # dropped past capacity, and optionally shared through Redis for ttl
+
+    cache = collections.OrderedDict()
+    capacity = 1024
+    share = False
+    ttl = 24*60*60
+    caching = threading.Lock()
+
+    # Rate limit budgets by creds, in Redis so all workers pace together,
+    # or just in memory if there's no Redis
+
+    redis = None
+    taking = None
+    budgets = {}
+    budgeting = threading.Lock()
+    retries = 3
+    wait = 60*60
+
+    # Requests counted on each CnC, by any instance or pager thread
+
+    counting = threading.Lock()
+
+    # Keep alive sessions by creds and url, shared by every block of every CnC,
+    # and how long calls took, by creds, method, and bucket
+
+    sessions = {}
+    pool = 10
+    timeout = 30
+    backoff = 0.5
+    pooling = threading.Lock()
+    latencies = {}
+
+    # Pages of listings fetched at once, ahead of whoever's iterating
+
+    per_page = 100
+    pages = 4
+    pager = None
 
     @classmethod
     def ssh(cls, name):
@@ -61,7 +146,7 @@ class GitHub:
         subprocess.check_output(f"chmod 600 /root/.ssh/github_{name}.key", shell=True)
 
     @classmethod
-    def config(cls):
+    def config(cls, redis=None):
         """
         Sets up a keys and such.
         """
@@ -74,9 +159,246 @@ class GitHub:
                 cls.creds[name] = json.load(creds_file)
                 cls.creds[name].setdefault("url", "https://api.github.com")
                 cls.creds[name].setdefault("host", "github.com")
+                cls.creds[name].setdefault("legacy", False)
 
             cls.ssh(name)
 
+        cls.mirror = os.environ.get("MIRROR")
+        cls.budget = int(os.environ.get("MIRROR_BUDGET", 0)) * 1024 * 1024
+        cls.local = os.environ.get("LOCAL", "read")
+
+        cls.capacity = int(os.environ.get("GITHUB_CACHE", 1024))
+        cls.share = os.environ.get("GITHUB_SHARE") == "true"
+
+        cls.retries = int(os.environ.get("GITHUB_RETRIES", 3))
+        cls.wait = int(os.environ.get("GITHUB_WAIT", 60*60))
+
+        cls.pool = int(os.environ.get("GITHUB_POOL", 10))
+        cls.timeout = float(os.environ.get("GITHUB_TIMEOUT", 30))
+        cls.backoff = float(os.environ.get("GITHUB_BACKOFF", 0.5))
+
+        cls.pages = int(os.environ.get("GITHUB_PAGES", 4))
+        cls.pager = concurrent.futures.ThreadPoolExecutor(max_workers=cls.pages)
+
+        cls.redis = redis
+
+        if redis is not None:
+            cls.taking = redis.register_script(TAKE)
+
+    @staticmethod
+    def link(source, destination):
+        """
+        Hard links a file, copying if we can't, like across devices
+        """
+
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
+
+    @staticmethod
+    def size(path):
+        """
+        Total bytes used by a directory
+        """
+
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path) for name in names
+            if not os.path.islink(os.path.join(root, name))
+        )
+
+    @classmethod
+    def evict(cls):
+        """
+        Removes least recently used mirrors until we're under budget
+        """
+
+        if not cls.budget:
+            return
+
+        mirrors = {mirror: cls.size(mirror) for mirror in glob.glob(f"{cls.mirror}/*/*/*.git")}
+        total = sum(mirrors.values())
+
+        for mirror in sorted(mirrors, key=os.path.getmtime):
+
+            if total <= cls.budget:
+                break
+
+            # Never pull a mirror out from under a CnC that might still reference it
+
+            if time.time() - os.path.getmtime(mirror) < cls.grace:
+                continue
+
+            with open(f"{mirror}.lock", "w") as lock_file:
+
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                print(f"evicting {mirror}")
+                shutil.rmtree(mirror, ignore_errors=True)
+                total -= mirrors[mirror]
+
+    @classmethod
+    def recall(cls, key):
+        """
+        Gets a cached response, from memory, then Redis if sharing
+        """
+
+        with cls.caching:
+            if key in cls.cache:
+                cls.cache.move_to_end(key)
+                return cls.cache[key]
+
+        if cls.share and cls.redis is not None:
+
+            shared = cls.redis.get(f"/github/cache/{key}")
+
+            if shared:
+                cached = json.loads(shared)
+                cls.remember(key, cached)
+                return cached
+
+        return None
+
+    @classmethod
+    def remember(cls, key, cached, share=False):
+        """
+        Caches a response in memory, and Redis if sharing
+        """
+
+        with cls.caching:
+
+            cls.cache[key] = cached
+            cls.cache.move_to_end(key)
+
+            while len(cls.cache) > cls.capacity:
+                cls.cache.popitem(last=False)
+
+        if share and cls.share and cls.redis is not None:
+            cls.redis.set(f"/github/cache/{key}", json.dumps(cached), ex=cls.ttl)
+
+    @classmethod
+    def take(cls, name):
+        """
+        Takes a request from a creds' budget, returning how long to wait if there's none left
+        """
+
+        now = int(time.time())
+
+        if cls.taking is not None:
+            return int(cls.taking(keys=[f"/github/budget/{name}"], args=[now]))
+
+        with cls.budgeting:
+
+            budget = cls.budgets.get(name)
+
+            if budget is None or budget["reset"] <= now:
+                return 0
+
+            if budget["remaining"] > 0:
+                budget["remaining"] -= 1
+                return 0
+
+            return budget["reset"] - now
+
+    @classmethod
+    def refill(cls, name, response):
+        """
+        Refills a creds' budget from what GitHub says is left
+        """
+
+        if "X-RateLimit-Remaining" not in response.headers or "X-RateLimit-Reset" not in response.headers:
+            return
+
+        budget = {
+            "remaining": int(response.headers["X-RateLimit-Remaining"]),
+            "reset": int(response.headers["X-RateLimit-Reset"])
+        }
+
+        if cls.redis is not None:
+            pipeline = cls.redis.pipeline()
+            pipeline.hset(f"/github/budget/{name}", mapping=budget)
+            pipeline.expireat(f"/github/budget/{name}", budget["reset"] + 60)
+            pipeline.sadd("/github/creds", name)
+            pipeline.execute()
+        else:
+            with cls.budgeting:
+                cls.budgets[name] = budget
+
+    @classmethod
+    def pooled(cls, name, url):
+        """
+        Gets the keep alive session for creds and a url, creating if needed,
+        which retries transient failures of everything but POSTs
+        """
+
+        with cls.pooling:
+
+            if (name, url) not in cls.sessions:
+
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=cls.pool,
+                    pool_maxsize=cls.pool,
+                    max_retries=urllib3.util.retry.Retry(
+                        total=cls.retries,
+                        backoff_factor=cls.backoff,
+                        status_forcelist=[500, 502, 503, 504],
+                        raise_on_status=False
+                    )
+                )
+
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+
+                creds = cls.creds[name]
+                session.auth = (creds["user"], creds["token"])
+
+                cls.sessions[(name, url)] = session
+
+            return cls.sessions[(name, url)]
+
+    @classmethod
+    def measure(cls, name, method, seconds):
+        """
+        Counts a call's latency in its bucket, in Redis so all workers add up
+        """
+
+        bucket = next((str(bound) for bound in BUCKETS if seconds <= bound), "+Inf")
+
+        if cls.redis is not None:
+            pipeline = cls.redis.pipeline()
+            pipeline.hincrby(f"/github/latency/{name}", f"{method} {bucket}", 1)
+            pipeline.hincrbyfloat(f"/github/latency/{name}", f"{method} sum", seconds)
+            pipeline.sadd("/github/creds", name)
+            pipeline.execute()
+            return
+
+        with cls.budgeting:
+            latency = cls.latencies.setdefault(name, {})
+            latency[f"{method} {bucket}"] = latency.get(f"{method} {bucket}", 0) + 1
+            latency[f"{method} sum"] = latency.get(f"{method} sum", 0) + seconds
+
+    @staticmethod
+    def delay(response):
+        """
+        How long GitHub wants us to back off, if it's a rate limit at all
+        """
+
+        if response.status_code not in [403, 429]:
+            return None
+
+        if "Retry-After" in response.headers:
+            return int(response.headers["Retry-After"])
+
+        if response.headers.get("X-RateLimit-Remaining") == "0" and "X-RateLimit-Reset" in response.headers:
+            return max(int(response.headers["X-RateLimit-Reset"]) - int(time.time()), 1)
+
+        return None
+
     data = None
 
     def __init__(self, cnc, data):
@@ -91,8 +413,8 @@ class GitHub:
         self.user = creds['user']
         self.host = creds["host"]
         self.url = creds["url"]
-        self.api = requests.Session()
-        self.api.auth = (self.user, creds['token'])
+        self.legacy = creds.get("legacy", False)
+        self.api = self.pooled(self.data["creds"], self.url)
 
         if isinstance(self.data["repo"], str):
 
@@ -129,34 +451,198 @@ class GitHub:
             if isinstance(self.data["labels"], str):
                 self.data["labels"] = [self.data["labels"]]
 
+    def key(self, path, params=None):
+        """
+        What to cache a GET under, by creds and everything requested
+        """
+
+        return hashlib.sha256(json.dumps([self.user, self.url, path, params], sort_keys=True).encode()).hexdigest()
+
     def request(self, method, path, params=None, json=None):
         """
         Performs a request and return the JSON
         """
 
-        response = self.api.request(method, f"{self.url}/{path}", params=params, json=json)
+        return self.fetch(method, path, params, json)[0]
+
+    def send(self, method, path, params, json, headers):
+        """
+        Sends a request once, counting it on the CnC so we can see what each
+        costs, measuring how long it took, and refilling the budget from it
+        """
+
+        with self.counting:
+            counts = self.cnc.data.setdefault("requests", {})
+            counts[self.host] = counts.get(self.host, 0) + 1
+
+        start = time.time()
+        response = self.api.request(method, f"{self.url}/{path}", params=params, json=json, headers=headers, timeout=self.timeout)
+        self.measure(self.data["creds"], method, time.time() - start)
+
+        self.refill(self.data["creds"], response)
+
+        return response
+
+    def fetch(self, method, path, params=None, json=None):
+        """
+        Performs a request and return the JSON and Link header, only getting
+        what's changed since last time for GETs we've cached
+        """
+
+        caching = method == "GET" and self.capacity > 0
+        cached = None
+        headers = {}
+
+        if caching:
+
+            key = self.key(path, params)
+            cached = self.recall(key)
+
+            if cached is not None:
+
+                if cached.get("etag"):
+                    headers["If-None-Match"] = cached["etag"]
+
+                if cached.get("modified"):
+                    headers["If-Modified-Since"] = cached["modified"]
+
+        # Pace against the budget, and back off and try again if we hit a limit anyway
+
+        for attempt in range(self.retries + 1):
+
+            wait = self.take(self.data["creds"])
+
+            if wait > 0:
+                print(f"waiting {wait}s for {self.data['creds']} rate limit")
+                time.sleep(min(wait, self.wait))
+
+            response = self.send(method, path, params, json, headers)
+
+            delay = self.delay(response)
+
+            if delay is None or attempt == self.retries:
+                break
+
+            print(f"rate limited, retrying {path} in {delay}s")
+            time.sleep(min(delay, self.wait))
+
+        # Unchanged, which doesn't count against the rate limit
+
+        if cached is not None and response.status_code == 304:
+            return cached["body"], cached.get("link")
 
         response.raise_for_status()
 
-        return response.json()
+        body = response.json()
+
+        if caching and (response.headers.get("ETag") or response.headers.get("Last-Modified")):
+            self.remember(key, {
+                "etag": response.headers.get("ETag"),
+                "modified": response.headers.get("Last-Modified"),
+                "link": response.headers.get("Link"),
+                "body": body
+            }, share=True)
+
+        return body, response.headers.get("Link")
+
+    def lookup(self, path, params=None):
+        """
+        Gets a single thing, None if it's not there
+        """
+
+        try:
+            return self.request("GET", path, params)
+        except requests.exceptions.HTTPError as exception:
+            if exception.response is not None and exception.response.status_code == 404:
+                return None
+            raise
+
+    @staticmethod
+    def paging(link):
+        """
+        The pages in a Link header, by rel, like next and last
+        """
+
+        pages = {}
+
+        for linked in requests.utils.parse_header_links(link or ""):
+
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(linked.get("url", "")).query)
+
+            if "rel" in linked and "page" in query:
+                pages[linked["rel"]] = int(query["page"][0])
+
+        return pages
 
     def iterate(self, path, params=None, json=None):
         """
-        Iterate through all results
+        Iterate through all results, fetching pages ahead all at once if we
+        know how many there are, while still stopping when the caller does
+        """
+
+        params = {**(params or {}), "per_page": self.per_page, "page": 1}
+
+        results, link = self.fetch("GET", path, params, json)
+
+        yield from results
+
+        pages = self.paging(link)
+
+        # Without a last page, go one at a time, and without any links, until a page isn't full
+
+        if "last" not in pages or self.pager is None or self.pages < 2:
+
+            page = 2
+
+            while "next" in pages or (not link and len(results) == self.per_page):
+                results, link = self.fetch("GET", path, {**params, "page": page}, json)
+                yield from results
+                pages = self.paging(link)
+                page += 1
+
+            return
+
+        pending = collections.deque()
+        page = 2
+
+        try:
+
+            while page <= pages["last"] or pending:
+
+                while page <= pages["last"] and len(pending) < self.pages:
+                    pending.append(self.pager.submit(self.fetch, "GET", path, {**params, "page": page}, json))
+                    page += 1
+
+                yield from pending.popleft().result()[0]
+
+        finally:
+
+            for future in pending:
+                future.cancel()
+
+    def retry(self, action, *args, **kwargs):
+        """
+        Does an action again if it failed on something transient, only for
+        actions that check what exists before creating, so they're safe to redo
         """
 
-        if params is None:
-            params = {}
+        for attempt in range(self.retries):
 
-        params["page"] = 1
+            try:
+                return action(*args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as exception:
 
-        results = self.request("GET", path, params, json)
+                if isinstance(exception, requests.exceptions.HTTPError) and (
+                    exception.response is None or exception.response.status_code < 500
+                ):
+                    raise
 
-        while results:
-            for result in results:
-                yield result
-            params = {**params, "page": params["page"] + 1}
-            results = self.request("GET", path, params, json)
+                print(f"retrying {action.__name__}: {exception}")
+                time.sleep(self.backoff * 2 ** attempt)
+
+        # Last try, whatever happens happens
+
+        return action(*args, **kwargs)
 
     def repo(self, ensure=True):
         """
@@ -165,15 +651,16 @@ class GitHub:
 
         # First make sure the repo exists
 
-        found = False
+        if self.legacy:
+            found = next((exists for exists in self.iterate("user/repos") if exists["full_name"] == self.data["path"]), None)
+        else:
+            found = self.lookup(f"repos/{self.data['path']}")
 
-        for exists in self.iterate("user/repos"):
+        if found:
 
-            if exists["full_name"] == self.data["path"]:
-                self.data["default"] = exists["default_branch"]
-                found = True
+            self.data["default"] = found["default_branch"]
 
-        if not found:
+        else:
 
             if not ensure:
                 return False
@@ -227,9 +714,11 @@ class GitHub:
         Ensure a branch exists
         """
 
-        for exists in self.iterate(f"repos/{self.data['path']}/branches"):
-            if exists["name"] == branch:
+        if self.legacy:
+            if any(exists["name"] == branch for exists in self.iterate(f"repos/{self.data['path']}/branches")):
                 return
+        elif self.lookup(f"repos/{self.data['path']}/git/ref/heads/{branch}") is not None:
+            return
 
         sha = self.request("GET", f"repos/{self.data['path']}/git/refs/heads/{base}")["object"]["sha"]
 
@@ -247,7 +736,14 @@ class GitHub:
         Ensures a pull request exists, including the need branches
         """
 
-        for exists in self.iterate(f"repos/{self.data['path']}/pulls"):
+        params = {"head": f"{self.data['path'].split('/')[0]}:{self.data['branch']}"}
+
+        if self.legacy:
+            pulls = self.iterate(f"repos/{self.data['path']}/pulls", params)
+        else:
+            pulls = self.request("GET", f"repos/{self.data['path']}/pulls", params)
+
+        for exists in pulls:
             if exists["head"]["ref"] == self.data['branch']:
                 self.data["url"] = exists["html_url"]
                 return
@@ -302,44 +798,141 @@ class GitHub:
 
         self.request("POST", f"repos/{self.data['path']}/issues/{number}/labels", json={"labels": self.data["labels"]})
 
-    def change(self):
+    def mirrored(self):
         """
-        Clones a repo for a change block
+        Ensures an up to date bare mirror of the repo and returns its path
         """
 
-        # If this is the same as the last repo/branch, just repo it again
+        mirror = f"{self.mirror}/{self.host}/{self.data['path']}.git"
+
+        os.makedirs(os.path.dirname(mirror), exist_ok=True)
+
+        # Lock so only one worker fetches a repo at a time
+
+        with open(f"{mirror}.lock", "w") as lock_file:
+
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if os.path.exists(mirror):
+                print(subprocess.check_output("git fetch --prune origin", shell=True, cwd=mirror))
+            else:
+                print(subprocess.check_output(f"git clone --mirror git@{self.host}:{self.data['path']}.git {mirror}", shell=True))
+
+            os.utime(mirror)
 
-        if self.cnc.data.get("change") == self.data:
+        self.evict()
+
+        return mirror
+
+    def clone(self, directory, branch=None, sparse=None):
+        """
+        Clones the repo into a directory, borrowing objects from a mirror if we have one,
+        and only fetching the latest (shallow) or just what's needed (sparse) if asked
+        """
+
+        self.cnc.check()
+
+        checkout = self.data.get("checkout", "full")
+
+        options = f"--reference {self.mirrored()} --dissociate " if self.mirror else ""
+
+        if checkout != "full":
+            options += "--depth 1 --filter=blob:none --no-checkout "
+            if branch:
+                options += f"--branch {branch} "
+
+        print(subprocess.check_output(f"git clone {options}git@{self.host}:{self.data['path']}.git {directory}", shell=True))
+
+        if checkout == "full":
+            if branch:
+                print(subprocess.check_output(f"git checkout {branch}", shell=True, cwd=directory))
             return
 
+        if checkout == "sparse" and sparse is not None:
+            self.sparsen(directory, sparse)
+            return
+
+        # Only now fetch and write the blobs we need
+
+        print(subprocess.check_output("git read-tree -mu HEAD", shell=True, cwd=directory))
+
+    @staticmethod
+    def sparsen(directory, sparse):
+        """
+        Sets the sparse checkout patterns of a clone and updates the files to match
+        """
+
+        print(subprocess.check_output("git config core.sparseCheckout true", shell=True, cwd=directory))
+
+        with open(f"{directory}/.git/info/sparse-checkout", "w") as sparse_file:
+            sparse_file.write("".join(f"{pattern}\n" for pattern in sparse))
+
+        print(subprocess.check_output("git read-tree -mu HEAD", shell=True, cwd=directory))
+
+    def change(self, sparse=None):
+        """
+        Clones a repo for a change block, reusing it if this CnC already has
+        """
+
         self.cnc.data["change"] = self.data
 
-        os.chdir(self.cnc.base())
+        checkout = self.data.get("checkout", "full")
+        key = (self.host, self.data["path"], self.data.get("branch"), checkout)
+
+        # If we already have this repo/branch, make sure it has everything we need
+
+        if key in self.cnc.sources:
+
+            source = self.cnc.sources[key]
+
+            if source["sparse"] is not None and (sparse is None or not set(sparse) <= set(source["sparse"])):
+                if sparse is None:
+                    source["sparse"] = None
+                else:
+                    source["sparse"] = source["sparse"] + [pattern for pattern in sparse if pattern not in source["sparse"]]
+                self.sparsen(source["directory"], ["/*"] if source["sparse"] is None else source["sparse"])
+
+            self.cnc.sourcing = source["directory"]
 
-        source = f"{self.cnc.base()}/source"
+            return
+
+        source = {
+            "directory": f"{self.cnc.base()}/source-{len(self.cnc.sources)}",
+            "sparse": None
+        }
+
+        local = f"/opt/service/repo/{self.data['path']}"
+
+        if not os.path.exists(local):
+
+            shutil.rmtree(source["directory"], ignore_errors=True)
+
+            self.clone(source["directory"], self.data.get("branch"), sparse)
 
-        shutil.rmtree(source, ignore_errors=True)
+            if checkout == "sparse":
+                source["sparse"] = sparse
 
-        if os.path.exists(f"/opt/service/repo/{self.data['path']}"):
+        elif self.local == "read":
 
-            print(f"copying repo/{self.data['path']}")
-            shutil.copytree(f"/opt/service/repo/{self.data['path']}", source)
+            # Sources are only ever read, so there's no need to copy
+
+            print(f"reading repo/{self.data['path']}")
+            source["directory"] = local
 
         else:
 
-            print(subprocess.check_output(f"git clone git@{self.host}:{self.data['path']}.git source", shell=True))
+            print(f"{'linking' if self.local == 'link' else 'copying'} repo/{self.data['path']}")
+            shutil.rmtree(source["directory"], ignore_errors=True)
+            shutil.copytree(local, source["directory"], copy_function=self.link if self.local == "link" else shutil.copy2)
 
-            if "branch" in self.data:
-                os.chdir(source)
-                print(subprocess.check_output(f"git checkout {self.data['branch']}", shell=True))
+        self.cnc.sources[key] = source
+        self.cnc.sourcing = source["directory"]
 
-    def code(self):
+    def code(self, sparse=None):
         """
         Clones a repo for a code block unless we're testing, then just creates a directory
         """
 
-        os.chdir(self.cnc.base())
-
         destination = f"{self.cnc.base()}/destination"
 
         shutil.rmtree(destination, ignore_errors=True)
@@ -353,25 +946,21 @@ class GitHub:
 
         # If we're testing and the repo doesn't exists, just make the directory
 
-        if not self.repo(ensure=not self.cnc.data["action"] == "test"):
+        if not self.retry(self.repo, ensure=not self.cnc.data["action"] == "test"):
             os.makedirs(destination)
             return
 
         # Make sure hooks are there
 
         if not self.cnc.data["action"] == "test":
-            self.hook()
+            self.retry(self.hook)
 
         # Make sure we have all the branches we need
 
-        self.branch(self.data["base"], self.data['default'])
-        self.branch(self.data["branch"], self.data['base'])
-
-        print(subprocess.check_output(f"git clone git@{self.host}:{self.data['path']}.git destination", shell=True))
-
-        os.chdir(destination)
+        self.retry(self.branch, self.data["base"], self.data['default'])
+        self.retry(self.branch, self.data["branch"], self.data['base'])
 
-        print(subprocess.check_output(f"git checkout {self.data['branch']}", shell=True))
+        self.clone(destination, self.data['branch'], sparse)
 
     def commit(self):
         """
@@ -380,8 +969,6 @@ class GitHub:
 
         destination = f"{self.cnc.base()}/destination"
 
-        os.chdir(destination)
-
         # If we're testing, move a code-# dir
 
         if self.cnc.data["action"] == "test":
@@ -395,18 +982,22 @@ class GitHub:
 
             return
 
-        print(subprocess.check_output("git add .", shell=True))
+        print(subprocess.check_output("git add .", shell=True, cwd=destination))
 
-        if b"Changes to be committed" in subprocess.check_output("git status", shell=True):
+        if b"Changes to be committed" in subprocess.check_output("git status", shell=True, cwd=destination):
 
             message = f"{self.data['prefix']}: {self.cnc.data['id']}" if "prefix" in self.data else self.cnc.data["id"]
 
-            print(subprocess.check_output(f"git commit -am '{message}'", shell=True))
+            print(subprocess.check_output(f"git commit -am '{message}'", shell=True, cwd=destination))
+
+            self.cnc.check()
 
-            print(subprocess.check_output("git push origin", shell=True))
+            print(subprocess.check_output("git push origin", shell=True, cwd=destination))
 
         # Make sure there's a pull request
 
-        self.pull_request()
-        self.comment()
-        self.labels()
+        self.cnc.check()
+
+        self.retry(self.pull_request)
+        self.retry(self.comment)
+        self.retry(self.labels)
@@ -5,52 +5,304 @@ Main module for daemon
 import os
 import json
 import time
+import socket
+import threading
 import traceback
+import multiprocessing
 
 import redis
 
 import cnc
 import github
 
-class Daemon:
+QUEUE = "/queue/cnc"
+PROCESSING = "/queue/cnc/processing"
+LEASE = "/lease/cnc"
+INDEX = "/index/cnc"
+STATUS = "/status/cnc"
+
+STATUSES = [
+    "Created",
+    "Retry",
+    "Completed",
+    "Error"
+]
+
+# What's kept in a CnC's status hash, away from its bulky definition
+
+HOT = [
+    "status",
+    "error",
+    "links",
+    "progress",
+    "timings"
+]
+
+# Only extend or release a lease if we still hold it
+
+RENEW = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# Only write a finished CnC, its status hash, and index if we still hold its
+# lease, all in one step so a new holder never has its work clobbered
+
+FINISH = """
+if redis.call("get", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call("set", KEYS[2], ARGV[2], "EX", ARGV[3])
+for field, value in pairs(cjson.decode(ARGV[4])) do
+    redis.call("hset", KEYS[3], field, value)
+end
+redis.call("expire", KEYS[3], ARGV[3])
+for index = 5, #KEYS do
+    redis.call("zrem", KEYS[index], ARGV[5])
+end
+redis.call("zadd", KEYS[4], ARGV[6], ARGV[5])
+return 1
+"""
+
+class Daemon: # pylint: disable=too-many-instance-attributes
     """
-    Main class for daemon
+    Main class for daemon, holding its settings, connection, and lease scripts
     """
 
     def __init__(self):
 
         self.sleep = int(os.environ['SLEEP'])
+        self.workers = int(os.environ.get('WORKERS', 1))
+        self.mode = os.environ.get('MODE', 'process')
+        self.lease = int(os.environ.get('LEASE', 60))
 
         self.redis = redis.Redis(host="redis.cnc-forge", charset="utf-8", decode_responses=True)
 
-        github.GitHub.config()
+        self.renew = self.redis.register_script(RENEW)
+        self.release = self.redis.register_script(RELEASE)
+        self.finished = self.redis.register_script(FINISH)
 
-    def process(self):
+        self.reclaimed = 0
+
+        github.GitHub.config(self.redis)
+
+    @staticmethod
+    def worker():
         """
-        Processes all the routines for reminding
+        Name of this worker, unique across pods, processes, and threads
         """
 
-        for key in self.redis.keys("/cnc/*"):
+        return f"{socket.gethostname()}/{os.getpid()}/{threading.get_ident()}"
+
+    def recover(self):
+        """
+        Queues anything orphaned or waiting from before queueing
+        """
+
+        self.reclaim()
+
+        # Anything created before there was a queue gets queued
+
+        for key in self.redis.scan_iter("/cnc/*"):
 
             data = json.loads(self.redis.get(key))
 
-            if data["status"] not in ["Created", "Retry"]:
+            if data["status"] in ["Created", "Retry"]:
+                self.redis.lpush(QUEUE, key.split("/")[-1])
+
+    def reclaim(self):
+        """
+        Requeues anything popped by a worker whose lease is gone
+        """
+
+        self.reclaimed = time.time()
+
+        for cnc_id in self.redis.lrange(PROCESSING, 0, -1):
+
+            if self.redis.exists(f"{LEASE}/{cnc_id}"):
                 continue
 
+            # Only requeue if we're the one who removed it
+
+            if self.redis.lrem(PROCESSING, 1, cnc_id):
+                self.redis.lpush(QUEUE, cnc_id)
+
+    def renewing(self, cnc_id, worker, done, lost):
+        """
+        Keeps renewing a lease until done, setting lost if it can't, either
+        because someone else has it or Redis has been unreachable so long
+        the lease has run out
+        """
+
+        renewed = time.time()
+
+        while not done.wait(self.lease / 3):
+
+            try:
+                if not self.renew(keys=[f"{LEASE}/{cnc_id}"], args=[worker, self.lease]):
+                    print(f"lost lease on {cnc_id}")
+                    lost.set()
+                    return
+                renewed = time.time()
+            except redis.exceptions.RedisError as exception:
+                print(f"failed to renew lease on {cnc_id}: {exception}")
+                if time.time() - renewed >= self.lease:
+                    print(f"lost lease on {cnc_id}")
+                    lost.set()
+                    return
+
+    def report(self, cnc_id, fields, lost):
+        """
+        Writes just the status fields that changed to a CnC's status hash,
+        unless the lease is lost and they're someone else's to write
+        """
+
+        if lost.is_set():
+            return
+
+        self.redis.hset(f"{STATUS}/{cnc_id}", mapping={field: json.dumps(value) for field, value in fields.items()})
+
+    @staticmethod
+    def score(cnc_id):
+        """
+        Where a CnC goes in the API's listing, by the timestamp ending its id
+        """
+
+        try:
+            return int(cnc_id.rsplit("-", 1)[-1])
+        except ValueError:
+            return int(time.time())
+
+    def finish(self, cnc_id, worker, data):
+        """
+        Writes a processed CnC, its status hash, and moves it to its status
+        index, but only if we still hold its lease
+        """
+
+        status = data["status"]
+
+        return self.finished(
+            keys=[f"{LEASE}/{cnc_id}", f"/cnc/{cnc_id}", f"{STATUS}/{cnc_id}", f"{INDEX}/status/{status}"] +
+                 [f"{INDEX}/status/{other}" for other in STATUSES if other != status],
+            args=[
+                worker,
+                json.dumps(data),
+                24*60*60,
+                json.dumps({field: json.dumps(data[field]) for field in HOT if field in data}),
+                cnc_id,
+                self.score(cnc_id)
+            ]
+        )
+
+    def process(self):
+        """
+        Waits for a queued CnC, leases, and processes it
+        """
+
+        if time.time() - self.reclaimed > self.lease:
+            self.reclaim()
+
+        cnc_id = self.redis.brpoplpush(QUEUE, PROCESSING, self.sleep)
+
+        if cnc_id is None:
+            return
+
+        key = f"/cnc/{cnc_id}"
+        worker = self.worker()
+
+        # If someone else has it, they'll finish it, so just drop our copy
+
+        if self.redis.set(f"{LEASE}/{cnc_id}", worker, nx=True, ex=self.lease):
+
+            done = threading.Event()
+            lost = threading.Event()
+            renewer = threading.Thread(target=self.renewing, args=(cnc_id, worker, done, lost), daemon=True)
+            renewer.start()
+
             try:
-                cnc.CnC(data).process()
-            except Exception as exception:
-                data["status"] = "Error"
-                data["error"] = str(exception)
-                data["traceback"] = traceback.format_exc()
 
-            self.redis.set(key, json.dumps(data), ex=24*60*60)
+                data = self.redis.get(key)
+
+                if data is not None:
+
+                    data = json.loads(data)
+
+                    if data["status"] in ["Created", "Retry"]:
+
+                        timings = {**data.get("timings", {}), "started": time.time()}
+                        self.report(cnc_id, {"timings": timings}, lost)
+
+                        try:
+                            cnc.CnC(data, lambda fields: self.report(cnc_id, fields, lost), lost).process()
+                        except Exception as exception:
+                            data["status"] = "Error"
+                            data["error"] = str(exception)
+                            data["traceback"] = traceback.format_exc()
+
+                        data["timings"] = {**timings, "finished": time.time()}
+
+                        if not self.finish(cnc_id, worker, data):
+                            print(f"lost lease on {cnc_id}, not saving")
+
+            finally:
+
+                done.set()
+                renewer.join()
+                self.release(keys=[f"{LEASE}/{cnc_id}"], args=[worker])
+
+        self.redis.lrem(PROCESSING, 1, cnc_id)
+
+    def work(self):
+        """
+        Processes forever
+        """
+
+        while True:
+            self.process()
+
+    def spawn(self):
+        """
+        Starts a worker process or thread
+        """
+
+        if self.mode == "thread":
+            worker = threading.Thread(target=self.work, daemon=True)
+        else:
+            worker = multiprocessing.Process(target=self.work, daemon=True)
+
+        worker.start()
+
+        return worker
 
     def run(self):
         """
         Runs the daemon
         """
 
+        self.recover()
+
+        if self.workers == 1:
+            self.work()
+            return
+
+        workers = [self.spawn() for _ in range(self.workers)]
+
+        # Replace any worker that dies, its lease will expire and be reclaimed
+
         while True:
-            self.process()
+
+            for index, worker in enumerate(workers):
+                if not worker.is_alive():
+                    print(f"worker {worker.name} exited")
+                    workers[index] = self.spawn()
+
             time.sleep(self.sleep)
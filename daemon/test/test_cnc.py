@@ -1,12 +1,94 @@
 import unittest
 import unittest.mock
 
+import os
 import json
 import yaml
+import hashlib
+import tempfile
+import threading
 
 import cnc
 import jinja2
 
+class TestEnvironment(unittest.TestCase):
+
+    def test___init__(self):
+
+        env = cnc.Environment(size=2, keep_trailing_newline=True)
+
+        self.assertEqual(env.size, 2)
+        self.assertEqual(env.compiled, {})
+        self.assertIsNone(env.bytecode_cache)
+        self.assertTrue(env.keep_trailing_newline)
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            env = cnc.Environment(bytecode=f"{directory}/bytecode")
+
+            self.assertIsInstance(env.bytecode_cache, jinja2.FileSystemBytecodeCache)
+            self.assertTrue(os.path.isdir(f"{directory}/bytecode"))
+
+    def test_compiling(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            env = cnc.Environment(bytecode=directory)
+            env.compile = unittest.mock.MagicMock(side_effect=jinja2.Environment().compile)
+
+            env.compiling("{{ a }}", "a")
+            env.compiling("{{ a }}", "a")
+
+            env.compile.assert_called_once_with("{{ a }}")
+
+            # each template has its own bucket
+
+            sources = ["{{ a }}", "{{ b }}", "{{ a }}-{{ b }}"]
+
+            env.compile.reset_mock()
+
+            for source in sources:
+                env.from_string(source)
+
+            self.assertEqual(env.compile.call_count, 3)
+
+            # another process can use what's on disk
+
+            other = cnc.Environment(bytecode=directory)
+            other.compile = unittest.mock.MagicMock()
+
+            self.assertEqual([other.from_string(source).render(a=1, b=2) for source in sources], ["1", "2", "1-2"])
+
+            other.compile.assert_not_called()
+
+    def test_from_string(self):
+
+        env = cnc.Environment(size=2)
+        env.compile = unittest.mock.MagicMock(side_effect=jinja2.Environment().compile)
+
+        self.assertEqual(env.from_string("{{ a }}").render(a=1), "1")
+        self.assertEqual(env.from_string("{{ a }}").render(a=2), "2")
+
+        self.assertEqual(env.compile.call_count, 1)
+        self.assertEqual((env.hits, env.misses), (1, 1))
+
+        # least recently used goes
+
+        env.from_string("{{ b }}")
+        env.from_string("{{ a }}")
+        env.from_string("{{ c }}")
+
+        self.assertEqual(len(env.compiled), 2)
+
+        env.from_string("{{ a }}")
+        env.from_string("{{ b }}")
+
+        self.assertEqual(env.compile.call_count, 4)
+
+        # globals still work
+
+        self.assertEqual(env.from_string("{{ a }}", globals={"a": 3}).render(), "3")
+
 class TestCnC(unittest.TestCase):
 
     def setUp(self):
@@ -17,7 +99,29 @@ class TestCnC(unittest.TestCase):
 
         init = cnc.CnC({})
         self.assertEqual(init.data, {})
+        self.assertIsNone(init.report)
+        self.assertIsNone(init.lost)
         self.assertTrue(init.engine.env.keep_trailing_newline)
+        self.assertEqual(init.engine.env, cnc.CnC({}).engine.env)
+        self.assertEqual(init.sources, {})
+        self.assertEqual(init.crafters, 1)
+        self.assertIsNone(init.crafting)
+        self.assertEqual(init.sourcing, "source")
+
+    @unittest.mock.patch.dict(os.environ, {
+        "TEMPLATES": "7"
+    })
+    @unittest.mock.patch("cnc.CnC.env", None)
+    def test_environment(self):
+
+        env = cnc.CnC.environment()
+
+        self.assertIsInstance(env, cnc.Environment)
+        self.assertEqual(env.size, 7)
+        self.assertIsNone(env.bytecode_cache)
+        self.assertTrue(env.keep_trailing_newline)
+
+        self.assertEqual(cnc.CnC.environment(), env)
 
     def test_placing(self):
 
@@ -55,9 +159,24 @@ class TestCnC(unittest.TestCase):
 
         self.assertEqual(self.cnc.base(), "/opt/service/cnc/sweat")
 
+    def test_root(self):
+
+        self.assertEqual(self.cnc.root("source"), "/opt/service/cnc/sweat/source")
+        self.assertEqual(self.cnc.root("destination"), "/opt/service/cnc/sweat/destination")
+
+        self.cnc.sourcing = "/opt/service/repo/my/stuff"
+
+        self.assertEqual(self.cnc.root("source"), "/opt/service/repo/my/stuff")
+
     def test_relative(self):
 
         self.assertEqual(self.cnc.relative("/opt/service/cnc/sweat/source/a/b/c"), "a/b/c")
+        self.assertEqual(self.cnc.relative("/opt/service/cnc/sweat/destination/a/b/c"), "a/b/c")
+
+        self.cnc.sourcing = "/opt/service/repo/my/stuff"
+
+        self.assertEqual(self.cnc.relative("/opt/service/repo/my/stuff/a/b/c"), "a/b/c")
+        self.assertEqual(self.cnc.relative("/opt/service/repo/my/stuff"), "")
 
     @unittest.mock.patch("cnc.open", create=True)
     def test_source(self, mock_open):
@@ -76,6 +195,12 @@ class TestCnC(unittest.TestCase):
 
         mock_open.assert_called_once_with("/opt/service/cnc/sweat/source/stuff", "r")
 
+        self.cnc.sourcing = "source-1"
+
+        self.assertEqual(self.cnc.source({"source": "stuff"}, path=True), "/opt/service/cnc/sweat/source-1/stuff")
+        self.assertEqual(self.cnc.source({"source": ""}, path=True), "/opt/service/cnc/sweat/source-1")
+        self.assertRaisesRegex(Exception, "invalid path: ..", self.cnc.source, {"source": "../source-10/stuff"})
+
     @unittest.mock.patch("cnc.open", create=True)
     @unittest.mock.patch("os.path.exists")
     def test_destination(self, mock_exists, mock_open):
@@ -114,10 +239,54 @@ class TestCnC(unittest.TestCase):
 
         mock_open.assert_not_called()
 
+        # unchanged
+
+        mock_exists.return_value = False
+        self.cnc.unchanged = unittest.mock.MagicMock(return_value=True)
+
+        self.cnc.destination({"destination": "things"}, "dest")
+
+        mock_open.assert_not_called()
+        self.cnc.unchanged.assert_called_once_with("/opt/service/cnc/sweat/destination/things", b"dest")
+
+    def test_digest(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            with open(f"{directory}/big", "wb") as big_file:
+                big_file.write(b"a" * (cnc.CHUNK + 7))
+
+            self.assertEqual(self.cnc.digest(f"{directory}/big"), hashlib.sha256(b"a" * (cnc.CHUNK + 7)).hexdigest())
+
+    def test_unchanged(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            self.assertFalse(self.cnc.unchanged(f"{directory}/nope", b"yep"))
+
+            with open(f"{directory}/dest", "wb") as dest_file:
+                dest_file.write(b"yep")
+
+            with open(f"{directory}/same", "wb") as same_file:
+                same_file.write(b"yep")
+
+            with open(f"{directory}/diff", "wb") as diff_file:
+                diff_file.write(b"yes")
+
+            self.assertTrue(self.cnc.unchanged(f"{directory}/dest", b"yep"))
+            self.assertFalse(self.cnc.unchanged(f"{directory}/dest", b"yes"))
+            self.assertFalse(self.cnc.unchanged(f"{directory}/dest", b"yeps"))
+
+            self.assertTrue(self.cnc.unchanged(f"{directory}/dest", source=f"{directory}/same"))
+            self.assertFalse(self.cnc.unchanged(f"{directory}/dest", source=f"{directory}/diff"))
+
     @unittest.mock.patch("os.path.exists")
     @unittest.mock.patch("shutil.copy")
     def test_copy(self, mock_copy, mock_exists):
 
+        self.cnc.unchanged = unittest.mock.MagicMock(return_value=False)
+        self.cnc.mode = unittest.mock.MagicMock()
+
         # no replace
 
         mock_exists.return_value = True
@@ -133,6 +302,20 @@ class TestCnC(unittest.TestCase):
             "/opt/service/cnc/sweat/destination/dest"
         )
 
+        self.cnc.unchanged.assert_called_once_with(
+            "/opt/service/cnc/sweat/destination/dest",
+            source="/opt/service/cnc/sweat/source/src"
+        )
+
+        # unchanged
+
+        self.cnc.unchanged.return_value = True
+
+        self.cnc.copy({"source": "src", "destination": "dest"})
+
+        mock_copy.assert_called_once()
+        self.cnc.mode.assert_called_once_with({"source": "src", "destination": "dest"})
+
     @unittest.mock.patch("os.path.exists")
     @unittest.mock.patch("os.path.isdir")
     @unittest.mock.patch("shutil.rmtree")
@@ -282,19 +465,32 @@ class TestCnC(unittest.TestCase):
     @unittest.mock.patch("os.stat")
     def test_mode(self, mock_stat, mock_mode):
 
-        mock_stat.return_value.st_mode = "ala"
+        def stat(path):
+            return unittest.mock.MagicMock(st_mode="ala" if path.endswith("src") else "carte")
+
+        mock_stat.side_effect = stat
 
         self.cnc.mode({"source": "src", "destination": "dest"})
 
-        mock_stat.assert_called_once_with(
-            "/opt/service/cnc/sweat/source/src"
-        )
+        mock_stat.assert_has_calls([
+            unittest.mock.call("/opt/service/cnc/sweat/source/src"),
+            unittest.mock.call("/opt/service/cnc/sweat/destination/dest")
+        ])
 
         mock_mode.assert_called_once_with(
             "/opt/service/cnc/sweat/destination/dest",
             "ala"
         )
 
+        # same
+
+        mock_stat.side_effect = None
+        mock_stat.return_value.st_mode = "ala"
+
+        self.cnc.mode({"source": "src", "destination": "dest"})
+
+        mock_mode.assert_called_once()
+
     @unittest.mock.patch("os.listdir")
     def test_directory(self, mock_listdir):
 
@@ -415,6 +611,7 @@ class TestCnC(unittest.TestCase):
             "transform": []
         }, None)
 
+    @unittest.mock.patch("cnc.CnC.unchanged", unittest.mock.MagicMock(return_value=False))
     @unittest.mock.patch("shutil.copy")
     @unittest.mock.patch("cnc.open", create=True)
     @unittest.mock.patch("os.chmod")
@@ -590,7 +787,7 @@ class TestCnC(unittest.TestCase):
             mock_write
         ]
 
-        mock_stat.return_value.st_mode = "ala"
+        mock_stat.side_effect = lambda path: unittest.mock.MagicMock(st_mode="ala" if "/source/" in path else "carte")
 
         content = {
             "source": "a/b/c",
@@ -605,7 +802,7 @@ class TestCnC(unittest.TestCase):
 
         mock_write.write.assert_called_once_with('yep')
 
-        mock_stat.assert_called_with(
+        mock_stat.assert_any_call(
             "/opt/service/cnc/sweat/source/a/b/c"
         )
 
@@ -689,6 +886,17 @@ class TestCnC(unittest.TestCase):
             "/opt/service/cnc/sweat/destination/a/b/c"
         )
 
+        # Parallel
+
+        self.cnc.crafting = []
+
+        self.cnc.craft(content, {"sure": "yep"})
+
+        self.assertEqual(self.cnc.crafting, [(content, {"sure": "yep"})])
+        mock_copy.assert_called_once()
+
+        self.cnc.crafting = None
+
         # Content
 
         mock_exists.side_effect = Exception("whoops")
@@ -851,6 +1059,120 @@ class TestCnC(unittest.TestCase):
             "transform": ["l"]
         }, {"start": "a/b"})
 
+        self.assertIsNone(self.cnc.crafting)
+
+        # parallel
+
+        self.cnc.crafters = 2
+        self.cnc.parallel = unittest.mock.MagicMock()
+
+        def craft(content, values):
+            self.cnc.crafting.append((content, values))
+
+        self.cnc.craft.side_effect = craft
+
+        self.cnc.content({"destination": "d"}, {"start": "a/b"})
+
+        self.cnc.parallel.assert_called_once_with([({
+            "destination": "d",
+            "include": [],
+            "exclude": [],
+            "preserve": [],
+            "transform": []
+        }, {"start": "a/b"})])
+
+        self.assertIsNone(self.cnc.crafting)
+
+        # parallel failing walk
+
+        self.cnc.craft.side_effect = Exception("whoops")
+
+        self.assertRaisesRegex(Exception, "whoops", self.cnc.content, {"destination": "d"}, {})
+
+        self.assertIsNone(self.cnc.crafting)
+        self.cnc.parallel.assert_called_once()
+
+    def test_files(self):
+
+        self.cnc.file = unittest.mock.MagicMock()
+
+        self.assertIsNone(self.cnc.files([({"destination": "a"}, {"b": 1}), ({"destination": "a"}, {"b": 2})]))
+
+        self.cnc.file.assert_has_calls([
+            unittest.mock.call({"destination": "a"}, {"b": 1}),
+            unittest.mock.call({"destination": "a"}, {"b": 2})
+        ])
+
+        exception = Exception("whoops")
+        self.cnc.file.side_effect = [None, exception]
+
+        self.assertEqual(
+            self.cnc.files([({"destination": "a"}, {"b": 1}), ({"destination": "a"}, {"b": 2}), ({"destination": "a"}, {"b": 3})]),
+            ({"destination": "a"}, exception)
+        )
+
+        self.assertEqual(self.cnc.file.call_count, 4)
+
+    def test_parallel(self):
+
+        self.cnc.crafters = 4
+
+        crafted = []
+
+        def file(content, values):
+            if content["destination"] == "bad":
+                raise Exception(f"whoops {values['n']}")
+            crafted.append((content["destination"], values["n"]))
+
+        self.cnc.file = unittest.mock.MagicMock(side_effect=file)
+
+        # same destinations stay in order
+
+        self.cnc.parallel([
+            ({"destination": "a"}, {"n": 1}),
+            ({"destination": "b"}, {"n": 2}),
+            ({"destination": "a"}, {"n": 3}),
+            ({"destination": "c"}, {"n": 4}),
+            ({"destination": "a"}, {"n": 5})
+        ])
+
+        self.assertEqual(len(crafted), 5)
+        self.assertEqual([n for destination, n in crafted if destination == "a"], [1, 3, 5])
+
+        # first failure sequentially is reported
+
+        self.assertRaisesRegex(Exception, "whoops 2", self.cnc.parallel, [
+            ({"destination": "a"}, {"n": 1}),
+            ({"destination": "bad"}, {"n": 2}),
+            ({"destination": "bad"}, {"n": 3})
+        ])
+
+        self.assertEqual(self.cnc.data["content"], {"destination": "bad"})
+
+    def test_sparse(self):
+
+        # sources
+
+        contents = [
+            {"source": "{{ here }}/*.yaml", "destination": "there"},
+            {"source": {"value": "ya"}, "destination": "sure"},
+            {"destination": "gone"},
+            {"source": "skip", "condition": "{? here == 'there' ?}"}
+        ]
+
+        self.assertEqual(self.cnc.sparse(contents, {"here": "deploy"}, "source"), ["/deploy/*.yaml"])
+
+        # destinations
+
+        self.assertEqual(self.cnc.sparse(contents, {"here": "deploy"}, "destination"), ["/there", "/sure", "/gone"])
+
+        self.assertEqual(self.cnc.sparse([{"source": "{{ here }}/"}], {"here": "deploy"}, "destination"), ["/deploy"])
+
+        # everything
+
+        self.assertIsNone(self.cnc.sparse([{"source": "/"}], {}, "source"))
+        self.assertIsNone(self.cnc.sparse([{"source": "a", "destination": ""}], {}, "destination"))
+
     @unittest.mock.patch("github.GitHub")
     def test_change(self, mock_github):
 
@@ -898,6 +1220,23 @@ class TestCnC(unittest.TestCase):
             {"here": "there"}
         )
 
+        # sparse
+
+        change = {
+            "github": {
+                "repo": "{{ here }}",
+                "checkout": "sparse"
+            },
+            "content": [
+                {"source": "{{ here }}.yaml"}
+            ],
+            "remove": False
+        }
+
+        self.cnc.change(change, {"here": "there"})
+
+        mock_github.return_value.change.assert_called_with(["/there.yaml"])
+
     @unittest.mock.patch("github.GitHub")
     def test_code(self, mock_github):
 
@@ -918,7 +1257,7 @@ class TestCnC(unittest.TestCase):
 
         self.cnc.code(code, {"here": "there"})
 
-        mock_github.return_value.code.assert_called_once_with()
+        mock_github.return_value.code.assert_called_once_with(None)
 
         self.cnc.change.assert_called_once_with(
             {"remove": False},
@@ -947,18 +1286,99 @@ class TestCnC(unittest.TestCase):
             {"here": "there"}
         )
 
+        # sparse
+
+        code = {
+            "github": {
+                "repo": "{{ here }}",
+                "checkout": "sparse"
+            },
+            "change": [
+                {"content": [{"source": "a", "destination": "{{ here }}"}]},
+                {"content": [{"source": "b"}]}
+            ],
+            "remove": False
+        }
+
+        self.cnc.code(code, {"here": "there"})
+
+        mock_github.return_value.code.assert_called_with(["/there", "/b"])
+
+        # sparse but everything
+
+        code["change"].append({"content": [{"source": "c", "destination": "/"}]})
+
+        self.cnc.code(code, {"here": "there"})
+
+        mock_github.return_value.code.assert_called_with(None)
+
     def test_link(self):
 
         self.cnc.link("sure")
         self.cnc.link("sure")
         self.assertEqual(self.cnc.data["links"], ["sure"])
 
+        self.cnc.report = unittest.mock.MagicMock()
+
+        self.cnc.link("sure")
+        self.cnc.link("yep")
+
+        self.cnc.report.assert_called_once_with({"links": ["sure", "yep"]})
+
+    def test_update(self):
+
+        self.cnc.update(progress={"code": 1})
+
+        self.cnc.report = unittest.mock.MagicMock()
+
+        self.cnc.update(progress={"code": 1})
+
+        self.cnc.report.assert_called_once_with({"progress": {"code": 1}})
+
+    def test_check(self):
+
+        self.cnc.check()
+
+        self.cnc.lost = threading.Event()
+
+        self.cnc.check()
+
+        self.cnc.lost.set()
+
+        self.assertRaisesRegex(Exception, "lost lease on sweat", self.cnc.check)
+
+    @unittest.mock.patch("os.makedirs")
+    @unittest.mock.patch("shutil.rmtree")
+    def test_process_lost(self, mock_rmtree, mock_makedirs):
+
+        self.cnc.code = unittest.mock.MagicMock()
+        self.cnc.lost = threading.Event()
+        self.cnc.lost.set()
+
+        self.cnc.data = {
+            "id": "sweat",
+            "output": {"code": [{}]},
+            "values": {},
+            "action": "commit"
+        }
+
+        self.assertRaisesRegex(Exception, "lost lease on sweat", self.cnc.process)
+
+        self.cnc.code.assert_not_called()
+        self.assertNotIn("status", self.cnc.data)
+
     @unittest.mock.patch("os.makedirs")
     @unittest.mock.patch("shutil.rmtree")
     def test_process(self, mock_rmtree, mock_makedirs):
 
         self.cnc.code = unittest.mock.MagicMock()
 
+        self.cnc.sources = {
+            ("most", "my/stuff", None, "full"): {"directory": "/opt/service/cnc/sweat/source-0", "sparse": None},
+            ("most", "my/stuff", "ayup", "full"): {"directory": "/opt/service/cnc/sweat/source-1", "sparse": None},
+            ("most", "our/stuff", None, "full"): {"directory": "/opt/service/repo/our/stuff", "sparse": None}
+        }
+
         # test
 
         self.cnc.data = {
@@ -973,8 +1393,12 @@ class TestCnC(unittest.TestCase):
             "action": "test"
         }
 
+        self.cnc.report = unittest.mock.MagicMock()
+
         self.cnc.process()
 
+        self.cnc.report.assert_called_once_with({"progress": {"code": 1}})
+
         self.assertEqual(self.cnc.data , {
             "id": "sweat",
             "output": {
@@ -1001,9 +1425,12 @@ class TestCnC(unittest.TestCase):
 
         mock_rmtree.assert_has_calls([
             unittest.mock.call("/opt/service/cnc/sweat", ignore_errors=True),
-            unittest.mock.call("/opt/service/cnc/sweat/source", ignore_errors=True)
+            unittest.mock.call("/opt/service/cnc/sweat/source-0", ignore_errors=True),
+            unittest.mock.call("/opt/service/cnc/sweat/source-1", ignore_errors=True)
         ])
 
+        self.assertNotIn(unittest.mock.call("/opt/service/repo/our/stuff", ignore_errors=True), mock_rmtree.call_args_list)
+
         # commit
 
         self.cnc.data = {
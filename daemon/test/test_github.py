@@ -1,8 +1,12 @@
 import unittest
 import unittest.mock
 
+import os
 import base64
+import fcntl
+import shutil
 import requests
+import concurrent.futures
 
 import github
 
@@ -25,6 +29,11 @@ class TestGitHub(unittest.TestCase):
 
         self.github = github.GitHub(cnc, {"repo": "git.com"})
         self.github.api = unittest.mock.MagicMock()
+        self.github.api.request.return_value.headers = {}
+
+        github.GitHub.cache.clear()
+        github.GitHub.budgets.clear()
+        github.GitHub.latencies.clear()
 
     @unittest.mock.patch.dict(github.GitHub.creds, {
         "people": {
@@ -53,6 +62,33 @@ class TestGitHub(unittest.TestCase):
         ])
 
     @unittest.mock.patch.dict(github.GitHub.creds, {})
+    @unittest.mock.patch.dict(os.environ, {
+        "MIRROR": "/opt/service/mirror",
+        "MIRROR_BUDGET": "2",
+        "LOCAL": "link",
+        "GITHUB_CACHE": "7",
+        "GITHUB_SHARE": "true",
+        "GITHUB_RETRIES": "2",
+        "GITHUB_WAIT": "60",
+        "GITHUB_POOL": "5",
+        "GITHUB_TIMEOUT": "7.5",
+        "GITHUB_BACKOFF": "0.25",
+        "GITHUB_PAGES": "3"
+    })
+    @unittest.mock.patch("github.GitHub.pages", 4)
+    @unittest.mock.patch("github.GitHub.pager", None)
+    @unittest.mock.patch("github.GitHub.pool", 10)
+    @unittest.mock.patch("github.GitHub.timeout", 30)
+    @unittest.mock.patch("github.GitHub.backoff", 0.5)
+    @unittest.mock.patch("github.GitHub.capacity", 1024)
+    @unittest.mock.patch("github.GitHub.share", False)
+    @unittest.mock.patch("github.GitHub.retries", 3)
+    @unittest.mock.patch("github.GitHub.wait", 3600)
+    @unittest.mock.patch("github.GitHub.redis", None)
+    @unittest.mock.patch("github.GitHub.taking", None)
+    @unittest.mock.patch("github.GitHub.mirror", None)
+    @unittest.mock.patch("github.GitHub.local", "read")
+    @unittest.mock.patch("github.GitHub.budget", 0)
     @unittest.mock.patch("glob.glob")
     @unittest.mock.patch('github.open', create=True)
     @unittest.mock.patch('github.GitHub.ssh')
@@ -64,18 +100,132 @@ class TestGitHub(unittest.TestCase):
             unittest.mock.mock_open(read_data='{"stuff": "things"}').return_value
         ]
 
-        github.GitHub.config()
+        redis = unittest.mock.MagicMock()
+
+        github.GitHub.config(redis)
 
         self.assertEqual(github.GitHub.creds, {
             "people": {
                 "stuff": "things",
                 "url": "https://api.github.com",
-                "host": "github.com"
+                "host": "github.com",
+                "legacy": False
             }
         })
 
         mock_ssh.assert_called_once_with("people")
 
+        self.assertEqual(github.GitHub.mirror, "/opt/service/mirror")
+        self.assertEqual(github.GitHub.budget, 2*1024*1024)
+        self.assertEqual(github.GitHub.local, "link")
+        self.assertEqual(github.GitHub.capacity, 7)
+        self.assertTrue(github.GitHub.share)
+        self.assertEqual(github.GitHub.retries, 2)
+        self.assertEqual(github.GitHub.wait, 60)
+        self.assertEqual(github.GitHub.pool, 5)
+        self.assertEqual(github.GitHub.timeout, 7.5)
+        self.assertEqual(github.GitHub.backoff, 0.25)
+        self.assertEqual(github.GitHub.pages, 3)
+        self.assertEqual(github.GitHub.pager._max_workers, 3)
+
+        github.GitHub.pager.shutdown()
+        self.assertEqual(github.GitHub.redis, redis)
+        self.assertEqual(github.GitHub.taking, redis.register_script.return_value)
+
+        redis.register_script.assert_called_once_with(github.TAKE)
+
+    @unittest.mock.patch("os.link")
+    @unittest.mock.patch("shutil.copy2")
+    def test_link(self, mock_copy2, mock_link):
+
+        github.GitHub.link("src", "dst")
+
+        mock_link.assert_called_once_with("src", "dst")
+        mock_copy2.assert_not_called()
+
+        mock_link.side_effect = OSError("cross-device link")
+
+        github.GitHub.link("src", "dst")
+
+        mock_copy2.assert_called_once_with("src", "dst")
+
+    @unittest.mock.patch("os.walk")
+    @unittest.mock.patch("os.path.islink")
+    @unittest.mock.patch("os.path.getsize")
+    def test_size(self, mock_getsize, mock_islink, mock_walk):
+
+        mock_walk.return_value = [
+            ("repo", ["objects"], ["HEAD", "link"]),
+            ("repo/objects", [], ["pack"])
+        ]
+
+        mock_islink.side_effect = lambda path: path == "repo/link"
+        mock_getsize.side_effect = {"repo/HEAD": 1, "repo/objects/pack": 10}.get
+
+        self.assertEqual(github.GitHub.size("repo"), 11)
+
+    @unittest.mock.patch("github.GitHub.mirror", "cache")
+    @unittest.mock.patch("github.GitHub.budget", 10)
+    @unittest.mock.patch("github.GitHub.grace", 100)
+    @unittest.mock.patch("glob.glob")
+    @unittest.mock.patch("github.GitHub.size")
+    @unittest.mock.patch("os.path.getmtime")
+    @unittest.mock.patch("time.time")
+    @unittest.mock.patch("github.open", create=True)
+    @unittest.mock.patch("fcntl.flock")
+    @unittest.mock.patch("shutil.rmtree")
+    @unittest.mock.patch("builtins.print")
+    def test_evict(self, mock_print, mock_rmtree, mock_flock, mock_open, mock_time, mock_getmtime, mock_size, mock_glob):
+
+        mock_glob.return_value = ["cache/h/o/recent.git", "cache/h/o/locked.git", "cache/h/o/old.git", "cache/h/o/older.git"]
+        mock_size.side_effect = {
+            "cache/h/o/recent.git": 5,
+            "cache/h/o/locked.git": 5,
+            "cache/h/o/old.git": 5,
+            "cache/h/o/older.git": 5
+        }.get
+        mock_getmtime.side_effect = {
+            "cache/h/o/recent.git": 950,
+            "cache/h/o/locked.git": 10,
+            "cache/h/o/old.git": 20,
+            "cache/h/o/older.git": 30
+        }.get
+        mock_time.return_value = 1000
+
+        def flock(lock_file, operation):
+            if lock_file == mock_open.locked:
+                raise BlockingIOError()
+
+        locked = unittest.mock.MagicMock()
+        unlocked = unittest.mock.MagicMock()
+        mock_open.locked = locked.__enter__.return_value
+        mock_open.side_effect = [locked, unlocked, unlocked]
+        mock_flock.side_effect = flock
+
+        github.GitHub.evict()
+
+        mock_glob.assert_called_once_with("cache/*/*/*.git")
+        mock_open.assert_has_calls([
+            unittest.mock.call("cache/h/o/locked.git.lock", "w"),
+            unittest.mock.call("cache/h/o/old.git.lock", "w"),
+            unittest.mock.call("cache/h/o/older.git.lock", "w")
+        ], any_order=True)
+        mock_flock.assert_called_with(unlocked.__enter__.return_value, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        mock_rmtree.assert_has_calls([
+            unittest.mock.call("cache/h/o/old.git", ignore_errors=True),
+            unittest.mock.call("cache/h/o/older.git", ignore_errors=True)
+        ])
+        self.assertEqual(mock_rmtree.call_count, 2)
+
+        # no budget, no eviction
+
+        mock_glob.reset_mock()
+
+        with unittest.mock.patch("github.GitHub.budget", 0):
+            github.GitHub.evict()
+
+        mock_glob.assert_not_called()
+
     @unittest.mock.patch.dict(github.GitHub.creds, {
         "default": {
             "user": "arcade",
@@ -105,6 +255,7 @@ class TestGitHub(unittest.TestCase):
         self.assertEqual(init.url, "curl")
         self.assertIsInstance(init.api, requests.Session)
         self.assertEqual(init.api.auth, ("arcade", "fire"))
+        self.assertEqual(init.api, github.GitHub(cnc, {"repo": "git.com"}).api)
         self.assertEqual(init.data, {
             "creds": "default",
             "repo": "git.com",
@@ -140,42 +291,532 @@ class TestGitHub(unittest.TestCase):
             "labels": ["smead"]
         })
 
+    @unittest.mock.patch("github.time.time")
+    def test_send(self, mock_time):
+
+        mock_time.side_effect = [100, 100.3]
+
+        response = unittest.mock.MagicMock(headers={
+            "X-RateLimit-Remaining": "10",
+            "X-RateLimit-Reset": "200"
+        })
+
+        self.github.api.request.return_value = response
+
+        self.assertEqual(self.github.send("POST", "some", {"b": 2}, {"c": 3}, {"d": "4"}), response)
+
+        self.github.api.request.assert_called_once_with("POST", "curl/some", params={"b": 2}, json={"c": 3}, headers={"d": "4"}, timeout=30)
+
+        self.assertEqual(self.github.cnc.data["requests"], {"most": 1})
+        self.assertEqual(github.GitHub.latencies["default"]["POST 0.5"], 1)
+        self.assertEqual(github.GitHub.budgets["default"], {"remaining": 10, "reset": 200})
+
     def test_request(self):
 
         self.github.api.request.return_value.json.return_value = {"a": 1}
 
         self.assertEqual(self.github.request("GET", "some", {"b": 2}, {"c": 3}), {"a": 1})
 
-        self.github.api.request.assert_called_once_with("GET", "curl/some", params={"b": 2}, json={"c": 3})
+        self.github.api.request.assert_called_once_with("GET", "curl/some", params={"b": 2}, json={"c": 3}, headers={}, timeout=30)
 
         self.github.api.request.return_value.raise_for_status.assert_called_once_with()
 
+        self.github.request("GET", "more")
+
+        self.assertEqual(self.github.cnc.data["requests"], {"most": 2})
+
+    @unittest.mock.patch("github.GitHub.capacity", 2)
+    def test_recall(self):
+
+        github.GitHub.remember("a", {"body": 1})
+        github.GitHub.remember("b", {"body": 2})
+
+        self.assertEqual(github.GitHub.recall("a"), {"body": 1})
+
+        github.GitHub.remember("c", {"body": 3})
+
+        self.assertIsNone(github.GitHub.recall("b"))
+        self.assertEqual(list(github.GitHub.cache), ["a", "c"])
+
+        # shared
+
+        redis = unittest.mock.MagicMock()
+        redis.get.return_value = '{"body": 4}'
+
+        with unittest.mock.patch("github.GitHub.redis", redis), unittest.mock.patch("github.GitHub.share", True):
+
+            self.assertEqual(github.GitHub.recall("d"), {"body": 4})
+            self.assertEqual(github.GitHub.cache["d"], {"body": 4})
+
+            redis.get.assert_called_once_with("/github/cache/d")
+
+            github.GitHub.remember("e", {"body": 5})
+            redis.set.assert_not_called()
+
+            github.GitHub.remember("e", {"body": 5}, share=True)
+            redis.set.assert_called_once_with("/github/cache/e", '{"body": 5}', ex=86400)
+
+    @unittest.mock.patch("github.time.time")
+    def test_take(self, mock_time):
+
+        mock_time.return_value = 100
+
+        # nothing known
+
+        self.assertEqual(github.GitHub.take("default"), 0)
+
+        # some left
+
+        github.GitHub.budgets["default"] = {"remaining": 1, "reset": 160}
+
+        self.assertEqual(github.GitHub.take("default"), 0)
+        self.assertEqual(github.GitHub.budgets["default"]["remaining"], 0)
+
+        # none left
+
+        self.assertEqual(github.GitHub.take("default"), 60)
+
+        # reset
+
+        mock_time.return_value = 160
+
+        self.assertEqual(github.GitHub.take("default"), 0)
+
+        # shared
+
+        redis = unittest.mock.MagicMock()
+        taking = unittest.mock.MagicMock(return_value=7)
+
+        with unittest.mock.patch("github.GitHub.redis", redis), unittest.mock.patch("github.GitHub.taking", taking):
+            self.assertEqual(github.GitHub.take("people"), 7)
+
+        taking.assert_called_once_with(keys=["/github/budget/people"], args=[160])
+
+    def test_refill(self):
+
+        # no headers
+
+        github.GitHub.refill("default", unittest.mock.MagicMock(headers={}))
+
+        self.assertEqual(github.GitHub.budgets, {})
+
+        response = unittest.mock.MagicMock(headers={
+            "X-RateLimit-Remaining": "4999",
+            "X-RateLimit-Reset": "1000"
+        })
+
+        github.GitHub.refill("default", response)
+
+        self.assertEqual(github.GitHub.budgets, {"default": {"remaining": 4999, "reset": 1000}})
+
+        # shared
+
+        redis = unittest.mock.MagicMock()
+
+        with unittest.mock.patch("github.GitHub.redis", redis):
+            github.GitHub.refill("people", response)
+
+        redis.pipeline.return_value.hset.assert_called_once_with("/github/budget/people", mapping={"remaining": 4999, "reset": 1000})
+        redis.pipeline.return_value.expireat.assert_called_once_with("/github/budget/people", 1060)
+        redis.pipeline.return_value.sadd.assert_called_once_with("/github/creds", "people")
+        redis.pipeline.return_value.execute.assert_called_once_with()
+
+    @unittest.mock.patch.dict(github.GitHub.creds, {
+        "people": {
+            "user": "arcade",
+            "token": "fire"
+        }
+    })
+    @unittest.mock.patch.dict(github.GitHub.sessions, {})
+    @unittest.mock.patch("github.GitHub.pool", 5)
+    @unittest.mock.patch("github.GitHub.retries", 2)
+    @unittest.mock.patch("github.GitHub.backoff", 0.25)
+    def test_pooled(self):
+
+        session = github.GitHub.pooled("people", "curl")
+
+        self.assertEqual(session.auth, ("arcade", "fire"))
+        self.assertIs(github.GitHub.pooled("people", "curl"), session)
+        self.assertIsNot(github.GitHub.pooled("people", "burl"), session)
+
+        adapter = session.get_adapter("https://api.github.com")
+
+        self.assertEqual(adapter._pool_connections, 5)
+        self.assertEqual(adapter._pool_maxsize, 5)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertEqual(adapter.max_retries.backoff_factor, 0.25)
+        self.assertEqual(adapter.max_retries.status_forcelist, [500, 502, 503, 504])
+        self.assertFalse(adapter.max_retries.is_retry("POST", 503))
+        self.assertTrue(adapter.max_retries.is_retry("GET", 503))
+
+    def test_measure(self):
+
+        github.GitHub.measure("default", "GET", 0.05)
+        github.GitHub.measure("default", "GET", 0.3)
+        github.GitHub.measure("default", "POST", 60)
+
+        self.assertEqual(github.GitHub.latencies, {
+            "default": {
+                "GET 0.1": 1,
+                "GET 0.5": 1,
+                "GET sum": 0.35,
+                "POST +Inf": 1,
+                "POST sum": 60
+            }
+        })
+
+        # shared
+
+        redis = unittest.mock.MagicMock()
+
+        with unittest.mock.patch("github.GitHub.redis", redis):
+            github.GitHub.measure("people", "GET", 2)
+
+        redis.pipeline.return_value.hincrby.assert_called_once_with("/github/latency/people", "GET 2.5", 1)
+        redis.pipeline.return_value.hincrbyfloat.assert_called_once_with("/github/latency/people", "GET sum", 2)
+        redis.pipeline.return_value.sadd.assert_called_once_with("/github/creds", "people")
+        redis.pipeline.return_value.execute.assert_called_once_with()
+
+    @unittest.mock.patch("github.time.sleep")
+    @unittest.mock.patch("builtins.print")
+    @unittest.mock.patch("github.GitHub.retries", 2)
+    @unittest.mock.patch("github.GitHub.backoff", 0.5)
+    def test_retry(self, mock_print, mock_sleep):
+
+        def status(code):
+
+            response = requests.Response()
+            response.status_code = code
+
+            return requests.exceptions.HTTPError(f"{code}", response=response)
+
+        # transient
+
+        action = unittest.mock.MagicMock(side_effect=[requests.exceptions.ConnectionError("reset"), status(502), "done"])
+        action.__name__ = "ensure"
+
+        self.assertEqual(self.github.retry(action, "it", sure=True), "done")
+
+        action.assert_has_calls([unittest.mock.call("it", sure=True)] * 3)
+        mock_sleep.assert_has_calls([unittest.mock.call(0.5), unittest.mock.call(1.0)])
+        mock_print.assert_has_calls([
+            unittest.mock.call("retrying ensure: reset"),
+            unittest.mock.call("retrying ensure: 502")
+        ])
+
+        # not transient
+
+        action = unittest.mock.MagicMock(side_effect=[status(422)])
+        action.__name__ = "ensure"
+
+        self.assertRaisesRegex(requests.exceptions.HTTPError, "422", self.github.retry, action)
+        self.assertEqual(action.call_count, 1)
+
+        # out of retries
+
+        action = unittest.mock.MagicMock(side_effect=requests.exceptions.Timeout("slow"))
+        action.__name__ = "ensure"
+
+        self.assertRaisesRegex(requests.exceptions.Timeout, "slow", self.github.retry, action)
+        self.assertEqual(action.call_count, 3)
+
+    @unittest.mock.patch("github.time.time")
+    def test_delay(self, mock_time):
+
+        mock_time.return_value = 100
+
+        self.assertIsNone(github.GitHub.delay(unittest.mock.MagicMock(status_code=200, headers={})))
+        self.assertIsNone(github.GitHub.delay(unittest.mock.MagicMock(status_code=403, headers={})))
+
+        self.assertEqual(github.GitHub.delay(unittest.mock.MagicMock(status_code=403, headers={
+            "Retry-After": "30"
+        })), 30)
+
+        self.assertEqual(github.GitHub.delay(unittest.mock.MagicMock(status_code=429, headers={
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset": "160"
+        })), 60)
+
+        self.assertEqual(github.GitHub.delay(unittest.mock.MagicMock(status_code=403, headers={
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset": "90"
+        })), 1)
+
+    @unittest.mock.patch("github.time.sleep")
+    @unittest.mock.patch("github.time.time")
+    @unittest.mock.patch("builtins.print")
+    @unittest.mock.patch("github.GitHub.retries", 1)
+    @unittest.mock.patch("github.GitHub.wait", 45)
+    def test_request_limited(self, mock_print, mock_time, mock_sleep):
+
+        mock_time.return_value = 100
+
+        limited = unittest.mock.MagicMock(status_code=403, headers={
+            "Retry-After": "30"
+        })
+
+        fine = unittest.mock.MagicMock(status_code=200, headers={
+            "X-RateLimit-Remaining": "10",
+            "X-RateLimit-Reset": "200"
+        })
+        fine.json.return_value = {"a": 1}
+
+        # retries after what it's told
+
+        self.github.api.request.side_effect = [limited, fine]
+
+        self.assertEqual(self.github.request("POST", "some"), {"a": 1})
+
+        mock_sleep.assert_called_once_with(30)
+        mock_print.assert_called_once_with("rate limited, retrying some in 30s")
+        self.assertEqual(self.github.cnc.data["requests"], {"most": 2})
+        self.assertEqual(github.GitHub.budgets["default"], {"remaining": 10, "reset": 200})
+
+        # waits out an empty budget, but only so long
+
+        github.GitHub.budgets["default"]["remaining"] = 0
+
+        self.github.api.request.side_effect = [fine]
+
+        self.github.request("POST", "some")
+
+        mock_print.assert_called_with("waiting 100s for default rate limit")
+        mock_sleep.assert_called_with(45)
+
+        # gives up after retries
+
+        self.github.api.request.side_effect = [limited, limited]
+        limited.raise_for_status.side_effect = requests.exceptions.HTTPError("limited")
+
+        self.assertRaisesRegex(requests.exceptions.HTTPError, "limited", self.github.request, "POST", "some")
+
+        self.assertEqual(self.github.api.request.call_count, 5)
+
+    def test_key(self):
+
+        self.assertEqual(self.github.key("some", {"b": 2, "a": 1}), self.github.key("some", {"a": 1, "b": 2}))
+        self.assertNotEqual(self.github.key("some", {"a": 1}), self.github.key("some", {"a": 2}))
+
+        key = self.github.key("some", {"a": 1})
+
+        self.github.user = "other"
+
+        self.assertNotEqual(self.github.key("some", {"a": 1}), key)
+
+    @unittest.mock.patch.dict(os.environ, {
+        "MIRROR_BUDGET": "2"
+    })
+    @unittest.mock.patch("github.GitHub.mirror", None)
+    @unittest.mock.patch("github.GitHub.budget", 0)
+    @unittest.mock.patch("github.GitHub.local", "read")
+    @unittest.mock.patch("github.GitHub.capacity", 1024)
+    @unittest.mock.patch("github.GitHub.share", False)
+    @unittest.mock.patch("github.GitHub.retries", 3)
+    @unittest.mock.patch("github.GitHub.wait", 3600)
+    @unittest.mock.patch("github.GitHub.pool", 10)
+    @unittest.mock.patch("github.GitHub.timeout", 30)
+    @unittest.mock.patch("github.GitHub.backoff", 0.5)
+    @unittest.mock.patch("github.GitHub.pages", 4)
+    @unittest.mock.patch("github.GitHub.pager", None)
+    @unittest.mock.patch("github.GitHub.redis", None)
+    @unittest.mock.patch("github.GitHub.taking", None)
+    @unittest.mock.patch("glob.glob", unittest.mock.MagicMock(return_value=[]))
+    def test_fetch_configured(self):
+
+        github.GitHub.config()
+
+        response = unittest.mock.MagicMock(status_code=200, headers={
+            "X-RateLimit-Remaining": "10",
+            "X-RateLimit-Reset": "200",
+            "Link": '<curl/some?page=2>; rel="next"'
+        })
+        response.json.return_value = [{"a": 1}]
+
+        self.github.api.request.return_value = response
+
+        self.assertEqual(self.github.fetch("GET", "some"), ([{"a": 1}], '<curl/some?page=2>; rel="next"'))
+        self.assertEqual(github.GitHub.budgets["default"], {"remaining": 10, "reset": 200})
+        self.assertEqual(github.GitHub.budget, 2*1024*1024)
+
+        github.GitHub.pager.shutdown()
+
+    def test_request_cached(self):
+
+        fresh = unittest.mock.MagicMock(status_code=200, headers={"ETag": '"v1"', "Last-Modified": "Tue"})
+        fresh.json.return_value = [{"a": 1}]
+
+        unchanged = unittest.mock.MagicMock(status_code=304, headers={})
+
+        self.github.api.request.side_effect = [fresh, unchanged]
+
+        self.assertEqual(self.github.request("GET", "some", {"b": 2}), [{"a": 1}])
+        self.assertEqual(self.github.request("GET", "some", {"b": 2}), [{"a": 1}])
+
+        self.github.api.request.assert_has_calls([
+            unittest.mock.call("GET", "curl/some", params={"b": 2}, json=None, headers={}, timeout=30),
+            unittest.mock.call("GET", "curl/some", params={"b": 2}, json=None, headers={
+                "If-None-Match": '"v1"',
+                "If-Modified-Since": "Tue"
+            }, timeout=30)
+        ])
+
+        unchanged.raise_for_status.assert_not_called()
+
+        # changed
+
+        changed = unittest.mock.MagicMock(status_code=200, headers={"ETag": '"v2"'})
+        changed.json.return_value = [{"a": 2}]
+
+        self.github.api.request.side_effect = [changed]
+
+        self.assertEqual(self.github.request("GET", "some", {"b": 2}), [{"a": 2}])
+        self.assertEqual(self.github.recall(self.github.key("some", {"b": 2})), {
+            "etag": '"v2"',
+            "modified": None,
+            "link": None,
+            "body": [{"a": 2}]
+        })
+
+        # only GETs
+
+        self.github.api.request.side_effect = [fresh]
+
+        self.github.request("POST", "some", json={"c": 3})
+
+        self.github.api.request.assert_called_with("POST", "curl/some", params=None, json={"c": 3}, headers={}, timeout=30)
+        self.assertEqual(len(github.GitHub.cache), 1)
+
+        # disabled
+
+        with unittest.mock.patch("github.GitHub.capacity", 0):
+
+            self.github.api.request.side_effect = [fresh]
+
+            self.github.request("GET", "some", {"b": 2})
+
+            self.github.api.request.assert_called_with("GET", "curl/some", params={"b": 2}, json=None, headers={}, timeout=30)
+
+    def test_lookup(self):
+
+        self.github.api.request.return_value.json.return_value = {"a": 1}
+
+        self.assertEqual(self.github.lookup("some", {"b": 2}), {"a": 1})
+
+        self.github.api.request.assert_called_once_with("GET", "curl/some", params={"b": 2}, json=None, headers={}, timeout=30)
+
+        # missing
+
+        missing = requests.Response()
+        missing.status_code = 404
+
+        self.github.api.request.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError(response=missing)
+
+        self.assertIsNone(self.github.lookup("nope"))
+
+        # anything else
+
+        broken = requests.Response()
+        broken.status_code = 500
+
+        self.github.api.request.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError("whoops", response=broken)
+
+        self.assertRaisesRegex(requests.exceptions.HTTPError, "whoops", self.github.lookup, "broken")
+
+    def test_paging(self):
+
+        self.assertEqual(github.GitHub.paging(None), {})
+
+        self.assertEqual(github.GitHub.paging(
+            '<curl/some?per_page=100&page=2>; rel="next", <curl/some?per_page=100&page=4>; rel="last", <curl/some>; rel="first"'
+        ), {
+            "next": 2,
+            "last": 4
+        })
+
     def test_iterate(self):
 
+        def pages(responses):
+
+            def respond(method, url, params, json, headers, timeout):
+
+                response = unittest.mock.MagicMock(headers={})
+                response.json.return_value, link = responses[params["page"]]
+
+                if link:
+                    response.headers["Link"] = link
+
+                return response
+
+            return respond
+
         # none
 
         self.github.api.request.return_value.json.return_value = []
 
         self.assertEqual(list(self.github.iterate("none")), [])
 
-        self.github.api.request.assert_called_once_with("GET", "curl/none", params={"page": 1}, json=None)
+        self.github.api.request.assert_called_once_with("GET", "curl/none", params={"per_page": 100, "page": 1}, json=None, headers={}, timeout=30)
 
-        # some
+        # no links, until a page isn't full
 
-        some = unittest.mock.MagicMock()
-        none = unittest.mock.MagicMock()
+        self.github.api.request.reset_mock()
 
-        some.json.return_value = [{"a": 1}]
-        none.json.return_value = []
+        with unittest.mock.patch("github.GitHub.per_page", 2):
 
-        self.github.api.request.side_effect = [some, none]
+            self.github.api.request.side_effect = pages({
+                1: ([{"a": 1}, {"a": 2}], None),
+                2: ([{"a": 3}], None)
+            })
 
-        self.assertEqual(list(self.github.iterate("some", {"b": 2}, {"c": 3})), [{"a": 1}])
+            self.assertEqual(list(self.github.iterate("some", {"b": 2}, {"c": 3})), [{"a": 1}, {"a": 2}, {"a": 3}])
 
         self.github.api.request.assert_has_calls([
-            unittest.mock.call("GET", "curl/some", params={"b": 2, "page": 1}, json={"c": 3}),
-            unittest.mock.call("GET", "curl/some", params={"b": 2, "page": 2}, json={"c": 3})
+            unittest.mock.call("GET", "curl/some", params={"b": 2, "per_page": 2, "page": 1}, json={"c": 3}, headers={}, timeout=30),
+            unittest.mock.call("GET", "curl/some", params={"b": 2, "per_page": 2, "page": 2}, json={"c": 3}, headers={}, timeout=30)
         ])
+        self.assertEqual(self.github.api.request.call_count, 2)
+
+        # following next without a pager
+
+        self.github.api.request.reset_mock()
+
+        self.github.api.request.side_effect = pages({
+            1: ([{"a": 1}], '<curl/some?page=2>; rel="next", <curl/some?page=3>; rel="last"'),
+            2: ([{"a": 2}], '<curl/some?page=3>; rel="next", <curl/some?page=3>; rel="last"'),
+            3: ([{"a": 3}], '<curl/some?page=1>; rel="first"')
+        })
+
+        self.assertEqual(list(self.github.iterate("some")), [{"a": 1}, {"a": 2}, {"a": 3}])
+        self.assertEqual(self.github.api.request.call_count, 3)
+
+        # all at once with a pager, still in order
+
+        responses = {page: ([{"a": page}], '<curl/some?page=5>; rel="last"') for page in range(1, 6)}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pager, \
+             unittest.mock.patch("github.GitHub.pager", pager), \
+             unittest.mock.patch("github.GitHub.pages", 2):
+
+            self.github.api.request.reset_mock()
+            self.github.api.request.side_effect = pages(responses)
+
+            self.assertEqual(list(self.github.iterate("some")), [{"a": page} for page in range(1, 6)])
+            self.assertEqual(self.github.api.request.call_count, 5)
+
+            # stopping early doesn't get everything
+
+            responses = {page: ([{"a": page}], '<curl/some?page=100>; rel="last"') for page in range(1, 101)}
+
+            self.github.api.request.reset_mock()
+            self.github.api.request.side_effect = pages(responses)
+
+            iterating = self.github.iterate("some")
+
+            self.assertEqual([next(iterating) for _ in range(3)], [{"a": 1}, {"a": 2}, {"a": 3}])
+
+            iterating.close()
+
+        self.assertLessEqual(self.github.api.request.call_count, 6)
 
     def test_repo(self):
 
@@ -187,10 +828,10 @@ class TestGitHub(unittest.TestCase):
             "name": "exist"
         }
 
-        self.github.iterate = unittest.mock.MagicMock(return_value=[{
+        self.github.lookup = unittest.mock.MagicMock(return_value={
             "full_name": "does/exist",
             "default_branch": "maine"
-        }])
+        })
 
         self.github.request = unittest.mock.MagicMock(return_value=[True])
 
@@ -204,9 +845,40 @@ class TestGitHub(unittest.TestCase):
             "base": "maine"
         })
 
-        self.github.iterate.assert_called_once_with("user/repos")
+        self.github.lookup.assert_called_once_with("repos/does/exist")
         self.github.request.assert_called_once_with("GET", "repos/does/exist/branches")
 
+        # legacy pages through
+
+        self.github.legacy = True
+
+        self.github.data = {
+            "path": "does/exist",
+            "org": "does",
+            "name": "exist"
+        }
+
+        self.github.iterate = unittest.mock.MagicMock(return_value=[
+            {
+                "full_name": "does/not",
+                "default_branch": "nope"
+            },
+            {
+                "full_name": "does/exist",
+                "default_branch": "maine"
+            }
+        ])
+
+        self.assertTrue(self.github.repo())
+
+        self.assertEqual(self.github.data["default"], "maine")
+
+        self.github.iterate.assert_called_once_with("user/repos")
+
+        self.github.legacy = False
+
+        self.github.lookup.return_value = None
+
         # org repo dooesn't exist but don't ensure
 
         self.github.data = {
@@ -303,6 +975,11 @@ class TestGitHub(unittest.TestCase):
 
         # default branch doesn't exist
 
+        self.github.lookup.return_value = {
+            "full_name": "does/exist",
+            "default_branch": "maine"
+        }
+
         self.github.data = {
             "path": "does/exist",
             "org": "does",
@@ -359,9 +1036,7 @@ class TestGitHub(unittest.TestCase):
             "path": "my/stuff"
         }
 
-        self.github.iterate = unittest.mock.MagicMock(return_value=[{
-            "name": "exists"
-        }])
+        self.github.lookup = unittest.mock.MagicMock(side_effect=lambda path: {"ref": "refs/heads/exists"} if path.endswith("/exists") else None)
 
         self.github.request = unittest.mock.MagicMock(return_value={
             "object": {
@@ -371,8 +1046,24 @@ class TestGitHub(unittest.TestCase):
 
         self.github.branch("exists", "drum")
 
+        self.github.lookup.assert_called_once_with("repos/my/stuff/git/ref/heads/exists")
         self.github.request.assert_not_called()
 
+        # legacy pages through
+
+        self.github.legacy = True
+
+        self.github.iterate = unittest.mock.MagicMock(return_value=[{
+            "name": "exists"
+        }])
+
+        self.github.branch("exists", "drum")
+
+        self.github.iterate.assert_called_once_with("repos/my/stuff/branches")
+        self.github.request.assert_not_called()
+
+        self.github.legacy = False
+
         self.github.branch("notexists", "drum")
 
         self.github.request.assert_called_with("POST", "repos/my/stuff/git/refs", json={
@@ -393,13 +1084,11 @@ class TestGitHub(unittest.TestCase):
             "branch": "exists"
         }
 
-        self.github.iterate = unittest.mock.MagicMock(return_value=[{
+        self.github.request = unittest.mock.MagicMock(return_value=[{
             "head": {"ref": "exists"},
             "html_url": "ya"
         }])
 
-        self.github.request = unittest.mock.MagicMock()
-
         self.github.cnc.link = unittest.mock.MagicMock()
 
         # exists
@@ -412,15 +1101,51 @@ class TestGitHub(unittest.TestCase):
             "url": "ya"
         })
 
-        self.github.request.assert_not_called()
+        self.github.request.assert_called_once_with("GET", "repos/my/stuff/pulls", {"head": "my:exists"})
+
+        # legacy pages through
+
+        self.github.legacy = True
+
+        self.github.data = {
+            "path": "my/stuff",
+            "branch": "exists"
+        }
+
+        self.github.iterate = unittest.mock.MagicMock(return_value=[
+            {
+                "head": {"ref": "other"},
+                "html_url": "nah"
+            },
+            {
+                "head": {"ref": "exists"},
+                "html_url": "ya"
+            }
+        ])
+
+        self.github.pull_request()
+
+        self.assertEqual(self.github.data["url"], "ya")
+
+        self.github.iterate.assert_called_once_with("repos/my/stuff/pulls", {"head": "my:exists"})
+
+        self.github.legacy = False
 
         # no changes
 
-        self.github.request = unittest.mock.MagicMock(return_value={
-            "commit": {
-                "sha": "same"
+        self.github.request = unittest.mock.MagicMock(side_effect=[
+            [],
+            {
+                "commit": {
+                    "sha": "same"
+                }
+            },
+            {
+                "commit": {
+                    "sha": "same"
+                }
             }
-        })
+        ])
 
         self.github.data = {
             "path": "my/stuff",
@@ -436,6 +1161,12 @@ class TestGitHub(unittest.TestCase):
         # create
 
         self.github.request = unittest.mock.MagicMock(side_effect=[
+            [
+                {
+                    "head": {"ref": "otherexists"},
+                    "html_url": "nah"
+                }
+            ],
             {
                 "commit": {
                     "sha": "diff"
@@ -562,76 +1293,283 @@ class TestGitHub(unittest.TestCase):
         })
 
 
-    @unittest.mock.patch("os.chdir")
+    @unittest.mock.patch("github.GitHub.mirror", "cache")
+    @unittest.mock.patch("os.makedirs")
+    @unittest.mock.patch("os.path.exists")
+    @unittest.mock.patch("github.open", create=True)
+    @unittest.mock.patch("fcntl.flock")
+    @unittest.mock.patch("os.utime")
+    @unittest.mock.patch("github.GitHub.evict")
+    @unittest.mock.patch("builtins.print")
+    @unittest.mock.patch("subprocess.check_output")
+    def test_mirrored(self, mock_subprocess, mock_print, mock_evict, mock_utime, mock_flock, mock_open, mock_exists, mock_makedirs):
+
+        self.github.data = {
+            "path": "my/stuff"
+        }
+
+        # clone
+
+        mock_exists.return_value = False
+        mock_subprocess.return_value = "cloned"
+
+        self.assertEqual(self.github.mirrored(), "cache/most/my/stuff.git")
+
+        mock_makedirs.assert_called_once_with("cache/most/my", exist_ok=True)
+        mock_open.assert_called_once_with("cache/most/my/stuff.git.lock", "w")
+        mock_flock.assert_called_once_with(mock_open.return_value.__enter__.return_value, fcntl.LOCK_EX)
+        mock_subprocess.assert_called_once_with("git clone --mirror git@most:my/stuff.git cache/most/my/stuff.git", shell=True)
+        mock_print.assert_called_once_with("cloned")
+        mock_utime.assert_called_once_with("cache/most/my/stuff.git")
+        mock_evict.assert_called_once_with()
+
+        # fetch
+
+        mock_exists.return_value = True
+
+        self.assertEqual(self.github.mirrored(), "cache/most/my/stuff.git")
+
+        mock_subprocess.assert_called_with("git fetch --prune origin", shell=True, cwd="cache/most/my/stuff.git")
+
+    @unittest.mock.patch("builtins.print")
+    @unittest.mock.patch("subprocess.check_output")
+    def test_clone(self, mock_subprocess, mock_print):
+
+        self.github.data = {
+            "path": "my/stuff"
+        }
+
+        mock_subprocess.return_value = "cloned"
+
+        # no mirror
+
+        self.github.clone("noise/source")
+
+        mock_subprocess.assert_called_once_with("git clone git@most:my/stuff.git noise/source", shell=True)
+        mock_print.assert_called_once_with("cloned")
+        self.github.cnc.check.assert_called_once_with()
+
+        # mirror
+
+        self.github.mirror = "cache"
+        self.github.mirrored = unittest.mock.MagicMock(return_value="cache/most/my/stuff.git")
+
+        self.github.clone("noise/source")
+
+        mock_subprocess.assert_called_with("git clone --reference cache/most/my/stuff.git --dissociate git@most:my/stuff.git noise/source", shell=True)
+
+        self.github.mirror = None
+
+        # branch
+
+        mock_subprocess.reset_mock()
+
+        self.github.clone("noise/source", "ayup")
+
+        mock_subprocess.assert_has_calls([
+            unittest.mock.call("git clone git@most:my/stuff.git noise/source", shell=True),
+            unittest.mock.call("git checkout ayup", shell=True, cwd="noise/source")
+        ])
+
+        # shallow
+
+        self.github.data["checkout"] = "shallow"
+
+        mock_subprocess.reset_mock()
+
+        self.github.clone("noise/source", "ayup", ["/ignored"])
+
+        mock_subprocess.assert_has_calls([
+            unittest.mock.call("git clone --depth 1 --filter=blob:none --no-checkout --branch ayup git@most:my/stuff.git noise/source", shell=True),
+            unittest.mock.call("git read-tree -mu HEAD", shell=True, cwd="noise/source")
+        ])
+        self.assertEqual(mock_subprocess.call_count, 2)
+
+        # sparse
+
+        self.github.data["checkout"] = "sparse"
+
+        mock_subprocess.reset_mock()
+
+        self.github.sparsen = unittest.mock.MagicMock()
+
+        self.github.clone("noise/source", None, ["/deploy/*.yaml", "/README.md"])
+
+        mock_subprocess.assert_called_once_with("git clone --depth 1 --filter=blob:none --no-checkout git@most:my/stuff.git noise/source", shell=True)
+        self.github.sparsen.assert_called_once_with("noise/source", ["/deploy/*.yaml", "/README.md"])
+
+        # sparse but everything
+
+        mock_subprocess.reset_mock()
+
+        self.github.clone("noise/source", None, None)
+
+        self.assertEqual(mock_subprocess.call_count, 2)
+
+    @unittest.mock.patch("github.open", create=True)
+    @unittest.mock.patch("builtins.print")
+    @unittest.mock.patch("subprocess.check_output")
+    def test_sparsen(self, mock_subprocess, mock_print, mock_open):
+
+        github.GitHub.sparsen("noise/source-0", ["/deploy/*.yaml", "/README.md"])
+
+        mock_open.assert_called_once_with("noise/source-0/.git/info/sparse-checkout", "w")
+        mock_open.return_value.__enter__().write.assert_called_once_with("/deploy/*.yaml\n/README.md\n")
+
+        mock_subprocess.assert_has_calls([
+            unittest.mock.call("git config core.sparseCheckout true", shell=True, cwd="noise/source-0"),
+            unittest.mock.call("git read-tree -mu HEAD", shell=True, cwd="noise/source-0")
+        ])
+
     @unittest.mock.patch("shutil.rmtree")
     @unittest.mock.patch("os.path.exists")
     @unittest.mock.patch("builtins.print")
     @unittest.mock.patch("shutil.copytree")
-    @unittest.mock.patch("subprocess.check_output")
-    def test_change(self, mock_subprocess, mock_copytree, mock_print, mock_exists, mock_rmtree, mock_chdir):
+    def test_change(self, mock_copytree, mock_print, mock_exists, mock_rmtree):
 
         self.github.cnc = unittest.mock.MagicMock()
         self.github.cnc.data = {}
+        self.github.cnc.sources = {}
         self.github.cnc.base.return_value = "noise"
 
+        self.github.clone = unittest.mock.MagicMock()
+        self.github.sparsen = unittest.mock.MagicMock()
+
         self.github.data = {
             "path": "my/stuff",
             "branch": "ayup"
         }
 
-        # copy
+        # read
 
-        mock_exists.return_value = True
+        mock_exists.side_effect = lambda path: path == "/opt/service/repo/my/stuff"
 
         self.github.change()
 
         self.assertEqual(self.github.cnc.data["change"], self.github.data)
+        self.assertEqual(self.github.cnc.sources, {
+            ("most", "my/stuff", "ayup", "full"): {"directory": "/opt/service/repo/my/stuff", "sparse": None}
+        })
+        self.assertEqual(self.github.cnc.sourcing, "/opt/service/repo/my/stuff")
+
+        mock_exists.assert_called_once_with("/opt/service/repo/my/stuff")
+        mock_rmtree.assert_not_called()
+        mock_copytree.assert_not_called()
 
-        mock_chdir.assert_has_calls([
-            unittest.mock.call("noise")
+        mock_print.assert_has_calls([
+            unittest.mock.call("reading repo/my/stuff")
         ])
-        mock_rmtree.assert_called_once_with("noise/source", ignore_errors=True)
 
-        mock_exists.assert_called_once_with("/opt/service/repo/my/stuff")
+        # copy
+
+        self.github.cnc.sources = {}
+        self.github.local = "copy"
 
-        mock_copytree.assert_called_once_with("/opt/service/repo/my/stuff", "noise/source")
+        self.github.change()
+
+        self.assertEqual(self.github.cnc.sources, {
+            ("most", "my/stuff", "ayup", "full"): {"directory": "noise/source-0", "sparse": None}
+        })
+        self.assertEqual(self.github.cnc.sourcing, "noise/source-0")
+
+        mock_rmtree.assert_called_once_with("noise/source-0", ignore_errors=True)
+        mock_copytree.assert_called_once_with("/opt/service/repo/my/stuff", "noise/source-0", copy_function=shutil.copy2)
 
         mock_print.assert_has_calls([
             unittest.mock.call("copying repo/my/stuff")
         ])
 
-        # clone
-
-        mock_exists.return_value = False
-        del self.github.cnc.data["change"]
+        # link
 
-        mock_subprocess.side_effect = ["cloned", "checked out"]
+        self.github.cnc.sources = {}
+        self.github.local = "link"
 
         self.github.change()
 
-        mock_subprocess.assert_has_calls([
-            unittest.mock.call("git clone git@most:my/stuff.git source", shell=True),
-            unittest.mock.call("git checkout ayup", shell=True)
-        ])
+        mock_copytree.assert_called_with("/opt/service/repo/my/stuff", "noise/source-0", copy_function=self.github.link)
+
         mock_print.assert_has_calls([
-            unittest.mock.call("cloned"),
-            unittest.mock.call("checked out")
+            unittest.mock.call("linking repo/my/stuff")
         ])
 
-        # again
+        # clone
 
-        mock_chdir.reset_mock()
+        self.github.data = {
+            "path": "your/stuff"
+        }
 
         self.github.change()
 
-        mock_chdir.assert_not_called()
+        self.github.clone.assert_called_once_with("noise/source-1", None, None)
+
+        self.assertEqual(self.github.cnc.sourcing, "noise/source-1")
+
+        # again, in any order
+
+        mock_rmtree.reset_mock()
+
+        self.github.data = {
+            "path": "my/stuff",
+            "branch": "ayup"
+        }
+
+        self.github.change()
+
+        self.assertEqual(self.github.cnc.sourcing, "noise/source-0")
+
+        self.github.data = {
+            "path": "your/stuff"
+        }
+
+        self.github.change()
+
+        self.assertEqual(self.github.cnc.sourcing, "noise/source-1")
+
+        mock_rmtree.assert_not_called()
+        self.github.clone.assert_called_once()
+        self.github.sparsen.assert_not_called()
+
+        # sparse
+
+        self.github.data = {
+            "path": "your/stuff",
+            "checkout": "sparse"
+        }
+
+        self.github.change(["/deploy"])
+
+        self.github.clone.assert_called_with("noise/source-2", None, ["/deploy"])
+        self.assertEqual(self.github.cnc.sources[("most", "your/stuff", None, "sparse")], {
+            "directory": "noise/source-2",
+            "sparse": ["/deploy"]
+        })
+
+        # sparse already have
+
+        self.github.change(["/deploy"])
+
+        self.github.sparsen.assert_not_called()
+
+        # sparse need more
+
+        self.github.change(["/deploy", "/README.md"])
+
+        self.github.sparsen.assert_called_once_with("noise/source-2", ["/deploy", "/README.md"])
+
+        # sparse need everything
+
+        self.github.change(None)
+
+        self.github.sparsen.assert_called_with("noise/source-2", ["/*"])
+        self.assertIsNone(self.github.cnc.sources[("most", "your/stuff", None, "sparse")]["sparse"])
+
+        self.assertEqual(self.github.clone.call_count, 2)
 
-    @unittest.mock.patch("os.chdir")
     @unittest.mock.patch("shutil.rmtree")
     @unittest.mock.patch("os.makedirs")
     @unittest.mock.patch("builtins.print")
     @unittest.mock.patch("subprocess.check_output")
-    def test_code(self, mock_subprocess, mock_print, mock_makedirs, mock_rmtree, mock_chdir):
+    def test_code(self, mock_subprocess, mock_print, mock_makedirs, mock_rmtree):
 
         self.github.cnc = unittest.mock.MagicMock()
         self.github.repo = unittest.mock.MagicMock()
@@ -656,9 +1594,6 @@ class TestGitHub(unittest.TestCase):
 
         self.github.code()
 
-        mock_chdir.assert_has_calls([
-            unittest.mock.call("noise")
-        ])
         mock_rmtree.assert_called_once_with("noise/destination", ignore_errors=True)
         mock_makedirs.assert_called_once_with("noise/destination")
 
@@ -699,25 +1634,27 @@ class TestGitHub(unittest.TestCase):
         ])
 
         mock_subprocess.assert_has_calls([
-            unittest.mock.call("git clone git@most:my/stuff.git destination", shell=True),
-            unittest.mock.call("git checkout mr-sweat", shell=True)
+            unittest.mock.call("git clone git@most:my/stuff.git noise/destination", shell=True),
+            unittest.mock.call("git checkout mr-sweat", shell=True, cwd="noise/destination")
         ])
         mock_print.assert_has_calls([
             unittest.mock.call("cloned"),
             unittest.mock.call("checked out")
         ])
 
-        mock_chdir.assert_has_calls([
-            unittest.mock.call("noise"),
-            unittest.mock.call("noise/destination")
-        ])
+        # sparse
+
+        self.github.clone = unittest.mock.MagicMock()
+
+        self.github.code(["/deploy"])
+
+        self.github.clone.assert_called_once_with("noise/destination", "mr-sweat", ["/deploy"])
 
-    @unittest.mock.patch("os.chdir")
     @unittest.mock.patch("os.path.exists")
     @unittest.mock.patch("os.rename")
     @unittest.mock.patch("builtins.print")
     @unittest.mock.patch("subprocess.check_output")
-    def test_commit(self, mock_subprocess, mock_print, mock_rename, mock_exists, mock_chdir):
+    def test_commit(self, mock_subprocess, mock_print, mock_rename, mock_exists):
 
         self.github.data = {"url": "sure"}
 
@@ -737,7 +1674,9 @@ class TestGitHub(unittest.TestCase):
 
         git_status = b"Changes to be committed"
 
-        def subprocess(command, shell):
+        def subprocess(command, shell, cwd):
+
+            self.assertEqual(cwd, "noise/destination")
 
             if command.startswith("git add"):
                 return "added"
@@ -754,9 +1693,6 @@ class TestGitHub(unittest.TestCase):
 
         self.github.commit()
 
-        mock_chdir.assert_has_calls([
-            unittest.mock.call("noise/destination")
-        ])
         mock_rename.assert_called_once_with(
             "noise/destination",
             "noise/code-1"
@@ -774,10 +1710,10 @@ class TestGitHub(unittest.TestCase):
         self.github.commit()
 
         mock_subprocess.assert_has_calls([
-            unittest.mock.call("git add .", shell=True),
-            unittest.mock.call("git status", shell=True),
-            unittest.mock.call("git commit -am 'sweat'", shell=True),
-            unittest.mock.call("git push origin", shell=True)
+            unittest.mock.call("git add .", shell=True, cwd="noise/destination"),
+            unittest.mock.call("git status", shell=True, cwd="noise/destination"),
+            unittest.mock.call("git commit -am 'sweat'", shell=True, cwd="noise/destination"),
+            unittest.mock.call("git push origin", shell=True, cwd="noise/destination")
         ])
         mock_print.assert_has_calls([
             unittest.mock.call("added"),
@@ -788,3 +1724,14 @@ class TestGitHub(unittest.TestCase):
         self.github.pull_request.assert_called_once_with()
         self.github.comment.assert_called_once_with()
         self.github.labels.assert_called_once_with()
+        self.assertEqual(self.github.cnc.check.call_count, 2)
+
+        # lost lease before pushing
+
+        self.github.cnc.check.side_effect = Exception("lost lease on sweat")
+        mock_subprocess.reset_mock()
+
+        self.assertRaisesRegex(Exception, "lost lease on sweat", self.github.commit)
+
+        self.assertNotIn(unittest.mock.call("git push origin", shell=True, cwd="noise/destination"), mock_subprocess.call_args_list)
+        self.github.pull_request.assert_called_once_with()
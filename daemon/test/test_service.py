@@ -7,6 +7,32 @@ import fnmatch
 
 import service
 
+class MockScript:
+
+    def __init__(self, redis, script):
+
+        self.redis = redis
+        self.script = script
+
+    def __call__(self, keys, args):
+
+        if self.redis.data.get(keys[0]) != args[0]:
+            return 0
+
+        if self.script == service.RENEW:
+            self.redis.expires[keys[0]] = args[1]
+        elif self.script == service.RELEASE:
+            self.redis.delete(keys[0])
+        else:
+            self.redis.set(keys[1], args[1], ex=args[2])
+            self.redis.hset(keys[2], json.loads(args[3]))
+            self.redis.expire(keys[2], args[2])
+            for key in keys[4:]:
+                self.redis.zrem(key, args[4])
+            self.redis.zadd(keys[3], {args[4]: args[5]})
+
+        return 1
+
 class MockRedis:
 
     def __init__(self, host, **kwargs):
@@ -28,17 +54,115 @@ class MockRedis:
 
         return self.data.get(key)
 
-    def set(self, key, value, ex=None):
+    def set(self, key, value, ex=None, nx=False):
+
+        if nx and key in self.data:
+            return None
 
         self.data[key] = value
         self.expires[key] = ex
 
+        return True
+
+    def exists(self, key):
+
+        return int(key in self.data)
+
+    def delete(self, key):
+
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+
+    def register_script(self, script):
+
+        return MockScript(self, script)
+
     def keys(self, pattern):
 
         for key in sorted(self.data.keys()):
-            if fnmatch.fnmatch(key, pattern):
+            if fnmatch.fnmatch(key, pattern) and isinstance(self.data[key], str):
                 yield key
 
+    def scan_iter(self, pattern):
+
+        return self.keys(pattern)
+
+    def lpush(self, key, value):
+
+        self.data.setdefault(key, [])
+        self.data[key].insert(0, value)
+
+    def rpoplpush(self, source, destination):
+
+        if not self.data.get(source):
+            return None
+
+        value = self.data[source].pop()
+        self.lpush(destination, value)
+
+        return value
+
+    def brpoplpush(self, source, destination, timeout=0):
+
+        self.messages.append(("brpoplpush", source, destination, timeout))
+
+        return self.rpoplpush(source, destination)
+
+    def lrange(self, key, start, end):
+
+        return list(self.data.get(key, []))
+
+    def lrem(self, key, count, value):
+
+        if value in self.data.get(key, []):
+            self.data[key].remove(value)
+            return 1
+
+        return 0
+
+    def expire(self, key, seconds):
+
+        self.expires[key] = seconds
+
+    def hset(self, key, mapping):
+
+        self.data.setdefault(key, {})
+        self.data[key].update(mapping)
+
+    def zadd(self, key, mapping):
+
+        self.data.setdefault(key, {})
+        self.data[key].update(mapping)
+
+    def zrem(self, key, *members):
+
+        for member in members:
+            self.data.get(key, {}).pop(member, None)
+
+    def pipeline(self):
+
+        return MockPipeline(self)
+
+class MockPipeline:
+
+    def __init__(self, redis):
+
+        self.redis = redis
+        self.results = []
+
+    def __getattr__(self, name):
+
+        def call(*args, **kwargs):
+            self.results.append(getattr(self.redis, name)(*args, **kwargs))
+
+        return call
+
+    def execute(self):
+
+        results, self.results = self.results, []
+
+        return results
+
 class TestService(unittest.TestCase):
 
     @unittest.mock.patch.dict(os.environ, {
@@ -51,7 +175,10 @@ class TestService(unittest.TestCase):
         self.daemon = service.Daemon()
 
     @unittest.mock.patch.dict(os.environ, {
-        "SLEEP": "7"
+        "SLEEP": "7",
+        "WORKERS": "3",
+        "MODE": "thread",
+        "LEASE": "30"
     })
 
     @unittest.mock.patch("redis.Redis", MockRedis)
@@ -61,45 +188,342 @@ class TestService(unittest.TestCase):
         daemon = service.Daemon()
 
         self.assertEqual(daemon.sleep, 7)
+        self.assertEqual(daemon.workers, 3)
+        self.assertEqual(daemon.mode, "thread")
+        self.assertEqual(daemon.lease, 30)
 
         self.assertEqual(daemon.redis.host, "redis.cnc-forge")
 
-        mock_github.assert_called_once_with()
+        mock_github.assert_called_once_with(daemon.redis)
+
+    def test_recover(self):
+
+        self.daemon.redis.set("/cnc/music", json.dumps({"status": "Created"}))
+        self.daemon.redis.set("/cnc/factory", json.dumps({"status": "Retry"}))
+        self.daemon.redis.set("/cnc/sing", json.dumps({"status": "Completed"}))
+
+        self.daemon.redis.lpush("/queue/cnc/processing", "stuck")
+
+        self.daemon.recover()
+
+        self.assertEqual(self.daemon.redis.data["/queue/cnc"], ["music", "factory", "stuck"])
+        self.assertEqual(self.daemon.redis.data["/queue/cnc/processing"], [])
+
+    @unittest.mock.patch("service.time.time")
+    def test_reclaim(self, mock_time):
+
+        mock_time.return_value = 123
+
+        self.daemon.redis.lpush("/queue/cnc/processing", "dead")
+        self.daemon.redis.lpush("/queue/cnc/processing", "alive")
+        self.daemon.redis.set("/lease/cnc/alive", "someone", ex=60)
+
+        self.daemon.reclaim()
+
+        self.assertEqual(self.daemon.reclaimed, 123)
+        self.assertEqual(self.daemon.redis.data["/queue/cnc"], ["dead"])
+        self.assertEqual(self.daemon.redis.data["/queue/cnc/processing"], ["alive"])
+
+    @unittest.mock.patch("service.time.time")
+    @unittest.mock.patch("builtins.print")
+    def test_renewing(self, mock_print, mock_time):
+
+        mock_time.return_value = 0
+
+        self.daemon.lease = 30
+        self.daemon.redis.set("/lease/cnc/music", "me", ex=30)
+
+        done = unittest.mock.MagicMock()
+        done.wait.side_effect = [False, True]
+
+        lost = unittest.mock.MagicMock()
+
+        self.daemon.renewing("music", "me", done, lost)
+
+        done.wait.assert_called_with(10)
+        self.assertEqual(self.daemon.redis.expires["/lease/cnc/music"], 30)
+        lost.set.assert_not_called()
+
+        # lost
+
+        self.daemon.redis.set("/lease/cnc/music", "you", ex=None)
+
+        done.wait.side_effect = [False, False]
+
+        self.daemon.renewing("music", "me", done, lost)
+
+        self.assertIsNone(self.daemon.redis.expires["/lease/cnc/music"])
+        self.assertEqual(done.wait.call_count, 3)
+        lost.set.assert_called_once_with()
+        mock_print.assert_called_once_with("lost lease on music")
+
+        # redis down, keeps trying until the lease would've run out
+
+        lost = unittest.mock.MagicMock()
+
+        self.daemon.renew = unittest.mock.MagicMock(side_effect=[1] + [service.redis.exceptions.ConnectionError("down")] * 3)
+
+        mock_time.side_effect = [100, 105, 115, 125, 135]
+
+        done.wait.reset_mock()
+        done.wait.side_effect = [False] * 4
+
+        self.daemon.renewing("music", "me", done, lost)
+
+        self.assertEqual(self.daemon.renew.call_count, 4)
+        lost.set.assert_called_once_with()
+        mock_print.assert_has_calls([
+            unittest.mock.call("failed to renew lease on music: down"),
+            unittest.mock.call("failed to renew lease on music: down"),
+            unittest.mock.call("failed to renew lease on music: down"),
+            unittest.mock.call("lost lease on music")
+        ])
+
+        # redis back in time
 
+        lost = unittest.mock.MagicMock()
+
+        self.daemon.renew = unittest.mock.MagicMock(side_effect=[service.redis.exceptions.TimeoutError("slow"), 1])
+
+        mock_time.side_effect = [200, 210, 220]
+
+        done.wait.side_effect = [False, False, True]
+
+        self.daemon.renewing("music", "me", done, lost)
+
+        self.assertEqual(self.daemon.renew.call_count, 2)
+        lost.set.assert_not_called()
+
+    def test_report(self):
+
+        lost = unittest.mock.MagicMock()
+        lost.is_set.return_value = False
+
+        self.daemon.redis.hset("/status/cnc/music", {"status": '"Created"'})
+
+        self.daemon.report("music", {"progress": {"code": 1}, "links": ["http://here"]}, lost)
+
+        self.assertEqual(self.daemon.redis.data["/status/cnc/music"], {
+            "status": '"Created"',
+            "progress": '{"code": 1}',
+            "links": '["http://here"]'
+        })
+
+        # lost
+
+        lost.is_set.return_value = True
+
+        self.daemon.report("music", {"progress": {"code": 2}}, lost)
+
+        self.assertEqual(self.daemon.redis.data["/status/cnc/music"]["progress"], '{"code": 1}')
+
+    @unittest.mock.patch("service.time.time")
+    def test_score(self, mock_time):
+
+        mock_time.return_value = 7.5
+
+        self.assertEqual(self.daemon.score("fun-here-3"), 3)
+        self.assertEqual(self.daemon.score("nope"), 7)
+
+    def test_finish(self):
+
+        self.daemon.redis.set("/lease/cnc/fun-here-3", "me")
+        self.daemon.redis.zadd("/index/cnc/status/Created", {"fun-here-3": 3})
+
+        self.assertEqual(self.daemon.finish("fun-here-3", "me", {"status": "Completed", "links": ["http://here"]}), 1)
+
+        self.assertEqual(json.loads(self.daemon.redis.get("/cnc/fun-here-3")), {"status": "Completed", "links": ["http://here"]})
+        self.assertEqual(self.daemon.redis.expires["/cnc/fun-here-3"], 86400)
+        self.assertEqual(self.daemon.redis.data["/status/cnc/fun-here-3"], {
+            "status": '"Completed"',
+            "links": '["http://here"]'
+        })
+        self.assertEqual(self.daemon.redis.expires["/status/cnc/fun-here-3"], 86400)
+        self.assertEqual(self.daemon.redis.data["/index/cnc/status/Created"], {})
+        self.assertEqual(self.daemon.redis.data["/index/cnc/status/Completed"], {"fun-here-3": 3})
+
+        # lost
+
+        self.daemon.redis.set("/lease/cnc/fun-here-3", "you")
+
+        self.assertEqual(self.daemon.finish("fun-here-3", "me", {"status": "Error"}), 0)
+
+        self.assertEqual(json.loads(self.daemon.redis.get("/cnc/fun-here-3"))["status"], "Completed")
+        self.assertEqual(self.daemon.redis.data["/status/cnc/fun-here-3"]["status"], '"Completed"')
+        self.assertNotIn("/index/cnc/status/Error", self.daemon.redis.data)
+
+    @unittest.mock.patch("service.time.time")
     @unittest.mock.patch("cnc.CnC.process")
     @unittest.mock.patch("traceback.format_exc")
-    def test_process(self, mock_traceback, mock_process):
+    def test_process(self, mock_traceback, mock_process, mock_time):
+
+        mock_time.return_value = 7
 
         self.daemon.redis.set("/cnc/music", json.dumps({"status": "Created"}))
         self.daemon.redis.set("/cnc/factory", json.dumps({"status": "Retry"}))
         self.daemon.redis.set("/cnc/sing", json.dumps({"status": "Nope"}))
 
+        self.daemon.redis.set("/cnc/busy", json.dumps({"status": "Created"}))
+        self.daemon.redis.set("/lease/cnc/busy", "someone", ex=60)
+
+        for cnc_id in ["music", "factory", "sing", "gone", "busy"]:
+            self.daemon.redis.lpush("/queue/cnc", cnc_id)
+
+        self.daemon.reclaimed = float("inf")
+
         mock_process.side_effect= Exception("whoops")
         mock_traceback.return_value = "adaisy"
 
-        self.daemon.process()
+        for _ in range(6):
+            self.daemon.process()
+
+        self.assertEqual(self.daemon.redis.messages[-1], ("brpoplpush", "/queue/cnc", "/queue/cnc/processing", 7))
 
         self.assertEqual(json.loads(self.daemon.redis.get("/cnc/music")), {
             "status": "Error",
             "error": "whoops",
-            "traceback": "adaisy"
+            "traceback": "adaisy",
+            "timings": {"started": 7, "finished": 7}
         })
 
         self.assertEqual(json.loads(self.daemon.redis.get("/cnc/factory")), {
             "status": "Error",
             "error": "whoops",
-            "traceback": "adaisy"
+            "traceback": "adaisy",
+            "timings": {"started": 7, "finished": 7}
+        })
+
+        self.assertEqual(self.daemon.redis.data["/status/cnc/music"], {
+            "status": '"Error"',
+            "error": '"whoops"',
+            "timings": '{"started": 7, "finished": 7}'
         })
+        self.assertEqual(self.daemon.redis.expires["/status/cnc/music"], 86400)
+
+        self.assertEqual(sorted(self.daemon.redis.data["/index/cnc/status/Error"]), ["factory", "music"])
 
         self.assertEqual(json.loads(self.daemon.redis.get("/cnc/sing")), {
             "status": "Nope"
         })
 
+        self.assertEqual(json.loads(self.daemon.redis.get("/cnc/busy")), {
+            "status": "Created"
+        })
+
+        self.assertEqual(mock_process.call_count, 2)
+
+        self.assertEqual(self.daemon.redis.data["/queue/cnc"], [])
+        self.assertEqual(self.daemon.redis.data["/queue/cnc/processing"], [])
+
+        self.assertNotIn("/lease/cnc/music", self.daemon.redis.data)
+        self.assertEqual(self.daemon.redis.data["/lease/cnc/busy"], "someone")
+
+        # reclaims when it's been a while
+
+        mock_time.return_value = 123
+        self.daemon.reclaimed = 0
+        self.daemon.reclaim = unittest.mock.MagicMock()
+
+        self.daemon.process()
+
+        self.daemon.reclaim.assert_called_once_with()
+
+    @unittest.mock.patch("service.time.time")
+    @unittest.mock.patch("cnc.CnC.process")
+    @unittest.mock.patch("builtins.print")
+    def test_process_lost(self, mock_print, mock_process, mock_time):
+
+        mock_time.return_value = 7
+
+        self.daemon.redis.set("/cnc/music", json.dumps({"status": "Created"}))
+        self.daemon.redis.lpush("/queue/cnc", "music")
+        self.daemon.reclaimed = float("inf")
+
+        # lease expires and someone else takes over mid process
+
+        def process(*args, **kwargs):
+            self.daemon.redis.set("/lease/cnc/music", "someone", ex=60)
+            self.daemon.redis.set("/cnc/music", json.dumps({"status": "Completed"}))
+
+        mock_process.side_effect = process
+
+        self.daemon.process()
+
+        mock_print.assert_called_once_with("lost lease on music, not saving")
+
+        self.assertEqual(json.loads(self.daemon.redis.get("/cnc/music")), {"status": "Completed"})
+        self.assertEqual(self.daemon.redis.data["/status/cnc/music"], {"timings": '{"started": 7}'})
+        self.assertNotIn("/index/cnc/status/Completed", self.daemon.redis.data)
+        self.assertEqual(self.daemon.redis.data["/lease/cnc/music"], "someone")
+
+    def test_work(self):
+
+        self.daemon.process = unittest.mock.MagicMock(side_effect=[None, Exception("whoops")])
+
+        self.assertRaisesRegex(Exception, "whoops", self.daemon.work)
+
+        self.assertEqual(self.daemon.process.call_count, 2)
+
+    @unittest.mock.patch("threading.Thread")
+    @unittest.mock.patch("multiprocessing.Process")
+    def test_spawn(self, mock_process, mock_thread):
+
+        self.assertEqual(self.daemon.mode, "process")
+
+        self.assertEqual(self.daemon.spawn(), mock_process.return_value)
+
+        mock_process.assert_called_once_with(target=self.daemon.work, daemon=True)
+        mock_process.return_value.start.assert_called_once_with()
+
+        self.daemon.mode = "thread"
+
+        self.assertEqual(self.daemon.spawn(), mock_thread.return_value)
+
+        mock_thread.assert_called_once_with(target=self.daemon.work, daemon=True)
+        mock_thread.return_value.start.assert_called_once_with()
+
+    @unittest.mock.patch("socket.gethostname")
+    @unittest.mock.patch("os.getpid")
+    @unittest.mock.patch("threading.get_ident")
+    def test_worker(self, mock_ident, mock_pid, mock_host):
+
+        mock_host.return_value = "pod"
+        mock_pid.return_value = 7
+        mock_ident.return_value = 11
+
+        self.assertEqual(self.daemon.worker(), "pod/7/11")
+
     @unittest.mock.patch("service.time.sleep")
-    def test_run(self, mock_sleep):
+    @unittest.mock.patch("builtins.print")
+    def test_run(self, mock_print, mock_sleep):
+
+        self.daemon.recover = unittest.mock.MagicMock()
+        self.daemon.work = unittest.mock.MagicMock()
+
+        # single
+
+        self.daemon.run()
+
+        self.daemon.recover.assert_called_once_with()
+        self.daemon.work.assert_called_once_with()
+
+        # pool
+
+        self.daemon.workers = 2
+
+        alive = unittest.mock.MagicMock()
+        alive.is_alive.return_value = True
+
+        dead = unittest.mock.MagicMock()
+        dead.name = "Worker-2"
+        dead.is_alive.return_value = False
+
+        self.daemon.spawn = unittest.mock.MagicMock(side_effect=[alive, dead, alive])
 
         mock_sleep.side_effect = [Exception("whoops")]
 
         self.assertRaisesRegex(Exception, "whoops", self.daemon.run)
 
-        mock_sleep.assert_called_with(7)
+        self.assertEqual(self.daemon.spawn.call_count, 3)
+        mock_print.assert_called_once_with("worker Worker-2 exited")
+        mock_sleep.assert_called_once_with(7)
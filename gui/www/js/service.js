@@ -36,15 +36,69 @@ DRApp.controller("Base",null,{
             window.clearTimeout(this.delay_timer);
         }
     },
-    delay_change: function() {
+    delay_changed: null,
+    delay_change: function(name) {
         this.delay_clear();
+        this.delay_changed = this.delay_changed || [];
+        if (this.delay_changed.indexOf(name) < 0) {
+            this.delay_changed.push(name);
+        }
         this.delay_timer = window.setTimeout($.proxy(this, "fields_change"), 2000);
     },
     fields_change: function() {
         this.delay_clear();
-        this.it = this.rest("OPTIONS", "api/cnc/" + DRApp.current.path.id, this.fields_request());
+        var request = this.fields_request();
+        if (this.it.blocks && this.delay_changed) {
+            request['changed'] = this.delay_changed;
+        }
+        this.delay_changed = null;
+        var it = this.rest("OPTIONS", "api/cnc/" + DRApp.current.path.id, request);
+        if (it.delta) {
+            this.fields_fill(this.it.fields, request.values);
+            this.fields_merge(it);
+        } else {
+            this.it = it;
+        }
         this.application.render(this.it);
     },
+    fields_merge: function(delta) {
+        var fields = {};
+        var blocked = {};
+        for (var index = 0; index < this.it.fields.length; index++) {
+            fields[this.it.fields[index].name] = this.it.fields[index];
+        }
+        for (var index = 0; index < delta.fields.length; index++) {
+            fields[delta.fields[index].name] = delta.fields[index];
+        }
+        for (var block = 0; block < this.it.blocks.length; block++) {
+            for (var index = 0; index < this.it.blocks[block].length; index++) {
+                blocked[this.it.blocks[block][index]] = true;
+            }
+            if (block in delta.blocks) {
+                this.it.blocks[block] = delta.blocks[block];
+            }
+        }
+        var merged = [];
+        var added = {};
+        var names = [];
+        for (var index = 0; index < this.it.fields.length; index++) {
+            if (!(this.it.fields[index].name in blocked)) {
+                names.push(this.it.fields[index].name);
+            }
+        }
+        for (var block = 0; block < this.it.blocks.length; block++) {
+            names = names.concat(this.it.blocks[block]);
+        }
+        for (var index = 0; index < names.length; index++) {
+            if (names[index] in fields && !(names[index] in added)) {
+                added[names[index]] = true;
+                merged.push(fields[names[index]]);
+            }
+        }
+        this.it.fields = merged;
+        this.it.errors = delta.errors;
+        this.it.valid = delta.valid;
+    },
     field_all: function(field) {
         var checked = $("input[name='" + field + "__all']").prop('checked');
         $("input[name='" + field + "']").each(function () {
@@ -96,6 +150,70 @@ DRApp.controller("Base",null,{
         }
         return values;
     },
+    fields_fill: function(fields, values, name, extra) {
+        for (var index = 0; index < fields.length; index++) {
+            var field = fields[index];
+            if (field.fields) {
+                this.fields_fill(field.fields, values[field.name] || {}, name, extra);
+                continue;
+            }
+            if (field.name in values) {
+                field.value = values[field.name];
+            }
+            if (field.name == name) {
+                var options = extra.options.slice();
+                var titles = extra.titles ? $.extend({}, extra.titles) : null;
+                if (field.search) {
+                    var selected = field.multi ? (field.value || []) : ((field.value == null || field.value === '') ? [] : [field.value]);
+                    for (var choice = selected.length - 1; choice > -1; choice--) {
+                        if (options.indexOf(selected[choice]) < 0) {
+                            options.unshift(selected[choice]);
+                        }
+                        if (titles && !(selected[choice] in titles)) {
+                            titles[selected[choice]] = field.titles && selected[choice] in field.titles ? field.titles[selected[choice]] : selected[choice];
+                        }
+                    }
+                    field.filter = extra.filter;
+                    field.page = extra.page;
+                    field.more = extra.more;
+                }
+                field.options = options;
+                if (titles) {
+                    field.titles = titles;
+                }
+                delete field.defer;
+            }
+        }
+    },
+    field_options: function(name) {
+        var request = this.fields_request();
+        var extra = this.rest("POST", "api/forge/" + DRApp.current.path.id + "/field/" + encodeURIComponent(name) + "/options", request);
+        this.fields_fill(this.it.fields, request.values, name, extra);
+        this.application.render(this.it);
+    },
+    search_timer: null,
+    search_clear: function() {
+        if (this.search_timer) {
+            window.clearTimeout(this.search_timer);
+        }
+    },
+    search_change: function(name, full_name) {
+        this.search_clear();
+        this.search_timer = window.setTimeout($.proxy(this, "field_search", name, full_name, 1), 500);
+    },
+    field_search: function(name, full_name, page) {
+        this.search_clear();
+        var request = this.fields_request();
+        request['filter'] = $('#' + full_name + '__filter').val() || '';
+        request['page'] = page;
+        var extra = this.rest("POST", "api/forge/" + DRApp.current.path.id + "/field/" + encodeURIComponent(name) + "/options", request);
+        extra.filter = request['filter'];
+        this.fields_fill(this.it.fields, request.values, name, extra);
+        this.application.render(this.it);
+        var filter = $('#' + full_name + '__filter');
+        filter.focus();
+        filter[0].setSelectionRange(filter.val().length, filter.val().length);
+    },
     fields_request: function() {
         var request = {};
         request['values'] = this.fields_values();
@@ -121,12 +239,21 @@ DRApp.controller("Base",null,{
             window.clearTimeout(this.cnc_timer);
         }
     },
+    cnc_status: null,
     cnc_refresh: function() {
         this.cnc_clear();
-        this.cnc_retrieve();
+        var status = JSON.stringify(this.rest("GET", "api/cnc/" + DRApp.current.path.id + "?fields=status,error,links,progress").cnc);
+        if (status != this.cnc_status) {
+            this.cnc_status = status;
+            this.cnc_retrieve();
+        } else {
+            this.cnc_timer = window.setTimeout($.proxy(this, "cnc_refresh"), 5000);
+        }
     },
     cnc_list: function() {
-        this.it = this.rest("GET", "api/cnc");
+        var cursor = DRApp.current.query.cursor;
+        this.it = this.rest("GET", "api/cnc" + (cursor ? "?cursor=" + encodeURIComponent(cursor) : ""));
+        this.it.first = !cursor;
         this.application.render(this.it);
     },
     cnc_retrieve: function() {